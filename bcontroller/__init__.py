@@ -1,14 +1,25 @@
 import sys
 import subprocess
+import collections
+import glob
 import os
 import re
+import shlex
+import shutil
 import json
+import datetime
 import multiprocessing
 import logging
-from logging import debug, info, warning
+import signal
+import tempfile
+import threading
+import time
+from logging import debug, info, warning, error
 
 import click
 
+from .stream import STDERR, STDOUT, Interrupt, LineMatcher, SpillBuffer, TailBuffer, multiplex
+
 from ._version import get_versions
 v = get_versions()
 __version__ = v.get("closest-tag", v["version"])
@@ -20,6 +31,15 @@ __maintainer__ = __author__
 __email__ = "seberm@seberm.com"
 
 _DRY_RUN_ACTIVE = False
+_EMBEDDED_RUNNER = None
+_SSH_POOL = None
+_AGENT_POOL = None
+_FANOUT = None
+_HTTP_SERVER = None
+_BOOT_PROBER = None
+_CONSOLE = None
+_POWER = None
+_BUILD_CACHE = None
 _CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 
 os.environ["ANSIBLE_CONFIG"] = os.path.join(_CUR_DIR, "../ansible.cfg")
@@ -35,6 +55,24 @@ class BControlCommandError(BControlError):
         self.__dict__.update(locals())
 
 
+class BControlBuildError(BControlError):
+    def __init__(self, line):
+        super().__init__("Build failed: %s" % line.text.rstrip())
+        self.line = line
+
+
+class BControlTimeout(BControlError):
+    """
+    Command or bisect phase did not finish before its deadline and was killed.
+    """
+
+    def __init__(self, what, elapsed, phase=None):
+        super().__init__("%s did not finish in time, killed after %.1f s." % (what, elapsed))
+        self.what = what
+        self.elapsed = elapsed
+        self.phase = phase
+
+
 class BControlBisect(Exception):
     """
     Abstract bisect exception.
@@ -50,46 +88,191 @@ class BControlBisectAbort(BControlBisect):
     pass
 
 
+# Mimics the finished subprocess.Popen object returned from run_command by
+# the runners which do not spawn a process per call
+CompletedRun = collections.namedtuple("CompletedRun", [
+    "args",
+    "returncode",
+])
+
+
 def convert_json(json_input):
     return json.loads(json_input)
 
 
-def run_command(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=None):
-    debug("Running CMD: %s", args)
-    process = subprocess.Popen(args, stdout=stdout, stderr=stderr, env=env)
-    out = []
-    for c in iter(lambda: process.stdout.read(1), b''):
+class _OutputTee:
+    """
+    Distribute output lines of a command into its output buffers, onto the
+    console (in debug mode) and into the log file.
+    """
+
+    def __init__(self, output, stderr_output, log_file=None):
+        self._buffers = {
+            STDOUT: output,
+            STDERR: stderr_output,
+        }
+        self._consoles = {}
         if logging.root.level == logging.DEBUG:
-            sys.stdout.buffer.write(c)
+            self._consoles = {
+                STDOUT: sys.stdout,
+                STDERR: sys.stderr,
+            }
+
+        self._log = None
+        if log_file:
+            self._log = open(log_file, "a", encoding="utf-8")
+
+        self._start = time.monotonic()
+
+    def write(self, line):
+        self._buffers[line.stream].write(line.text)
+
+        console = self._consoles.get(line.stream)
+        if console is not None:
+            console.write(line.text)
+            console.flush()
+
+        if self._log is not None:
+            self._log.write("[%10.3f] %s: %s" % (line.timestamp - self._start, line.stream, line.text))
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+
+
+def _kill_process_group(process, sig=signal.SIGKILL):
+    """
+    Send `sig` to the whole process group of `process` (the process has to be
+    started with start_new_session=True), e.g. to make/gcc or ssh children.
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
 
-        sys.stdout.flush()
-        out.append(c.decode('utf-8'))
 
-    _, stderr_output = process.communicate()
-    output = ''.join(out)
+class CommandStream:
+    """
+    Iterable over output lines (see bcontroller.stream.OutputLine) of a running
+    command. Standard output and standard error output are drained
+    concurrently, so the command never stalls on a full pipe.
+
+    The standard output is collected in the `output` buffer (the whole output
+    spilled to disk by default), the tail of the standard error output in
+    `stderr_output`. In debug mode the lines are also teed onto the console
+    and if `log_file` is given, they are appended there with a timestamp.
+
+    When the iteration finishes, the command has exited. BControlCommandError
+    is raised if its exit code is not zero. If the iteration is stopped
+    earlier, the whole process group of the command is killed.
+
+    Every line is passed to all `hooks` (callables, see e.g.
+    bcontroller.stream.LineMatcher) as soon as it is read. An exception raised
+    from a hook stops the command and is propagated.
+
+    If the command does not finish in `timeout` seconds, its process group is
+    killed and BControlTimeout is raised. An exception thrown into `interrupt`
+    (see bcontroller.stream.Interrupt) kills it too and is propagated.
+    """
 
-    if process.returncode != 0:
-        raise BControlCommandError(
-            args,
-            process,
-            output,
-            stderr_output.decode("utf-8"),
+    def __init__(self, args, env=None, output=None, log_file=None, hooks=(), timeout=None, interrupt=None):
+        self.args = args
+        self.env = env
+        self.hooks = list(hooks)
+        self.timeout = timeout
+        self.interrupt = interrupt
+        self.output = SpillBuffer() if output is None else output
+        self.stderr_output = TailBuffer()
+        self.log_file = log_file
+        self.process = None
+
+    def __iter__(self):
+        debug("Running CMD: %s", self.args)
+        tee = _OutputTee(self.output, self.stderr_output, self.log_file)
+        self.process = subprocess.Popen(
+            self.args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.env,
+            start_new_session=True,
         )
+        start = time.monotonic()
+        deadline = None if self.timeout is None else start + self.timeout
+        try:
+            for line in multiplex({
+                STDOUT: self.process.stdout,
+                STDERR: self.process.stderr,
+            }, deadline=deadline, interrupt=self.interrupt):
+                tee.write(line)
+                for hook in self.hooks:
+                    hook(line)
+
+                yield line
+
+            self.process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        except (TimeoutError, subprocess.TimeoutExpired):
+            _kill_process_group(self.process)
+            elapsed = time.monotonic() - start
+            warning("Program [$ %s] exceeded its %d s deadline, killed", " ".join(self.args), self.timeout)
+            raise BControlTimeout("Program [$ %s]" % " ".join(self.args), elapsed)
+        finally:
+            tee.close()
+
+            # The consumer stopped the iteration before the command finished
+            if self.process.returncode is None:
+                _kill_process_group(self.process)
+                self.process.wait()
+
+            self.process.stdout.close()
+            self.process.stderr.close()
+
+        if self.process.returncode != 0:
+            raise BControlCommandError(
+                self.args,
+                self.process,
+                self.output.getvalue(),
+                self.stderr_output.getvalue(),
+            )
+
+
+def iter_command(args, env=None, output=None, log_file=None, hooks=(), timeout=None, interrupt=None):
+    """
+    Run the command given by `args` and iterate over its output lines.
+    """
+    return CommandStream(args, env=env, output=output, log_file=log_file, hooks=hooks, timeout=timeout,
+                         interrupt=interrupt)
+
+
+def run_command(args, env=None, output=None, log_file=None, hooks=(), timeout=None, interrupt=None):
+    """
+    Run the command given by `args`, wait until it finishes and return its
+    standard output together with the finished process.
+    """
+    cmd = iter_command(args, env=env, output=output, log_file=log_file, hooks=hooks, timeout=timeout,
+                       interrupt=interrupt)
+    for _ in cmd:
+        pass
 
-    return output, process
+    return cmd.output.getvalue(), cmd.process
 
 
-def git(args, work_dir=os.getcwd()):
-    cmd_args = [
+def _git_args(args, work_dir):
+    return [
         "git",
         "-C",
         work_dir,
     ] + args
 
-    return run_command(cmd_args)
 
+def git(args, work_dir=os.getcwd()):
+    return run_command(_git_args(args, work_dir))
+
+
+def iter_git(args, work_dir=os.getcwd()):
+    return iter_command(_git_args(args, work_dir))
 
-def ansible(module_name, limit, params=""):
+
+def _ansible_args(module_name, limit, params=""):
     ansible_cmd = [
         "ansible",
         "-m",
@@ -104,16 +287,10 @@ def ansible(module_name, limit, params=""):
 
     # Limit hosts
     ansible_cmd.append(limit)
-
-    try:
-        return run_command(ansible_cmd)
-    except BControlCommandError as e:
-        # Parse ansible JSON output to get error message
-        ans_out = convert_json(e.output)
-        raise BControlError(ans_out["stats"])
+    return ansible_cmd
 
 
-def ansible_playbook(playbook, limit, **argv):
+def _ansible_playbook_args(playbook, limit, forks=None, **argv):
     extra_vars = " ".join(
         f"{key}={val}" for key, val in argv.items()
     )
@@ -125,103 +302,1467 @@ def ansible_playbook(playbook, limit, **argv):
         playbook,
     ]
 
+    if forks:
+        ansible_playbook_cmd += ["--forks", str(forks)]
+
     if extra_vars:
         ansible_playbook_cmd.append("--extra-vars")
         ansible_playbook_cmd.append(extra_vars)
 
+    return ansible_playbook_cmd
+
+
+# Tasks of bcontrol playbooks are tagged with the bisect phase they belong to,
+# e.g. tags: [phase_install] (see PHASES)
+_PHASE_TAG_PREFIX = "phase_"
+
+_TIMEOUT_MSG_PATTERN = re.compile(r"timed out|timeout", re.IGNORECASE)
+
+
+def _task_elapsed(task):
     try:
-        return run_command(ansible_playbook_cmd)
+        duration = task["duration"]
+        start = datetime.datetime.strptime(duration["start"], "%Y-%m-%dT%H:%M:%S.%fZ")
+        end = datetime.datetime.strptime(duration["end"], "%Y-%m-%dT%H:%M:%S.%fZ")
+    except (KeyError, ValueError):
+        return 0.0
+
+    return (end - start).total_seconds()
+
+
+def _task_phase(task):
+    """
+    Return the bisect phase of the Ansible `task` given by its phase tag, None
+    when it has none.
+    """
+    for tag in task.get("tags") or ():
+        if tag.startswith(_PHASE_TAG_PREFIX):
+            return tag[len(_PHASE_TAG_PREFIX):]
+
+    return None
+
+
+def _result_timeout(task, host, result):
+    """
+    Return BControlTimeout if the `result` of the `task` on the `host` failed
+    because of the task timeout (task timeout keyword, reboot_timeout, ...),
+    None otherwise.
+    """
+    if not result.get("failed") or not _TIMEOUT_MSG_PATTERN.search(str(result.get("msg", ""))):
+        return None
+
+    task_name = task["task"]["name"]
+    return BControlTimeout(
+        "Ansible task [%s] on %s" % (task_name, host),
+        _task_elapsed(task["task"]),
+        phase=_task_phase(task["task"]),
+    )
+
+
+def _ansible_timeout(ans_out):
+    """
+    Return BControlTimeout for the first task which failed because of its
+    timeout, None otherwise.
+    """
+    for play in ans_out.get("plays", []):
+        for task in play.get("tasks", []):
+            for host, result in task.get("hosts", {}).items():
+                timeout_error = _result_timeout(task, host, result)
+                if timeout_error is not None:
+                    return timeout_error
+
+    return None
+
+
+def _ansible_failure(ans_out):
+    return _ansible_timeout(ans_out) or BControlError("Ansible failed, stats: %s" % ans_out["stats"])
+
+
+def _ansible_error(e, events):
+    if not events.stats:
+        # Ansible failed before running anything (e.g. syntax error)
+        return BControlError(e.message)
+
+    return _ansible_failure(events.document())
+
+
+class AnsibleEvents:
+    """
+    Follow events of an Ansible run (see callback_plugins/bcontrol_ndjson.py)
+    as they arrive, log the progress and build the result document: plays,
+    their tasks with results per host, and stats (the same document the json
+    stdout callback produces).
+
+    With `fail_fast`, the first host which failed (unless the errors are
+    ignored by the task) or is unreachable raises BControlError (or
+    BControlTimeout), which stops the whole run.
+
+    `on_result` is called with task name, host and result of every host
+    result as it arrives. An exception raised from it stops the run too.
+    """
+
+    def __init__(self, fail_fast=False, on_result=None):
+        self.fail_fast = fail_fast
+        self.on_result = on_result
+        self.plays = []
+        self.stats = {}
+        self._tasks = {}
+
+    def hook(self, line):
+        """
+        Output line hook for run_command().
+        """
+        if line.stream != STDOUT:
+            return
+
+        try:
+            event = json.loads(line.text)
+        except ValueError:
+            debug("ansible: %s", line.text.rstrip())
+            return
+
+        self.feed(event)
+
+    def feed(self, event):
+        kind = event.get("event")
+        if kind == "play_start":
+            self.plays.append({
+                "play": dict(event["play"], duration={"start": event["time"]}),
+                "tasks": [],
+            })
+        elif kind == "task_start":
+            if event["task"]["id"] in self._tasks:
+                # Started again by another host (free strategy)
+                return
+
+            task = {
+                "task": dict(event["task"], duration={"start": event["time"], "end": event["time"]}),
+                "hosts": {},
+            }
+            self._tasks[event["task"]["id"]] = task
+            self.plays[-1]["tasks"].append(task)
+            info("ansible: TASK [%s]", event["task"]["name"])
+        elif kind == "result":
+            self._result(event)
+        elif kind == "stats":
+            self.stats = event["stats"]
+
+    def _result(self, event):
+        task = self._tasks[event["task"]["id"]]
+        host = event["host"]
+        status = event["status"]
+
+        result = event["result"]
+        if status != "ok":
+            result[status] = True
+
+        task["hosts"][host] = result
+        task["task"]["duration"]["end"] = event["time"]
+        if self.on_result is not None:
+            self.on_result(task["task"]["name"], host, result)
+
+        fatal = status == "unreachable" or (status == "failed" and not event["ignore_errors"])
+        if not fatal:
+            debug("ansible: %s: [%s] %s", host, task["task"]["name"], status)
+            return
+
+        warning("ansible: %s: [%s] %s: %s", host, task["task"]["name"], status, result.get("msg", ""))
+        if self.fail_fast:
+            raise _result_timeout(task, host, result) or BControlError(
+                "Ansible task [%s] %s on %s: %s" % (task["task"]["name"], status, host, result.get("msg", ""))
+            )
+
+    def document(self):
+        return {
+            "plays": self.plays,
+            "stats": self.stats,
+        }
+
+    def dumps(self):
+        return json.dumps(self.document())
+
+
+def use_embedded_runner(inventory=None):
+    """
+    Run all following ansible() and ansible_playbook() calls in this process
+    (see bcontroller.embedded) instead of spawning the ansible commands.
+    """
+    global _EMBEDDED_RUNNER
+    from .embedded import EmbeddedRunner
+    _EMBEDDED_RUNNER = EmbeddedRunner(inventory)
+
+
+def use_ssh_pool(group="duts", **kwargs):
+    """
+    Keep persistent SSH master connections to all hosts of the `group` (see
+    bcontroller.sshpool) and let Ansible use them. Has to be called before
+    use_embedded_runner().
+    """
+    global _SSH_POOL
+    from .inventory import load_inventory
+    from .sshpool import SSHPool
+
+    _SSH_POOL = SSHPool(load_inventory().hosts(group), **kwargs)
+    os.environ.update(_SSH_POOL.ansible_env())
+    _SSH_POOL.warm()
+    return _SSH_POOL
+
+
+def use_agent(group="duts", fanout=None):
+    """
+    Run sh/uname/run on all hosts of the `group` through the persistent DUT
+    agent (see bcontroller.agent) instead of Ansible modules. With `fanout`
+    degree, kernel packages are relayed by DUTs to each other (see
+    bcontroller.fanout) instead of being sent to every DUT by the controller.
+    """
+    global _AGENT_POOL, _FANOUT
+    from .agent import AgentPool
+    from .fanout import FanOut
+    from .inventory import load_inventory
+
+    _AGENT_POOL = AgentPool(load_inventory().hosts(group), ssh_pool=_SSH_POOL)
+    if fanout:
+        _FANOUT = FanOut(_AGENT_POOL, degree=fanout)
+
+    return _AGENT_POOL
+
+
+def use_http_server(address=None, port=None):
+    """
+    Let DUTs download kernel packages from the HTTP server (see
+    bcontroller.httpd) running inside bcontrol instead of pushing them.
+    `address` is how DUTs reach the controller.
+    """
+    global _HTTP_SERVER
+    from .httpd import DEFAULT_PORT, ArtifactServer
+
+    _HTTP_SERVER = ArtifactServer(address, DEFAULT_PORT if port is None else port)
+    _HTTP_SERVER.start()
+    return _HTTP_SERVER
+
+
+def use_boot_probe():
+    """
+    Let bcontrol watch rebooting DUTs (see bcontroller.boot) instead of the
+    Ansible reboot module. Has to be called after use_ssh_pool().
+    """
+    global _BOOT_PROBER
+    import atexit
+    from .boot import BootProber
+
+    _BOOT_PROBER = BootProber(ssh_pool=_SSH_POOL)
+    atexit.register(_BOOT_PROBER.close)
+    return _BOOT_PROBER
+
+
+def use_console(group="duts", netconsole_port=None):
+    """
+    Capture consoles of hosts of the `group` which have one (see
+    bcontroller.console). A bisect step whose kernel panics while booting is
+    skipped right away, without waiting for the reboot deadline.
+    """
+    global _CONSOLE
+    import atexit
+    from .console import DEFAULT_NETCONSOLE_PORT, ConsoleMonitor
+    from .inventory import load_inventory
+
+    inventory = load_inventory()
+    consoles = {host: inventory.console(host) for host in inventory.hosts(group) if inventory.console(host)}
+    if not consoles:
+        warning("console: no host of %s has bcontrol_console set", group)
+
+    _CONSOLE = ConsoleMonitor(
+        consoles,
+        DEFAULT_NETCONSOLE_PORT if netconsole_port is None else netconsole_port,
+        inventory=inventory,
+    )
+    _CONSOLE.start()
+    atexit.register(_CONSOLE.close)
+    return _CONSOLE
+
+
+def use_power(concurrency=None, rate=None):
+    """
+    Control power of DUTs through BMCs of their duts-mgmt hosts (see
+    bcontroller.ipmi): DUTs which panicked without a serial console are
+    reset by their BMC.
+    """
+    global _POWER
+    from .ipmi import DEFAULT_CONCURRENCY, DEFAULT_RATE, IPMIPower
+
+    _POWER = IPMIPower(
+        ssh_pool=_SSH_POOL,
+        concurrency=DEFAULT_CONCURRENCY if concurrency is None else concurrency,
+        rate=DEFAULT_RATE if rate is None else rate,
+    )
+    return _POWER
+
+
+def use_build_cache(path=None, max_size=None):
+    """
+    Keep built kernel packages in a persistent cache (see
+    bcontroller.buildcache), build() of a tree built before returns them
+    right away. `max_size` is in bytes.
+    """
+    global _BUILD_CACHE
+    from .buildcache import DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE, BuildCache
+
+    _BUILD_CACHE = BuildCache(
+        DEFAULT_CACHE_DIR if path is None else path,
+        DEFAULT_MAX_SIZE if max_size is None else max_size,
+    )
+    return _BUILD_CACHE
+
+
+def _ensure_ssh_pool():
+    if _SSH_POOL is not None:
+        _SSH_POOL.ensure()
+
+
+def _run_ansible(args, timeout=None, fail_fast=False, on_result=None, interrupt=None):
+    """
+    Run the ansible or ansible-playbook command given by `args` and return
+    the result document (JSON, see AnsibleEvents) with the finished process.
+    Only the tail of the raw event stream is kept in memory.
+    """
+    events = AnsibleEvents(fail_fast=fail_fast, on_result=on_result)
+    try:
+        _, process = run_command(args, output=TailBuffer(), hooks=[events.hook], timeout=timeout, interrupt=interrupt)
+    except BControlCommandError as e:
+        e.output = events.dumps()
+        e.events = events
+        raise
+
+    return events.dumps(), process
+
+
+def ansible(module_name, limit, params="", timeout=None):
+    _ensure_ssh_pool()
+    if _EMBEDDED_RUNNER is not None:
+        return _EMBEDDED_RUNNER.ansible(module_name, limit, params, timeout=timeout)
+
+    try:
+        return _run_ansible(_ansible_args(module_name, limit, params), timeout=timeout, fail_fast=True)
+    except BControlCommandError as e:
+        raise _ansible_error(e, e.events)
+
+
+def _iter_ansible_command(args, timeout=None):
+    events = AnsibleEvents()
+    cmd = iter_command(args, output=TailBuffer(), hooks=[events.hook], timeout=timeout)
+    try:
+        yield from cmd
     except BControlCommandError as e:
-        # Parse ansible JSON output to get error message
-        ans_out = convert_json(e.output)
-        raise BControlError(ans_out["stats"])
+        raise _ansible_error(e, events)
+
+
+def iter_ansible(module_name, limit, params="", timeout=None):
+    """
+    Iterate over output lines of the ansible command. Note that the lines are
+    JSON events (see stdout_callback in ansible.cfg).
+    """
+    return _iter_ansible_command(_ansible_args(module_name, limit, params), timeout=timeout)
 
 
-# TODO: support multiple rpms? (kernel-headers?)
-def kernel_install(from_rpm, reboot):
+# ansible-playbook exit codes when some hosts failed or were unreachable
+_ANSIBLE_RC_HOST_FAILURES = (2, 4)
+
+
+def ansible_playbook(playbook, limit, timeout=None, ignore_failures=False, forks=None, on_result=None, interrupt=None,
+                     **argv):
+    """
+    Run the `playbook` on hosts given by `limit`, `argv` are passed as extra
+    variables. The run is stopped on the first failed host, unless
+    `ignore_failures` is set: then the output is returned even if some hosts
+    failed (timed out tasks are still raised as BControlTimeout).
+
+    `forks` overrides the number of hosts Ansible works on in parallel,
+    `on_result` is passed to AnsibleEvents. An exception thrown into
+    `interrupt` (see bcontroller.stream.Interrupt) stops the run and is
+    raised (not supported by the embedded runner).
+    """
+    _ensure_ssh_pool()
+    if _BOOT_PROBER is not None:
+        # Playbooks wait for the prober instead of the reboot module
+        if argv.get("reboot_method") == REBOOT_KEXEC:
+            boot_timeout = argv.get("kexec_timeout", DEFAULT_KEXEC_TIMEOUT)
+        else:
+            boot_timeout = argv.get("reboot_timeout", DEFAULT_PHASE_DEADLINES["reboot"])
+
+        on_result = _BOOT_PROBER.hook(argv.get("reboot_method", REBOOT_ANSIBLE), boot_timeout, on_result)
+        argv["boot_probe_dir"] = _BOOT_PROBER.dir
+
+    if _EMBEDDED_RUNNER is not None:
+        return _EMBEDDED_RUNNER.ansible_playbook(
+            playbook,
+            limit,
+            timeout=timeout,
+            ignore_failures=ignore_failures,
+            forks=forks,
+            on_result=on_result,
+            **argv
+        )
+
+    try:
+        return _run_ansible(
+            _ansible_playbook_args(playbook, limit, forks=forks, **argv),
+            timeout=timeout,
+            fail_fast=not ignore_failures,
+            on_result=on_result,
+            interrupt=interrupt,
+        )
+    except BControlCommandError as e:
+        if not ignore_failures or e.process.returncode not in _ANSIBLE_RC_HOST_FAILURES or not e.events.stats:
+            raise _ansible_error(e, e.events)
+
+        timeout_error = _ansible_timeout(e.events.document())
+        if timeout_error is not None:
+            raise timeout_error
+
+        return e.output, e.process
+
+
+def iter_ansible_playbook(playbook, limit, timeout=None, **argv):
+    return _iter_ansible_command(_ansible_playbook_args(playbook, limit, **argv), timeout=timeout)
+
+
+def _fanout_kernel(from_rpm, dut_path, timeout, report=None):
+    sha256, transfers = _FANOUT.distribute(from_rpm, timeout=timeout)
+    _AGENT_POOL.link(sha256, dut_path)
+
+    sent = {host: 0 for host in _AGENT_POOL.hosts}
+    for transfer in transfers:
+        if transfer.parent is None:
+            sent[transfer.host] = transfer.size
+
+        if report is not None:
+            report.record_host(
+                transfer.host,
+                copy_parent=transfer.parent,
+                copy_seconds=transfer.seconds,
+                copy_throughput=transfer.size / transfer.seconds if transfer.seconds else None,
+            )
+
+    return sent
+
+
+def _store_kernel(from_rpm, deadlines, report=None):
+    """
+    Make the kernel package available on DUTs through the content store of
+    the DUT agent (see bcontroller.agent), it is transferred only to DUTs which
+    do not have it yet (relayed by DUTs with fan-out).
+    """
+    from .transfer import TransferStats
+
+    dut_path = os.path.join("/root", os.path.basename(from_rpm))
+    size = os.path.getsize(from_rpm)
+    timeout = deadlines.get("copy") or None
+    try:
+        if _FANOUT is not None:
+            sent = _fanout_kernel(from_rpm, dut_path, timeout, report)
+        else:
+            sent = _AGENT_POOL.push(from_rpm, dut_path, timeout=timeout)
+    except BControlTimeout as e:
+        e.phase = "copy"
+        raise
+
+    stats = {}
+    for host, host_sent in sent.items():
+        info("kernel-install: %s: controller sent %d of %d bytes", host, host_sent, size)
+        stats[host] = TransferStats(size=size, sent=host_sent, literal=host_sent, matched=size - host_sent)
+
+    return {"kernel_pkg_pushed": True, "kernel_pkg_dut_path": dut_path}, stats
+
+
+def _push_kernel(from_rpm, deadlines, delta=False, report=None):
+    """
+    Send the kernel package to DUTs through the DUT agent store when the
+    agent is in use, or by delta transfer (see bcontroller.transfer) when
+    `delta` is set. Returns extra variables for the install playbooks and
+    per-host transfer stats. When neither is possible, the stats are None and
+    the playbooks copy the whole package themselves, or download it from the
+    HTTP server of bcontrol if it runs.
+    """
+    from . import transfer
+    from .inventory import load_inventory
+
+    if _AGENT_POOL is not None:
+        return _store_kernel(from_rpm, deadlines, report)
+
+    if not delta:
+        if _HTTP_SERVER is not None:
+            return {"kernel_pkg_url": _HTTP_SERVER.publish(from_rpm)}, None
+
+        return {}, None
+
+    if not transfer.available():
+        warning("kernel-install: rsync is not installed, copying whole kernel package")
+        return {}, None
+
+    try:
+        stats, dut_path = transfer.push(
+            from_rpm,
+            load_inventory().hosts("duts"),
+            ssh_pool=_SSH_POOL,
+            timeout=deadlines.get("copy") or None,
+        )
+    except BControlTimeout as e:
+        e.phase = "copy"
+        raise
+    except BControlCommandError as e:
+        warning("kernel-install: delta transfer failed, copying whole kernel package: %s", e.message.splitlines()[0])
+        return {}, None
+
+    return {"kernel_pkg_pushed": True, "kernel_pkg_dut_path": dut_path}, stats
+
+
+# How DUTs are rebooted into the installed kernel
+REBOOT_ANSIBLE = "ansible"  # full reboot through firmware and boot loader
+REBOOT_KEXEC = "kexec"  # kexec into the kernel, full reboot when it fails
+REBOOT_METHODS = (
+    REBOOT_ANSIBLE,
+    REBOOT_KEXEC,
+)
+# Soft reboot escalated to BMC reset and power cycle, see bcontroller.ipmi
+REBOOT_IPMI = "ipmi"
+
+# Seconds a DUT has to come back from kexec before it is fully rebooted
+DEFAULT_KEXEC_TIMEOUT = 120
+
+# Kernel command line profiles, applied to the boot entry of the tested kernel
+# only (entries of other kernels keep their command line)
+CMDLINE_PROFILE_NONE = "none"
+CMDLINE_PROFILE_QUIET = "quiet"  # no boot messages and splash on the console
+CMDLINE_PROFILE_MINIMAL = "minimal"  # quiet, without services tests do not need
+CMDLINE_PROFILES = (
+    CMDLINE_PROFILE_NONE,
+    CMDLINE_PROFILE_QUIET,
+    CMDLINE_PROFILE_MINIMAL,
+)
+
+_CMDLINE_QUIET_ARGS = [
+    "quiet",
+    "loglevel=3",
+    "systemd.show_status=false",
+    "rd.plymouth=0",
+    "plymouth.enable=0",
+]
+_CMDLINE_PROFILE_ARGS = {
+    CMDLINE_PROFILE_NONE: [],
+    CMDLINE_PROFILE_QUIET: _CMDLINE_QUIET_ARGS,
+    CMDLINE_PROFILE_MINIMAL: _CMDLINE_QUIET_ARGS + [
+        "systemd.unit=multi-user.target",
+        "systemd.mask=kdump.service",
+        "systemd.mask=NetworkManager-wait-online.service",
+        "systemd.mask=dnf-makecache.timer",
+        "systemd.mask=mlocate-updatedb.timer",
+    ],
+}
+
+
+def cmdline_args(profile, extra=()):
+    """
+    Return kernel command line arguments of the `profile` (see
+    CMDLINE_PROFILES) followed by the `extra` ones.
+    """
+    args = _CMDLINE_PROFILE_ARGS[profile] + list(extra)
+    for arg in args:
+        # Playbooks get them comma separated
+        if "," in arg:
+            raise BControlError("cmdline: argument %s must not contain comma" % arg)
+
+    return args
+
+
+def _cmdline_label(profile, extra=()):
+    """
+    Return how reboots with the command line are recorded (see
+    _RebootTimes).
+    """
+    return " ".join([profile] + list(extra))
+
+
+# Duration of the last reboot of every DUT by every method and cmdline profile,
+# the full reboot without profile is the baseline the others are compared to
+_REBOOT_TIMES_PATH = os.path.join(tempfile.gettempdir(), "bcontrol-reboot-times.json")
+
+
+class _RebootTimes:
+    """
+    Collect durations of the reboot tasks as they arrive (a result hook for
+    ansible_playbook()), both of the Ansible reboot module and of the boot
+    prober (see bcontroller.boot), into the kernel booting with the `cmdline`
+    profile (see _cmdline_label()). Every reboot is logged (and added to the
+    `report`) with the time it saved against the full reboot without profile
+    and, with a profile, against the same method without it.
+    """
+
+    _FULL_TASK = "Reboot system into newly installed kernel"
+    _KEXEC_TASK = "Reboot system into newly installed kernel by kexec"
+    # Reboot watched by bcontrol.boot
+    _PROBE_TASK = "Wait for DUT to boot"
+
+    def __init__(self, report=None, path=_REBOOT_TIMES_PATH, cmdline=CMDLINE_PROFILE_NONE):
+        self.report = report
+        self.path = path
+        self.cmdline = cmdline
+        # host -> reboot method -> cmdline profile -> seconds
+        self.times = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                times = json.load(f)
+        except (OSError, ValueError):
+            times = {}
+
+        for host, host_times in times.items():
+            # Older bcontrol kept only full reboots without profile
+            if not isinstance(host_times, dict):
+                host_times = {REBOOT_ANSIBLE: {CMDLINE_PROFILE_NONE: host_times}}
+
+            self.times[host] = host_times
+
+    def _save(self):
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.times, f)
+        except OSError as e:
+            warning("reboot: cannot save reboot times: %s", e)
+
+    def add(self, task_name, host, result):
+        if task_name == self._PROBE_TASK:
+            self._probed(host, result)
+            return
+
+        if task_name not in (self._FULL_TASK, self._KEXEC_TASK) or "elapsed" not in result:
+            return
+
+        # A timed out reboot sets rebooted too, only a successful one changed
+        if result.get("changed"):
+            self._rebooted(host, REBOOT_ANSIBLE if task_name == self._FULL_TASK else REBOOT_KEXEC, result["elapsed"])
+        elif task_name == self._KEXEC_TASK:
+            warning("reboot: %s: kexec failed, rebooting fully: %s", host, result.get("msg", ""))
+
+    def _probed(self, host, result):
+        from .boot import parse_status
+
+        status = result.get("ansible_facts", {}).get("out_boot_probe", "")
+        parsed = parse_status(status)
+        if parsed is None:
+            if status:
+                warning("reboot: %s: %s", host, status)
+            return
+
+        method, times = parsed
+        self._rebooted(host, method, times.ready, boot_down=times.down, boot_banner=times.banner)
+
+    def _rebooted(self, host, method, elapsed, **values):
+        host_times = self.times.setdefault(host, {})
+        full = host_times.get(REBOOT_ANSIBLE, {}).get(CMDLINE_PROFILE_NONE)
+        plain = host_times.get(method, {}).get(CMDLINE_PROFILE_NONE)
+        host_times.setdefault(method, {})[self.cmdline] = elapsed
+        self._save()
+
+        message = "reboot: %s: %s in %.1f s" % (host, "full reboot" if method == REBOOT_ANSIBLE else method, elapsed)
+        if self.cmdline != CMDLINE_PROFILE_NONE:
+            values["cmdline_profile"] = self.cmdline
+            message += " with cmdline %s" % self.cmdline
+            if plain is not None:
+                values["cmdline_saved"] = plain - elapsed
+                message += ", %.1f s saved against no profile" % values["cmdline_saved"]
+            else:
+                message += " (not measured without profile yet)"
+
+        if method != REBOOT_ANSIBLE or self.cmdline != CMDLINE_PROFILE_NONE:
+            if full is not None:
+                values["reboot_saved"] = full - elapsed
+                message += ", %.1f s saved against full reboot" % values["reboot_saved"]
+            else:
+                message += " (no full reboot measured yet)"
+
+        info("%s", message)
+        if self.report is not None:
+            self.report.record_host(host, reboot_method=method, reboot_seconds=elapsed, **values)
+
+
+def _reboot_vars(reboot_use, kexec_timeout, gc, keep_releases, cmdline=()):
+    return {
+        "reboot_method": reboot_use,
+        "kexec_timeout": kexec_timeout,
+        "gc_kernels": gc,
+        "keep_releases": ",".join(keep_releases),
+        "cmdline_args": ",".join(cmdline),
+    }
+
+
+# How the kernel RPM packages are installed on DUTs
+INSTALLER_YUM = "yum"
+INSTALLER_RPM = "rpm"  # one rpm transaction, no repositories (library/bcontrol_rpm.py)
+INSTALLERS = (
+    INSTALLER_YUM,
+    INSTALLER_RPM,
+)
+
+
+def kernel_install(from_rpm, reboot, deadlines=None, delta=False, extra_rpms=(), installer=INSTALLER_YUM,
+                   reboot_use=REBOOT_ANSIBLE, kexec_timeout=DEFAULT_KEXEC_TIMEOUT, gc=False, keep_releases=(),
+                   cmdline_profile=CMDLINE_PROFILE_NONE, extra_cmdline=()):
     """
     Install given kernel to the target system(s) and try to boot into it. This
     command *does not* check if system(s) successfully booted into the given
     kernel.
+
+    `deadlines` maps the copy, install and reboot phases to their timeouts in
+    seconds. BControlTimeout with the phase which expired is raised when any
+    of them is exceeded.
+
+    With `delta`, only the difference against the previous kernel package
+    cached on DUTs is sent. When the DUT agent is in use, the package is sent
+    only to DUTs which do not have it in their content store yet.
+
+    A kernel tarball (see build()) is unpacked on DUTs and gets its own boot
+    entry instead of being installed by yum.
+
+    Packages in `extra_rpms` (e.g. kernel-headers) are copied to DUTs and
+    installed together with the kernel. With the rpm `installer`, all of them
+    are installed in one rpm transaction without loading any repository
+    metadata.
+
+    With the kexec `reboot_use`, DUTs boot the kernel by kexec (skipping
+    firmware and boot loader) and are fully rebooted only when they do not
+    come back in `kexec_timeout` seconds. With `gc`, kernels installed by
+    bcontrol earlier are removed first, except the default one and releases
+    in `keep_releases`.
+
+    The boot entry of the kernel gets the command line of `cmdline_profile`
+    (see CMDLINE_PROFILES) and `extra_cmdline` arguments.
     """
+    cmdline = cmdline_args(cmdline_profile, extra_cmdline)
     rpm_filename = os.path.basename(from_rpm)
+    deadlines = deadlines or {}
+
+    pushed, _ = _push_kernel(from_rpm, deadlines, delta)
+
+    pkg_format = artifact_format(from_rpm)
+    if pkg_format == ARTIFACT_TARBALL:
+        pushed["kernel_release"] = _tarball_release(from_rpm)
 
     if not reboot:
         warning("kernel-install: not rebooting the kernel, option -R/--no-reboot is active.")
 
+    # Task timeouts are enforced by Ansible itself, the whole playbook is
+    # guarded just in case Ansible gets stuck (e.g. on SSH connection)
+    timeout = None
+    if deadlines:
+        timeout = sum(deadlines.get(phase, 0) for phase in ("copy", "install", "reboot")) + _PLAYBOOK_DEADLINE_SLACK
+
     debug("kernel-install: installing new kernel using ansible")
     return ansible_playbook(
         os.path.join(_CUR_DIR, "../playbooks/install-kernel.yml"),
         "duts",
+        timeout=timeout,
         kernel_pkg_path=from_rpm,
         kernel_pkg=rpm_filename,
+        kernel_pkg_format=pkg_format,
+        extra_pkg_paths=",".join(os.path.abspath(path) for path in extra_rpms),
+        installer=installer,
         reboot=reboot,
+        copy_timeout=deadlines.get("copy", 0),
+        install_timeout=deadlines.get("install", 0),
+        reboot_timeout=deadlines.get("reboot", DEFAULT_PHASE_DEADLINES["reboot"]),
+        on_result=_RebootTimes(cmdline=_cmdline_label(cmdline_profile, extra_cmdline)).add,
+        **_reboot_vars(reboot_use, kexec_timeout, gc, keep_releases, cmdline),
+        **pushed
     )
 
 
-# TODO: what about kernel config? we should stop if there is no config...or run
-# make olddefconfig?
-def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig):
-    info("Current rpmbuild topdir: %s", rpmbuild_topdir)
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_bad(rc):
+    """
+    Return True if the test script exit code `rc` marks the tested kernel
+    bad the way git bisect run sees it: 125 is skip, 126 and 127 are errors
+    of the script itself and 128 and above are crashes of it.
+    """
+    return rc is not None and (1 <= rc < 125 or 126 < rc < 128)
+
+
+def _finished(result):
+    """
+    Return True if the test script finished on the tested kernel of a DUT
+    with per-host `result` of bisect_step().
+    """
+    return (
+        not result["failed"]
+        and not result["panic"]
+        and result["timed_out"] is None
+        and result["verified"]
+        and result["rc"] is not None
+    )
+
+
+# How the Ansible play of a bisect step is executed
+STRATEGY_LINEAR = "linear"  # every task finishes on all DUTs before the next one
+STRATEGY_FREE = "free"  # every DUT goes through the step on its own pace
+STRATEGIES = (
+    STRATEGY_LINEAR,
+    STRATEGY_FREE,
+)
+
+# When the bisect step is decided
+VERDICT_ALL = "all"  # when all DUTs finished
+VERDICT_FIRST = "first"  # by the first DUT which finished
+VERDICT_ANY_BAD = "any-bad"  # by the first DUT which reproduced the bug
+VERDICT_POLICIES = (
+    VERDICT_ALL,
+    VERDICT_FIRST,
+    VERDICT_ANY_BAD,
+)
+
+# Upper bound of Ansible forks sized from the inventory
+_MAX_FORKS = 64
+
+
+def _forks(group):
+    """
+    Return number of Ansible forks which lets all hosts of the `group` run in
+    parallel.
+    """
+    from .inventory import load_inventory
+    return min(max(len(load_inventory().hosts(group)), 1), _MAX_FORKS)
+
+
+# Tasks of bisect-step.yml between which a kernel panic on the console means
+# the kernel did not boot
+_PANIC_WATCH_TASK = "Enforce system reboot on panic after N seconds"
+_PANIC_UNWATCH_TASK = "Read boot ID"
+
+# Lines of the console log shown with the panic
+_PANIC_LOG_LINES = 30
+
+
+class _StepDecided(Exception):
+    """
+    Raised from the result hook of the bisect step when its verdict is
+    decided, stops the Ansible run.
+    """
+    pass
+
+
+class _StepResults:
+    """
+    Per-host results of the bisect-step.yml playbook collected as they
+    arrive. `results` contains finished hosts in the order they finished.
+    """
+
+    _STEP_RESULT_TASK = "Bisect step result"
+    # Exit code of the test script is the verdict, not an error
+    _SCRIPT_TASK = "Run local script on DUTs"
+
+    def __init__(self, hosts, verdict=VERDICT_ALL, report=None, test_deadline=None):
+        self.hosts = list(hosts)
+        self.verdict = verdict
+        self.report = report
+        self.test_deadline = test_deadline
+        self.results = collections.OrderedDict()
+        self._pending = {}
+        self._start = time.monotonic()
+        # Panics are reported from the console thread
+        self._lock = threading.Lock()
+
+    def _host_result(self, host):
+        return self._pending.setdefault(host, {
+            # Running kernel release
+            "kernel": None,
+            # Running kernel is the built one
+            "verified": False,
+            # Exit code and output of the test script
+            "rc": None,
+            "stdout": "",
+            "stderr": "",
+            # Name of the task which failed and its message
+            "failed": None,
+            "msg": "",
+            # Seconds after which the test script was killed
+            "timed_out": None,
+            # Console line of the panic while booting and the console log
+            "panic": None,
+            "console": "",
+        })
+
+    def add(self, task_name, host, result):
+        """
+        Result hook for ansible_playbook().
+        """
+        with self._lock:
+            self._add(task_name, host, result)
+
+    def _add(self, task_name, host, result):
+        if host in self.results:
+            return
+
+        host_result = self._host_result(host)
+        # The DUT is gone during the test, e.g. the tested kernel crashed
+        if task_name == self._SCRIPT_TASK and not result.get("unreachable"):
+            # A failed script without exit code did not finish
+            if result.get("failed") and _int_or_none(result.get("rc")) is None:
+                if _TIMEOUT_MSG_PATTERN.search(str(result.get("msg", ""))):
+                    host_result["timed_out"] = self.test_deadline or time.monotonic() - self._start
+                else:
+                    host_result["failed"] = task_name
+
+                host_result["msg"] = result.get("msg", "")
+                self._finish(host)
+
+            return
+
+        if result.get("failed") or result.get("unreachable"):
+            host_result["failed"] = task_name
+            host_result["msg"] = result.get("msg", "")
+            self._finish(host)
+            return
+
+        step = result.get("ansible_facts", {}).get("bcontrol_step")
+        if task_name == self._STEP_RESULT_TASK and step is not None:
+            host_result.update(
+                kernel=step["kernel"],
+                verified=step["verified"] in (True, "True", "true"),
+                rc=_int_or_none(step["rc"]),
+                stdout=step["stdout"],
+                stderr=step["stderr"],
+            )
+            self._finish(host)
+
+    def panicked(self, panic):
+        """
+        Panic watcher (see bcontroller.console.ConsoleMonitor.watch()), the
+        DUT finished the step with a kernel which did not boot.
+        """
+        with self._lock:
+            if panic.host in self.results:
+                return
+
+            self._host_result(panic.host).update(panic=panic.line, console=panic.log)
+            if self.report is not None:
+                self.report.record_host(panic.host, panic=panic.line, console_log=panic.log_path)
+
+            self._finish(panic.host)
+
+    def _finish(self, host):
+        result = self.results[host] = self._pending.pop(host)
+        elapsed = time.monotonic() - self._start
+        info("bisect-step: %s finished in %.1f s (kernel %s, rc %s)", host, elapsed, result["kernel"], result["rc"])
+        if self.report is not None:
+            self.report.record_host(
+                host,
+                finished=elapsed,
+                kernel=result["kernel"],
+                verified=result["verified"],
+                rc=result["rc"],
+                failed=result["failed"],
+                timed_out=result["timed_out"],
+            )
+
+        if self.decided():
+            raise _StepDecided
+
+    def decided(self):
+        """
+        Return True if the verdict policy can decide the step from the
+        results collected so far.
+        """
+        if all(host in self.results for host in self.hosts):
+            return True
+
+        finished = [result for result in self.results.values() if _finished(result)]
+        if self.verdict == VERDICT_FIRST:
+            return bool(finished)
+
+        if self.verdict == VERDICT_ANY_BAD:
+            return any(_is_bad(result["rc"]) for result in finished)
+
+        return False
+
+
+def bisect_step(kernel_pkg_path, kernel_release, filename, reboot=True, deadlines=None,
+                strategy=STRATEGY_LINEAR, verdict=VERDICT_ALL, report=None, delta=False,
+                extra_pkg_paths=(), installer=INSTALLER_YUM, staged=False,
+                reboot_use=REBOOT_ANSIBLE, kexec_timeout=DEFAULT_KEXEC_TIMEOUT, gc=True, keep_releases=(),
+                cmdline_profile=CMDLINE_PROFILE_NONE, extra_cmdline=()):
+    """
+    Install the kernel package, reboot into it, verify the running kernel
+    against `kernel_release` and run the test script given by `filename` on
+    all DUTs in one Ansible play. With the free `strategy`, every DUT goes
+    through the step independently.
+
+    The run is stopped as soon as the `verdict` policy decides the step (see
+    _StepResults.decided()). Returns per-host results of the DUTs which
+    finished, in the order they finished.
+
+    See kernel_install() for `delta`, `extra_pkg_paths` (its `extra_rpms`)
+    and `installer` and for `reboot_use`, `kexec_timeout`, `gc`,
+    `keep_releases`, `cmdline_profile` and `extra_cmdline`. A `staged` kernel was already installed on DUTs (see
+    bcontroller.prestage), the step only boots into it.
+    """
+    deadlines = deadlines or {}
+    cmdline = cmdline_args(cmdline_profile, extra_cmdline)
+
+    if staged:
+        pushed, transfer_stats = {"kernel_pkg_pushed": True, "kernel_staged": True}, None
+    else:
+        pushed, transfer_stats = _push_kernel(kernel_pkg_path, deadlines, delta, report)
+    for host, host_stats in (transfer_stats or {}).items():
+        if report is not None:
+            report.record_host(host, copy_size=host_stats.size, copy_sent=host_stats.sent)
+
+    timeout = None
+    if deadlines:
+        timeout = sum(deadlines.get(phase, 0) for phase in ("copy", "install", "reboot", "test")) + _PLAYBOOK_DEADLINE_SLACK
+
+    from .inventory import load_inventory
+    step = _StepResults(load_inventory().hosts("duts"), verdict=verdict, report=report, test_deadline=deadlines.get("test"))
+    reboot_times = _RebootTimes(report, cmdline=_cmdline_label(cmdline_profile, extra_cmdline))
+    interrupt = Interrupt()
+
+    def power_reset(host):
+        from .ipmi import POWER_RESET
+
+        try:
+            _POWER.power(POWER_RESET, [host])
+        except BControlError as e:
+            warning("%s", e.message)
+
+    def on_panic(panic):
+        if not _CONSOLE.recover(panic.host) and _POWER is not None:
+            # Not in the console thread, which has to go on reading consoles
+            threading.Thread(target=power_reset, args=(panic.host,), daemon=True).start()
+
+        try:
+            step.panicked(panic)
+        except _StepDecided as e:
+            interrupt.throw(e)
+
+    def on_result(task_name, host, result):
+        reboot_times.add(task_name, host, result)
+        if _CONSOLE is not None:
+            # Panics only from the reboot until the DUT is up, then they are
+            # the outcome of the test
+            if task_name == _PANIC_WATCH_TASK and not result.get("failed"):
+                _CONSOLE.watch(host, on_panic)
+            elif task_name == _PANIC_UNWATCH_TASK:
+                _CONSOLE.unwatch(host)
+
+        step.add(task_name, host, result)
+
+    try:
+        ansible_playbook(
+            os.path.join(_CUR_DIR, "../playbooks/bisect-step.yml"),
+            "duts",
+            timeout=timeout,
+            ignore_failures=True,
+            forks=_forks("duts"),
+            on_result=on_result,
+            interrupt=interrupt,
+            kernel_pkg_path=kernel_pkg_path,
+            kernel_pkg=os.path.basename(kernel_pkg_path),
+            kernel_pkg_format=artifact_format(kernel_pkg_path),
+            extra_pkg_paths=",".join(os.path.abspath(path) for path in extra_pkg_paths),
+            installer=installer,
+            kernel_release=kernel_release,
+            filename=os.path.abspath(filename),
+            reboot=reboot,
+            bcontrol_strategy=strategy,
+            copy_timeout=deadlines.get("copy", 0),
+            install_timeout=deadlines.get("install", 0),
+            reboot_timeout=deadlines.get("reboot", DEFAULT_PHASE_DEADLINES["reboot"]),
+            script_timeout=deadlines.get("test", 0),
+            **_reboot_vars(reboot_use, kexec_timeout, gc, keep_releases, cmdline),
+            **pushed
+        )
+    except _StepDecided:
+        unfinished = [host for host in step.hosts if host not in step.results]
+        if unfinished:
+            info("bisect-step: decided (%s policy), not waiting for: %s", verdict, ", ".join(unfinished))
+    finally:
+        if _CONSOLE is not None:
+            for host in step.hosts:
+                _CONSOLE.unwatch(host)
+
+        interrupt.close()
+
+    debug("bisect-step: results: %s", step.results)
+    return step.results
+
+
+def step_verdict(results, verdict=VERDICT_ALL, hosts=()):
+    """
+    Return exit code of the test script which decides the bisect step given
+    by per-host `results` of bisect_step(). Raise BControlBisectAbort if a
+    DUT failed, BControlBisectSkip if it did not boot the tested kernel (or
+    it panicked while booting) or the test script did not exit and
+    BControlTimeout of the test phase if the script timed out. With the
+    all `verdict`, a DUT of `hosts` without result skips the step.
+    """
+    missing = [host for host in hosts if host not in results]
+    if verdict == VERDICT_ALL and missing:
+        warning("bisect: no result of %s", ", ".join(missing))
+        raise BControlBisectSkip
+
+    results = list(results.items())
+    finished = [(host, result) for host, result in results if _finished(result)]
+    if verdict == VERDICT_FIRST:
+        # DUTs which did not finish the test do not decide, unless all did not
+        results = finished[:1] or results
+    elif verdict == VERDICT_ANY_BAD:
+        bad = [result["rc"] for _, result in finished if _is_bad(result["rc"])]
+        if bad:
+            return bad[0]
+
+    for host, result in results:
+        if result["panic"]:
+            warning(
+                "bisect: %s: kernel panicked while booting: %s\n%s",
+                host,
+                result["panic"],
+                "".join(result["console"].splitlines(True)[-_PANIC_LOG_LINES:]),
+            )
+            raise BControlBisectSkip
+
+        if result["failed"]:
+            error("bisect: %s: task [%s] failed: %s", host, result["failed"], result["msg"])
+            raise BControlBisectAbort
+
+        if result["timed_out"] is not None:
+            raise BControlTimeout("Test script on %s" % host, result["timed_out"], phase="test")
+
+        if not result["verified"]:
+            # Kernel did not boot correctly - panic?
+            warning("bisect: %s: running kernel %s is not the tested one", host, result["kernel"])
+            raise BControlBisectSkip
+
+        if result["rc"] is None:
+            warning("bisect: %s: test script did not exit: %s", host, result["msg"] or "no exit code")
+            raise BControlBisectSkip
+
+    return next((result["rc"] for _, result in results if result["rc"]), 0)
+
+
+def _step_verdict_of(verdict=VERDICT_ALL, **kwargs):
+    """
+    Run bisect_step() and return its step_verdict(), so a timed out test
+    script is handled by PhaseWatchdog like any other phase.
+    """
+    from .inventory import load_inventory
+
+    results = bisect_step(verdict=verdict, **kwargs)
+    return step_verdict(results, verdict, hosts=load_inventory().hosts("duts"))
+
+
+def _kernel_release_args(git_tree, make_opts=None):
+    args = [
+        "make",
+        "-s",
+        "--no-print-directory",
+        "-C",
+        git_tree,
+        "kernelrelease",
+    ]
+
+    if make_opts:
+        args.extend(make_opts.split(" "))
+
+    return args
+
 
+def kernel_release(git_tree, make_opts=None):
+    """
+    Return release of the kernel built in `git_tree` (with `make_opts`), i.e.
+    what `uname -r` prints when the kernel is running.
+    """
+    out, _ = run_command(_kernel_release_args(git_tree, make_opts))
+    return out.strip()
+
+
+def manifest_release(git_tree, make_opts, manifest):
+    """
+    Return release of the kernel of `manifest` built by build() in
+    `git_tree` (with `make_opts`). A kernel from the build cache has the
+    release it was built with, which may not be the one of the checked out
+    commit (see bcontroller.buildcache).
+    """
+    if _BUILD_CACHE is not None and manifest.kernel is not None:
+        release = _BUILD_CACHE.release(manifest.kernel)
+        if release:
+            return release
+
+    return kernel_release(git_tree, make_opts)
+
+
+def _build_env(cc):
     # Change OS environment only for the following command, not for whole
     # process
     modified_env = os.environ.copy()
     if cc:
         modified_env["CC"] = cc
 
-    if oldconfig:
-        config_cmd = [
-            "make",
-            "-C",
-            git_tree,
+    return modified_env
 
-            # Makefile target
-            "oldconfig",  # or use olddefconfig?
-        ]
-        run_command(config_cmd, env=modified_env)
 
+def _oldconfig_args(git_tree):
+    return [
+        "make",
+        "-C",
+        git_tree,
+
+        # Makefile target
+        "oldconfig",  # or use olddefconfig?
+    ]
+
+
+# Formats of the built kernel
+ARTIFACT_RPM = "rpm"  # binary RPM packages installed by yum
+ARTIFACT_TARBALL = "tarball"  # vmlinuz, System.map and modules unpacked on DUTs
+ARTIFACT_FORMATS = (
+    ARTIFACT_RPM,
+    ARTIFACT_TARBALL,
+)
+
+# Makefile target of the kernel tree producing the tarball
+_TARBALL_TARGET = "tarzst-pkg"
+_TARBALL_SUFFIX = ".tar.zst"
+
+
+def _build_args(git_tree, make_opts, jobs, rpmbuild_topdir, artifact=ARTIFACT_RPM):
     build_cmd = [
         "make",
         "-C",
         git_tree,
         "-j",
         str(jobs),
+    ]
 
-        # Makefile target
-        "binrpm-pkg",
+    if artifact == ARTIFACT_TARBALL:
+        build_cmd.append(_TARBALL_TARGET)
+    else:
+        build_cmd += [
+            # Makefile target
+            "binrpm-pkg",
 
-        # Build packages in well-known directory
-        f'RPMOPTS=--define \"_topdir {rpmbuild_topdir}\"',
-    ]
+            # Build packages in well-known directory
+            f'RPMOPTS=--define \"_topdir {rpmbuild_topdir}\"',
+        ]
 
     if make_opts:
         build_cmd.extend(make_opts.split(" "))
 
-    return run_command(build_cmd, env=modified_env)
+    return build_cmd
 
 
-def reboot(use):
-    # TODO: add support various methods of reboot
+# Packages produced by the kernel build, path to each package or None
+BuildManifest = collections.namedtuple("BuildManifest", [
+    "kernel",
+    "headers",
+    "devel",
+    "debuginfo",
+])
 
-    if use == "ipmi":
-        mgmt_host = ""  # TODO
-        mgmt_user = "USERID"
-        mgmt_password = "PASSW0RD"
-        return ansible(
-            "ipmi_power",
-            "duts-mgmt",
-            state="reset",
-            name=mgmt_host,
-            user=mgmt_user,
-            password=mgmt_password,
-        )
-    else:
-        return ansible(
-            "reboot",
-            "duts",
-            reboot_timeout=0,
-        )
+# Wrote: /tmp/bisect-my/RPMS/i386/kernel-5.1.0_rc3+-5.i386.rpm
+_RPM_WROTE_PATTERN = r"^Wrote:\s+(?P<pkg_path>.*(?<!\.src)\.rpm)$"
+_RPM_NAME_PATTERN = re.compile(r"^kernel(?:-(?P<subpackage>headers|devel|debuginfo))?-\d")
+
+# Output lines which mean the build is going to fail
+BUILD_ERROR_PATTERNS = [
+    # gcc/clang: drivers/foo.c:12:5: error: ...
+    r"^\S+:\d+(?::\d+)?: (?:fatal )?error: ",
+    # make: *** [Makefile:1234: vmlinux] Error 2
+    r"^make(?:\[\d+\])?: \*\*\* .*Error \d+",
+]
+
+
+def _build_hooks(packages, abort_on_error=True):
+    """
+    Return line hooks which collect built packages into `packages` dict and
+    optionally stop the build on the first error.
+    """
+    def _wrote(m, line):
+        pkg_path = m.group("pkg_path")
+        m_name = _RPM_NAME_PATTERN.match(os.path.basename(pkg_path))
+        if not m_name:
+            debug("build: ignoring unknown package: %s", pkg_path)
+            return
+
+        packages[m_name.group("subpackage") or "kernel"] = pkg_path
+        info("build: package written: %s", pkg_path)
+
+    def _error(m, line):
+        raise BControlBuildError(line)
+
+    hooks = [
+        LineMatcher(_RPM_WROTE_PATTERN, _wrote, stream=STDOUT),
+    ]
+    if abort_on_error:
+        hooks += [
+            LineMatcher(pattern, _error) for pattern in BUILD_ERROR_PATTERNS
+        ]
+
+    return hooks
+
+
+def _build_manifest(packages):
+    return BuildManifest(**{
+        field: packages.get(field) for field in BuildManifest._fields
+    })
+
+
+def _collect_tarball(git_tree, release, rpmbuild_topdir, packages):
+    """
+    Move the kernel tarball built in `git_tree` next to the RPM packages into
+    `rpmbuild_topdir` and record it in `packages` as the kernel.
+    """
+    pattern = os.path.join(glob.escape(git_tree), "linux-%s-*%s" % (glob.escape(release), _TARBALL_SUFFIX))
+    tarballs = sorted(glob.glob(pattern), key=os.path.getmtime)
+    if not tarballs:
+        warning("build: kernel tarball not found: %s", pattern)
+        return
+
+    tarball_dir = os.path.join(rpmbuild_topdir, "TARBALLS")
+    os.makedirs(tarball_dir, exist_ok=True)
+    pkg_path = os.path.join(tarball_dir, os.path.basename(tarballs[-1]))
+    shutil.move(tarballs[-1], pkg_path)
+
+    packages["kernel"] = pkg_path
+    info("build: tarball written: %s", pkg_path)
+
+
+def artifact_format(pkg_path):
+    """
+    Return format of the built kernel `pkg_path`.
+    """
+    if pkg_path.endswith(_TARBALL_SUFFIX):
+        return ARTIFACT_TARBALL
+
+    return ARTIFACT_RPM
+
+
+def _tarball_release(pkg_path):
+    # linux-5.14.0-rc3+-x86.tar.zst
+    name = os.path.basename(pkg_path)[len("linux-"):-len(_TARBALL_SUFFIX)]
+    return name.rsplit("-", 1)[0]
+
+
+# TODO: what about kernel config? we should stop if there is no config...or run
+# make olddefconfig?
+def iter_build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig, log_file=None, hooks=(), timeout=None,
+               artifact=ARTIFACT_RPM):
+    """
+    Regenerate kernel configuration (if `oldconfig` is set) and return an
+    iterable over output lines of the kernel build.
+    """
+    info("Current rpmbuild topdir: %s", rpmbuild_topdir)
+    modified_env = _build_env(cc)
+
+    if oldconfig:
+        run_command(_oldconfig_args(git_tree), env=modified_env, log_file=log_file)
+
+    # Build output can be tens of MB, keep only its tail
+    return iter_command(
+        _build_args(git_tree, make_opts, jobs, rpmbuild_topdir, artifact),
+        env=modified_env,
+        output=TailBuffer(),
+        log_file=log_file,
+        hooks=hooks,
+        timeout=timeout,
+    )
+
+
+def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig, log_file=None, timeout=None,
+          artifact=ARTIFACT_RPM):
+    """
+    Build kernel RPM packages. Returns BuildManifest of the produced packages
+    and the finished make process.
+
+    With the tarball `artifact`, the kernel is built as a zstd tarball of
+    vmlinuz, System.map and modules instead (make tarzst-pkg), which DUTs
+    unpack without RPM and yum. It is the kernel of the BuildManifest.
+
+    The build is stopped with BControlBuildError as soon as an error appears
+    in its output, without waiting for the whole make tree to unwind, or with
+    BControlTimeout if it does not finish in `timeout` seconds.
+
+    With the build cache in use (see use_build_cache()), packages of a tree
+    built before are returned from the cache without running make, with
+    CompletedRun in place of the process. Built packages are moved into the
+    cache.
+    """
+    cache_key = None
+    if _BUILD_CACHE is not None:
+        # Before oldconfig touches .config
+        cache_key = _BUILD_CACHE.key(git_tree, make_opts, cc, artifact)
+        manifest = _BUILD_CACHE.get(cache_key) if cache_key else None
+        if manifest is not None:
+            info("build: cache hit %s: %s", cache_key, manifest.kernel)
+            return manifest, CompletedRun(_build_args(git_tree, make_opts, jobs, rpmbuild_topdir, artifact), 0)
+
+    packages = {}
+    cmd = iter_build(
+        git_tree,
+        make_opts,
+        jobs,
+        cc,
+        rpmbuild_topdir,
+        oldconfig,
+        log_file=log_file,
+        hooks=_build_hooks(packages),
+        timeout=timeout,
+        artifact=artifact,
+    )
+    for _ in cmd:
+        pass
+
+    if artifact == ARTIFACT_TARBALL:
+        _collect_tarball(git_tree, kernel_release(git_tree), rpmbuild_topdir, packages)
+
+    manifest = _build_manifest(packages)
+    if cache_key and manifest.kernel is not None:
+        manifest = _BUILD_CACHE.put(cache_key, manifest, kernel_release(git_tree, make_opts))
+
+    return manifest, cmd.process
+
+
+def reboot(use, kexec_timeout=DEFAULT_KEXEC_TIMEOUT, ready_timeout=None):
+    """
+    Reboot all DUTs into their default kernel the `use` way (one of
+    REBOOT_METHODS or REBOOT_IPMI) and wait until they are back.
+    """
+    if use == REBOOT_IPMI:
+        from .ipmi import DEFAULT_READY_TIMEOUT
+
+        power = _POWER or use_power()
+        return power.reboot(timeout=DEFAULT_READY_TIMEOUT if ready_timeout is None else ready_timeout)
+
+    if use not in REBOOT_METHODS:
+        warning("reboot: %s is not supported, rebooting over SSH", use)
+        use = REBOOT_ANSIBLE
+
+    return ansible_playbook(
+        os.path.join(_CUR_DIR, "../playbooks/reboot.yml"),
+        "duts",
+        on_result=_RebootTimes().add,
+        reboot_method=use,
+        kexec_timeout=kexec_timeout,
+    )
+
+
+def power(operation):
+    """
+    Run power `operation` (see bcontroller.ipmi.POWER_OPERATIONS) on BMCs
+    of all DUTs concurrently.
+    """
+    return (_POWER or use_power()).power(operation)
 
 
 def ping():
@@ -232,6 +1773,9 @@ def ping():
 
 
 def sh(command, args):
+    if _AGENT_POOL is not None:
+        return _AGENT_POOL.run(shlex.split("%s %s" % (command, " ".join(args))))
+
     return ansible(
         "command",
         "duts",
@@ -239,12 +1783,20 @@ def sh(command, args):
     )
 
 
-def run(filename):
+def run(filename, timeout=None):
     abs_path_filename = os.path.abspath(filename)
+
+    if _AGENT_POOL is not None:
+        remote_filename = os.path.join("/root", os.path.basename(filename))
+        _AGENT_POOL.push(abs_path_filename, remote_filename, mode=0o755)
+        return _AGENT_POOL.run([remote_filename], cwd="/root", timeout=timeout)
+
     return ansible_playbook(
         os.path.join(_CUR_DIR, "../playbooks/run.yml"),
         "duts",
+        timeout=None if timeout is None else timeout + _PLAYBOOK_DEADLINE_SLACK,
         filename=abs_path_filename,
+        script_timeout=timeout or 0,
     )
 
 
@@ -311,46 +1863,257 @@ def bisect_reset(git_tree):
     )
 
 
-def bisect_from_git(git_tree, filename, rpmbuild_topdir):
+PHASES = (
+    "build",
+    "copy",
+    "install",
+    "reboot",
+    "test",
+)
+
+# What to do with a bisect step when its phase exceeds the deadline
+ON_TIMEOUT_SKIP = "skip"
+ON_TIMEOUT_ABORT = "abort"
+ON_TIMEOUT_RETRY = "retry"
+ON_TIMEOUT_ACTIONS = (
+    ON_TIMEOUT_SKIP,
+    ON_TIMEOUT_ABORT,
+    ON_TIMEOUT_RETRY,
+)
+
+# Seconds
+DEFAULT_PHASE_DEADLINES = {
+    "build": 4 * 3600,
+    "copy": 600,
+    "install": 900,
+    "reboot": 600,
+    "test": 3600,
+}
+
+DEFAULT_PHASE_ON_TIMEOUT = {
+    # Tree which cannot be built in time is not testable
+    "build": ON_TIMEOUT_SKIP,
+    # Network hiccup, try again
+    "copy": ON_TIMEOUT_RETRY,
+    # Something is wrong with DUT
+    "install": ON_TIMEOUT_ABORT,
+    # Kernel probably does not boot
+    "reboot": ON_TIMEOUT_SKIP,
+    "test": ON_TIMEOUT_SKIP,
+}
+
+# Extra time given to the whole ansible-playbook on top of its task timeouts
+_PLAYBOOK_DEADLINE_SLACK = 60
+
+
+class StepReport:
     """
-    Kernel bisect algorithm for $ git bisect run %prog from-git.
+    Measurements of one bisect step (phase durations, timeouts, ...).
     """
-    try:
-        p_out, p_build = build(
-            git_tree,
-            make_opts=[],
-            jobs=multiprocessing.cpu_count(),
-            cc="",
-            rpmbuild_topdir=rpmbuild_topdir,
-            oldconfig=True,
-        )
-    except BControlCommandError:
-        raise BControlBisectSkip
 
-    # Grep this from make output and use this rpm path for package installation
-    # Wrote: /tmp/bisect-my/RPMS/i386/kernel-5.1.0_rc3+-5.i386.rpm
-    rpms = re.findall(r"^Wrote:\s+(?P<pkg_path>.*(?<!\.rpm)\.rpm)$", p_out, re.MULTILINE)
+    def __init__(self):
+        self.started = time.time()
+        self.phases = collections.OrderedDict()
+        self.hosts = collections.OrderedDict()
 
-    # TODO: we must also check output and returncodes of ansible
-    try:
-        #_, p_ans = kernel_install(from_rpm=rpms[0], reboot=True)
-        _, p_ans = kernel_install(from_rpm=rpms[0], reboot=False)
-    except BControlCommandError:
-        raise BControlBisectAbort
+    def record(self, phase, **values):
+        self.phases.setdefault(phase, {}).update(values)
 
-    # Retrieve kernel version from filename
-    m_groups = re.match(r"^kernel-(?P<kernel_version>.*(?<!\.rpm))\.rpm$", os.path.basename(rpms[0]))
-    built_kernel_version = m_groups.group("kernel_version")
-    if not check_installed_kernel(must_match_kernel=built_kernel_version):
-        # Kernel did not boot correctly - panic?
-        raise BControlBisectSkip
+    def record_host(self, host, **values):
+        self.hosts.setdefault(host, {}).update(values)
 
-    try:
-        _, p_run = run(filename)
-    except BControlCommandError as e:
-        return e.process.returncode
+    def as_dict(self):
+        return {
+            "started": self.started,
+            "phases": self.phases,
+            "hosts": self.hosts,
+        }
+
+    def save(self, filename):
+        """
+        Append the report as one JSON line into `filename`.
+        """
+        with open(filename, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.as_dict()) + "\n")
+
+
+class PhaseWatchdog:
+    """
+    Enforce per-phase deadlines of a bisect step and map the expired phase to
+    the bisect outcome. A phase whose action is "retry" is repeated up to
+    `retries` times, then the step is skipped.
+    """
+
+    def __init__(self, deadlines=None, on_timeout=None, retries=1, report=None):
+        self.deadlines = dict(DEFAULT_PHASE_DEADLINES, **(deadlines or {}))
+        self.on_timeout = dict(DEFAULT_PHASE_ON_TIMEOUT, **(on_timeout or {}))
+        self.retries = retries
+        self.report = report if report is not None else StepReport()
+
+    def deadline(self, phase):
+        return self.deadlines.get(phase)
+
+    def run(self, phase, fnc, *args, **kwargs):
+        """
+        Call `fnc` as the bisect `phase`. The function is responsible for
+        passing the deadline into commands it runs, this method only handles
+        BControlTimeout raised from it.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.monotonic()
+            try:
+                ret = fnc(*args, **kwargs)
+            except BControlTimeout as e:
+                timed_out_phase = e.phase or phase
+                action = self.on_timeout.get(timed_out_phase, ON_TIMEOUT_ABORT)
+                warning("bisect: phase %s timed out after %.1f s (%s)", timed_out_phase, e.elapsed, action)
+                self.report.record(
+                    timed_out_phase,
+                    elapsed=time.monotonic() - start,
+                    killed_after=e.elapsed,
+                    timed_out=True,
+                    attempt=attempt,
+                    action=action,
+                )
+
+                if action == ON_TIMEOUT_RETRY and attempt <= self.retries:
+                    continue
+                elif action == ON_TIMEOUT_ABORT:
+                    raise BControlBisectAbort from e
+
+                raise BControlBisectSkip from e
+
+            self.report.record(phase, elapsed=time.monotonic() - start, attempt=attempt)
+            return ret
+
+
+def bisect_from_git(git_tree, filename, rpmbuild_topdir, watchdog=None,
+                    strategy=STRATEGY_LINEAR, verdict=VERDICT_ALL, delta=False, artifact=ARTIFACT_RPM,
+                    installer=INSTALLER_YUM, headers=False, prestage=0,
+                    reboot_use=REBOOT_ANSIBLE, kexec_timeout=DEFAULT_KEXEC_TIMEOUT, gc=True, keep_releases=(),
+                    cmdline_profile=CMDLINE_PROFILE_NONE, extra_cmdline=()):
+    """
+    Kernel bisect algorithm for $ git bisect run %prog from-git. See
+    bisect_step() for `strategy`, `verdict`, `delta`, `installer`,
+    `reboot_use`, `kexec_timeout`, `gc`, `keep_releases`, `cmdline_profile`
+    and `extra_cmdline` and build() for
+    `artifact`. With `headers`, the built kernel-headers package
+    is installed too.
+
+    With `prestage`, up to that many candidates of the next steps are built
+    while DUTs test this one and installed on DUTs when it is decided (see
+    bcontroller.prestage). A step whose kernel was staged skips the build
+    and the install.
+    """
+    watchdog = watchdog or PhaseWatchdog()
+
+    if _SSH_POOL is not None:
+        # Re-establish connections to DUTs while the kernel is being built
+        threading.Thread(target=_SSH_POOL.ensure, daemon=True).start()
+
+    make_opts = ""
+    staged = None
+    if prestage:
+        from . import prestage as _prestage
+        session = _prestage.Session(git_tree)
+        head = session.head()
+        # Kernels of all steps get unique releases, like the staged ones
+        make_opts = _prestage.make_opts(head)
+        staged = session.staged.get(head)
+        if staged is not None and not _prestage.installed(staged["release"]):
+            warning("bisect: staged kernel %s of %s is missing on DUTs, installing it again", staged["release"], head)
+            del session.staged[head]
+            session.save()
+            staged = None
+
+    if staged is not None:
+        info("bisect: kernel %s of %s is staged on DUTs already", staged["release"], head)
+        kernel_pkg_path, built_kernel_release, extra_pkg_paths = staged["pkg"], staged["release"], []
     else:
-        return p_run.returncode
+        try:
+            manifest, p_build = watchdog.run(
+                "build",
+                build,
+                git_tree,
+                make_opts=make_opts,
+                jobs=multiprocessing.cpu_count(),
+                cc="",
+                rpmbuild_topdir=rpmbuild_topdir,
+                oldconfig=True,
+                timeout=watchdog.deadline("build"),
+                artifact=artifact,
+            )
+        except (BControlBuildError, BControlCommandError) as e:
+            warning("bisect: build failed, skipping: %s", e.message.splitlines()[0])
+            raise BControlBisectSkip
+
+        if manifest.kernel is None:
+            warning("bisect: build did not produce kernel package, skipping")
+            raise BControlBisectSkip
+
+        try:
+            built_kernel_release = manifest_release(git_tree, make_opts, manifest)
+        except BControlCommandError:
+            raise BControlBisectSkip
+
+        kernel_pkg_path = manifest.kernel
+        extra_pkg_paths = [manifest.headers] if headers and manifest.headers else []
+
+    prestager = None
+    if prestage:
+        prestager = _prestage.Prestager(
+            session,
+            rpmbuild_topdir,
+            prestage,
+            installer,
+            watchdog.deadlines,
+            gc=gc,
+            keep_releases=keep_releases,
+        )
+        prestager.start(head)
+        # The other staged candidates must survive the kernel GC
+        keep_releases = list(keep_releases) + [entry["release"] for entry in session.staged.values()]
+
+    decided = False
+    try:
+        # Copy, install, reboot and test in one playbook; a timed out task is
+        # attributed to its own phase (see _task_phase())
+        rc = watchdog.run(
+            "step",
+            _step_verdict_of,
+            kernel_pkg_path=kernel_pkg_path,
+            kernel_release=built_kernel_release,
+            filename=filename,
+            deadlines=watchdog.deadlines,
+            strategy=strategy,
+            verdict=verdict,
+            report=watchdog.report,
+            delta=delta,
+            extra_pkg_paths=extra_pkg_paths,
+            installer=installer,
+            staged=staged is not None,
+            reboot_use=reboot_use,
+            kexec_timeout=kexec_timeout,
+            gc=gc,
+            keep_releases=keep_releases,
+            cmdline_profile=cmdline_profile,
+            extra_cmdline=extra_cmdline,
+        )
+        decided = True
+    finally:
+        if prestager is not None:
+            # Candidates are staged only when the bisect goes on with them
+            start = time.monotonic()
+            try:
+                prestager.finish(head, stage=decided)
+            except BControlError as e:
+                warning("bisect: staging of next candidates failed: %s", e.message.splitlines()[0])
+
+            watchdog.report.record("prestage", elapsed=time.monotonic() - start, staged=list(prestager.built))
+
+    return rc
 
 
 def check_installed_kernel(must_match_kernel):
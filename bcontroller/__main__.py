@@ -32,6 +32,34 @@ _BISECT_RET_ABORT = 128
 _CUR_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
+def _parse_phase_values(value_type):
+    """
+    Return click callback parsing repeated PHASE=VALUE options into a dict.
+    """
+    def _callback(ctx, param, values):
+        parsed = {}
+        for value in values:
+            phase, sep, phase_value = value.partition("=")
+            if not sep or phase not in bcontroller.PHASES:
+                raise click.BadParameter("expected PHASE=VALUE where PHASE is one of: %s" % ", ".join(bcontroller.PHASES))
+
+            try:
+                parsed[phase] = value_type(phase_value)
+            except ValueError as e:
+                raise click.BadParameter("%s: %s" % (value, e))
+
+        return parsed
+
+    return _callback
+
+
+def _on_timeout_action(value):
+    if value not in bcontroller.ON_TIMEOUT_ACTIONS:
+        raise ValueError("action must be one of: %s" % ", ".join(bcontroller.ON_TIMEOUT_ACTIONS))
+
+    return value
+
+
 def dry(fnc, *args, **kwargs):
     if _DRY_RUN_ACTIVE:
         warning("DRY-RUN: not calling: %s(%s, %s)", fnc.__name__, args, kwargs)
@@ -68,8 +96,105 @@ def dry(fnc, *args, **kwargs):
     is_flag=True,
     help="Do not launch any action, just print it out.",
 )
+@click.option(
+    "--runner",
+    type=click.Choice([
+        # == Spawn ansible/ansible-playbook for every call
+        "subprocess",
+        # == Drive Ansible's Python API inside bcontrol process
+        "embedded",
+    ]),
+    default="subprocess",
+    show_default=True,
+    help="Tells how to run Ansible.",
+)
+@click.option(
+    "--ssh-pool/--no-ssh-pool",
+    default=False,
+    show_default=True,
+    help="Keep persistent multiplexed SSH connections to DUTs and share them with Ansible.",
+)
+@click.option(
+    "--agent/--no-agent",
+    default=False,
+    show_default=True,
+    help="Run commands and scripts on DUTs through a persistent bcontrol agent instead of Ansible modules.",
+)
+@click.option(
+    "--fanout",
+    type=click.IntRange(min=0),
+    default=0,
+    metavar="DEGREE",
+    help="With --agent, DUTs relay kernel packages to DEGREE other DUTs each, instead of the controller sending them to every DUT (0 disables).",
+)
+@click.option(
+    "--http-server",
+    metavar="ADDRESS[:PORT]",
+    help="DUTs download kernel packages from HTTP server inside bcontrol, ADDRESS is how they reach this machine.",
+)
+@click.option(
+    "--boot-probe/--no-boot-probe",
+    default=False,
+    show_default=True,
+    help="Watch rebooting DUTs from bcontrol (SSH port, banner and boot ID) and release every DUT as soon as it is up, instead of the Ansible reboot module.",
+)
+@click.option(
+    "--console/--no-console",
+    default=False,
+    show_default=True,
+    help="Capture consoles of DUTs (bcontrol_console inventory variable) and skip a bisect step as soon as its kernel panics while booting.",
+)
+@click.option(
+    "--netconsole-port",
+    type=click.IntRange(min=1, max=65535),
+    default=6666,
+    show_default=True,
+    help="UDP port the netconsole of DUTs sends to.",
+)
+@click.option(
+    "--ipmi/--no-ipmi",
+    default=False,
+    show_default=True,
+    help="Control power of DUTs through BMCs of their duts-mgmt hosts, e.g. reset DUTs which panicked without a serial console.",
+)
+@click.option(
+    "--ipmi-concurrency",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="How many BMC operations may run at once.",
+)
+@click.option(
+    "--ipmi-rate",
+    type=click.FloatRange(min=0),
+    default=4.0,
+    show_default=True,
+    metavar="PER_SECOND",
+    help="How many BMC operations may start per second (0 for no limit).",
+)
+@click.option(
+    "--build-cache/--no-build-cache",
+    default=False,
+    show_default=True,
+    help="Keep built kernel packages in a persistent cache keyed by the source tree, .config, compiler and make options, and reuse them instead of building again.",
+)
+@click.option(
+    "--build-cache-dir",
+    type=click.Path(file_okay=False),
+    metavar="PATH",
+    help="Directory of the build cache [default: ~/.cache/bcontrol/builds].",
+)
+@click.option(
+    "--build-cache-size",
+    type=click.FloatRange(min=0),
+    default=20,
+    show_default=True,
+    metavar="GIB",
+    help="Evict the least recently used builds when the build cache grows over this size.",
+)
 @click.pass_context
-def cli(ctx, log, dry_run):
+def cli(ctx, log, dry_run, runner, ssh_pool, agent, fanout, http_server, boot_probe, console, netconsole_port,
+        ipmi, ipmi_concurrency, ipmi_rate, build_cache, build_cache_dir, build_cache_size):
     """
     Script for automatic kernel bisection.
     """
@@ -78,6 +203,32 @@ def cli(ctx, log, dry_run):
 
     logging.basicConfig(level=log.upper())
 
+    if ssh_pool and not dry_run:
+        # Must be set up before the embedded runner loads Ansible config
+        bcontroller.use_ssh_pool()
+
+    if runner == "embedded":
+        bcontroller.use_embedded_runner()
+
+    if agent and not dry_run:
+        bcontroller.use_agent(fanout=fanout)
+
+    if http_server and not dry_run:
+        address, _, port = http_server.partition(":")
+        bcontroller.use_http_server(address, int(port) if port else None)
+
+    if boot_probe and not dry_run:
+        bcontroller.use_boot_probe()
+
+    if console and not dry_run:
+        bcontroller.use_console(netconsole_port=netconsole_port)
+
+    if ipmi and not dry_run:
+        bcontroller.use_power(concurrency=ipmi_concurrency, rate=ipmi_rate)
+
+    if build_cache and not dry_run:
+        bcontroller.use_build_cache(build_cache_dir, int(build_cache_size * 1024 ** 3))
+
     global _DRY_RUN_ACTIVE
     _DRY_RUN_ACTIVE = dry_run
 
@@ -96,7 +247,7 @@ def cli(ctx, log, dry_run):
         exists=True,
         dir_okay=False,
     ),
-    help="Path to RPM package to install on all DUTs.",
+    help="Path to RPM package (or kernel tarball, see build --artifact) to install on all DUTs.",
 )
 @click.option(
     "--reboot/--no-reboot",
@@ -104,8 +255,86 @@ def cli(ctx, log, dry_run):
     default=True,
     help="Tell if system will be rebooted after the kernel installation.",
 )
-def kernel_install(from_rpm, reboot):
-    dry(bcontroller.kernel_install, from_rpm, reboot)
+@click.option(
+    "--delta/--no-delta",
+    default=False,
+    help="Send only the difference against the previous kernel package cached on DUTs (needs rsync).",
+)
+@click.option(
+    "--with-rpm",
+    "extra_rpms",
+    multiple=True,
+    type=click.Path(
+        exists=True,
+        dir_okay=False,
+    ),
+    help="Install another package (e.g. kernel-headers) together with the kernel. Can be used multiple times.",
+)
+@click.option(
+    "--installer",
+    type=click.Choice(bcontroller.INSTALLERS),
+    default=bcontroller.INSTALLER_YUM,
+    show_default=True,
+    help="Install the packages by yum or in one rpm transaction without loading repository metadata.",
+)
+@click.option(
+    "--use",
+    "reboot_use",
+    type=click.Choice(bcontroller.REBOOT_METHODS),
+    default=bcontroller.REBOOT_ANSIBLE,
+    show_default=True,
+    help="Reboot into the kernel fully or by kexec (skipping firmware and boot loader).",
+)
+@click.option(
+    "--kexec-timeout",
+    default=bcontroller.DEFAULT_KEXEC_TIMEOUT,
+    show_default=True,
+    type=click.IntRange(min=1),
+    metavar="SECONDS",
+    help="With kexec, fully reboot DUTs which did not come back from kexec in given time.",
+)
+@click.option(
+    "--gc/--no-gc",
+    default=False,
+    help="Remove kernels installed by bcontrol before, except the running and the default one.",
+)
+@click.option(
+    "--keep-kernel",
+    "keep_releases",
+    multiple=True,
+    metavar="RELEASE",
+    help="Never remove the kernel of given release by --gc. Can be used multiple times.",
+)
+@click.option(
+    "--cmdline-profile",
+    type=click.Choice(bcontroller.CMDLINE_PROFILES),
+    default=bcontroller.CMDLINE_PROFILE_NONE,
+    show_default=True,
+    help="Boot the kernel with a faster command line: quiet (no boot messages), minimal (quiet, without services tests do not need). Only its boot entry gets it.",
+)
+@click.option(
+    "--cmdline-arg",
+    "extra_cmdline",
+    multiple=True,
+    metavar="ARG",
+    help="Add ARG to the command line of the kernel boot entry (e.g. systemd.mask=foo.service). Can be used multiple times.",
+)
+def kernel_install(from_rpm, reboot, delta, extra_rpms, installer, reboot_use, kexec_timeout, gc, keep_releases,
+                   cmdline_profile, extra_cmdline):
+    dry(
+        bcontroller.kernel_install,
+        from_rpm,
+        reboot,
+        delta=delta,
+        extra_rpms=extra_rpms,
+        installer=installer,
+        reboot_use=reboot_use,
+        kexec_timeout=kexec_timeout,
+        gc=gc,
+        keep_releases=keep_releases,
+        cmdline_profile=cmdline_profile,
+        extra_cmdline=extra_cmdline,
+    )
 
 
 @click.command(
@@ -167,8 +396,23 @@ def uname(args):
     show_default=True,
     help="Try to regenerate kernel configuration file using the `make oldconfig`.",
 )
-def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig):
-    dry(bcontroller.build, git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig)
+@click.option(
+    "--log-file",
+    type=click.Path(
+        dir_okay=False,
+        writable=True,
+    ),
+    help="Append the whole build output into given file.",
+)
+@click.option(
+    "--artifact",
+    type=click.Choice(bcontroller.ARTIFACT_FORMATS),
+    default=bcontroller.ARTIFACT_RPM,
+    show_default=True,
+    help="Build RPM packages or a zstd tarball of vmlinuz, System.map and modules which DUTs install without yum (needs tarzst-pkg target of the kernel).",
+)
+def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig, log_file, artifact):
+    dry(bcontroller.build, git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig, log_file, artifact=artifact)
 
 
 @click.command(
@@ -179,10 +423,13 @@ def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig):
     type=click.Choice([
         # == Reboot over SSH
         "ansible",
-        # == System reset without waiting for OS
-        "ipmi",
+        # == Reboot over SSH, reset and power cycle by BMC when it does not come back
+        bcontroller.REBOOT_IPMI,
         "amtc",
 
+        # == Boot the default kernel by kexec, reboot over SSH on failure
+        bcontroller.REBOOT_KEXEC,
+
         # == Restart system using the Beaker - is it possible? TODO
         #"beaker",
 
@@ -192,8 +439,43 @@ def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig):
     show_default=True,
     help="Tells which way reboot the machine."
 )
-def reboot(use):
-    dry(bcontroller.reboot, use)
+@click.option(
+    "--kexec-timeout",
+    default=bcontroller.DEFAULT_KEXEC_TIMEOUT,
+    show_default=True,
+    type=click.IntRange(min=1),
+    metavar="SECONDS",
+    help="With kexec, fully reboot DUTs which did not come back from kexec in given time.",
+)
+@click.option(
+    "--ready-timeout",
+    type=click.IntRange(min=1),
+    metavar="SECONDS",
+    help="With ipmi, escalate to the next way of reboot when a DUT does not come back in given time [default: 300].",
+)
+def reboot(use, kexec_timeout, ready_timeout):
+    dry(bcontroller.reboot, use, kexec_timeout=kexec_timeout, ready_timeout=ready_timeout)
+
+
+@click.command(
+    help="Control power of DUTs through BMCs of their duts-mgmt hosts (ipmitool is needed).",
+)
+@click.argument(
+    "operation",
+    type=click.Choice([
+        "status",
+        "on",
+        "off",
+        # == ACPI shutdown
+        "soft",
+        "reset",
+        "cycle",
+    ]),
+)
+def power(operation):
+    results = dry(bcontroller.power, operation) or {}
+    for host, out in results.items():
+        print("%s: %s" % (host, out))
 
 
 @click.command(
@@ -235,6 +517,39 @@ def run(filename):
     print(out)
 
 
+@click.group(
+    name="ssh-pool",
+    help="Manage persistent SSH connections to DUTs.",
+)
+def ssh_pool():
+    pass
+
+
+@click.command(
+    name="warm",
+    help="Start SSH master connections to all DUTs (in parallel) and print their state.",
+)
+def ssh_pool_warm():
+    from bcontroller.sshpool import SSHPool
+    from bcontroller.inventory import load_inventory
+
+    pool = SSHPool(load_inventory().hosts("duts"))
+    for host, status in (dry(pool.ensure) or {}).items():
+        print("%s: %s" % (host, status))
+
+
+@click.command(
+    name="close",
+    help="Close SSH master connections to all DUTs.",
+)
+def ssh_pool_close():
+    from bcontroller.sshpool import SSHPool
+    from bcontroller.inventory import load_inventory
+
+    pool = SSHPool(load_inventory().hosts("duts"))
+    dry(pool.close)
+
+
 @click.group(
     help="Control kernel bisect. This is basically a wrapper around git-bisect.",
 )
@@ -394,14 +709,138 @@ def bisect_reset(ctx):
         dir_okay=False,
     ),
 )
+@click.option(
+    "--deadline",
+    "deadlines",
+    multiple=True,
+    metavar="PHASE=SECONDS",
+    callback=_parse_phase_values(int),
+    help="Override deadline of a bisect step phase (%s). Can be used multiple times." % ", ".join(bcontroller.PHASES),
+)
+@click.option(
+    "--on-timeout",
+    multiple=True,
+    metavar="PHASE=ACTION",
+    callback=_parse_phase_values(_on_timeout_action),
+    help="What to do when the phase exceeds its deadline (%s)." % ", ".join(bcontroller.ON_TIMEOUT_ACTIONS),
+)
+@click.option(
+    "--retries",
+    default=1,
+    show_default=True,
+    help="How many times to retry a timed out phase with the retry action.",
+)
+@click.option(
+    "--report",
+    type=click.Path(
+        dir_okay=False,
+        writable=True,
+    ),
+    help="Append JSON report of the bisect step (phase durations, timeouts, per-DUT results) into given file.",
+)
+@click.option(
+    "--strategy",
+    type=click.Choice(bcontroller.STRATEGIES),
+    default=bcontroller.STRATEGY_LINEAR,
+    show_default=True,
+    help="With free strategy, every DUT goes through install, reboot and test on its own pace.",
+)
+@click.option(
+    "--verdict",
+    type=click.Choice(bcontroller.VERDICT_POLICIES),
+    default=bcontroller.VERDICT_ALL,
+    show_default=True,
+    help="Decide the bisect step when all DUTs finished, by the first DUT which finished or by the first DUT which reproduced the bug (any-bad).",
+)
+@click.option(
+    "--delta/--no-delta",
+    default=False,
+    help="Send only the difference against the previous kernel package cached on DUTs (needs rsync).",
+)
+@click.option(
+    "--artifact",
+    type=click.Choice(bcontroller.ARTIFACT_FORMATS),
+    default=bcontroller.ARTIFACT_RPM,
+    show_default=True,
+    help="Install the kernel from RPM packages or from a tarball unpacked on DUTs (see build --artifact).",
+)
+@click.option(
+    "--installer",
+    type=click.Choice(bcontroller.INSTALLERS),
+    default=bcontroller.INSTALLER_YUM,
+    show_default=True,
+    help="Install the RPM packages by yum or in one rpm transaction without loading repository metadata.",
+)
+@click.option(
+    "--headers/--no-headers",
+    default=False,
+    help="Install the built kernel-headers package together with the kernel.",
+)
+@click.option(
+    "--prestage",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    metavar="N",
+    help="Build up to N candidate kernels of the next steps (2 covers both next midpoints) while DUTs test this one and install them on DUTs, so the next step only reboots.",
+)
+@click.option(
+    "--reboot-use",
+    type=click.Choice(bcontroller.REBOOT_METHODS),
+    default=bcontroller.REBOOT_ANSIBLE,
+    show_default=True,
+    help="Reboot into the kernel fully or by kexec (skipping firmware and boot loader).",
+)
+@click.option(
+    "--kexec-timeout",
+    default=bcontroller.DEFAULT_KEXEC_TIMEOUT,
+    show_default=True,
+    type=click.IntRange(min=1),
+    metavar="SECONDS",
+    help="With kexec, fully reboot DUTs which did not come back from kexec in given time.",
+)
+@click.option(
+    "--gc/--no-gc",
+    default=True,
+    show_default=True,
+    help="Remove kernels installed by bcontrol in previous steps, except the running, the default and the staged ones.",
+)
+@click.option(
+    "--keep-kernel",
+    "keep_releases",
+    multiple=True,
+    metavar="RELEASE",
+    help="Never remove the kernel of given release by --gc. Can be used multiple times.",
+)
+@click.option(
+    "--cmdline-profile",
+    type=click.Choice(bcontroller.CMDLINE_PROFILES),
+    default=bcontroller.CMDLINE_PROFILE_NONE,
+    show_default=True,
+    help="Boot the kernel with a faster command line: quiet (no boot messages), minimal (quiet, without services tests do not need). Only its boot entry gets it.",
+)
+@click.option(
+    "--cmdline-arg",
+    "extra_cmdline",
+    multiple=True,
+    metavar="ARG",
+    help="Add ARG to the command line of the kernel boot entry (e.g. systemd.mask=foo.service). Can be used multiple times.",
+)
 @click.pass_context
-def bisect_from_git(ctx, filename):
+def bisect_from_git(ctx, filename, deadlines, on_timeout, retries, report, strategy, verdict, delta, artifact,
+                    installer, headers, prestage, reboot_use, kexec_timeout, gc, keep_releases,
+                    cmdline_profile, extra_cmdline):
     """
     This sub-command implements the kernel bisect algorithm. Use this when
     running `git bisect run <script>` directly. FILENAME is the name of a
     bisect script.
     """
     git_tree = ctx.obj["git_tree"]
+    watchdog = bcontroller.PhaseWatchdog(
+        deadlines=deadlines,
+        on_timeout=on_timeout,
+        retries=retries,
+    )
 
     retcode = _BISECT_RET_ABORT
     try:
@@ -409,6 +848,20 @@ def bisect_from_git(ctx, filename):
             git_tree,
             filename,
             DEFAULT_RPMBUILD_TOPDIR,
+            watchdog=watchdog,
+            strategy=strategy,
+            verdict=verdict,
+            delta=delta,
+            artifact=artifact,
+            installer=installer,
+            headers=headers,
+            prestage=prestage,
+            reboot_use=reboot_use,
+            kexec_timeout=kexec_timeout,
+            gc=gc,
+            keep_releases=keep_releases,
+            cmdline_profile=cmdline_profile,
+            extra_cmdline=extra_cmdline,
         )
     except bcontroller.BControlBisectSkip:
         retcode = _BISECT_RET_SKIP
@@ -419,6 +872,9 @@ def bisect_from_git(ctx, filename):
         retcode = _BISECT_RET_ABORT
     except Exception:
         retcode = _BISECT_RET_ABORT
+    finally:
+        if report:
+            watchdog.report.save(report)
 
     sys.exit(retcode)
 
@@ -428,9 +884,14 @@ cli.add_command(build)
 cli.add_command(kernel_install)
 cli.add_command(uname)
 cli.add_command(reboot)
+cli.add_command(power)
 cli.add_command(run)
 cli.add_command(sh)
 
+ssh_pool.add_command(ssh_pool_warm)
+ssh_pool.add_command(ssh_pool_close)
+cli.add_command(ssh_pool)
+
 bisect.add_command(bisect_start)
 bisect.add_command(bisect_run)
 bisect.add_command(bisect_good)
@@ -0,0 +1,378 @@
+"""
+Controller side of the persistent DUT agent (see bcontroller.dut_agent).
+
+The agent is bootstrapped over SSH (through the SSH pool master if there is
+one) and stays running for the whole bcontrol process. Command execution and
+file push then cost one round trip over the already open SSH channel instead
+of a full Ansible module execution. When the connection is gone (e.g. the DUT
+rebooted), the agent is bootstrapped again automatically.
+"""
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import select
+import shlex
+import struct
+import subprocess
+import time
+import zlib
+from logging import debug, info
+
+from . import (
+    BControlCommandError,
+    BControlError,
+    BControlTimeout,
+    CompletedRun,
+    _kill_process_group,
+)
+from .inventory import load_inventory
+from .sshpool import SSHPool
+from .stream import STDERR, STDOUT, LineDecoder, OutputLine, SpillBuffer, TailBuffer
+
+
+_HEADER = struct.Struct(">II")
+_CHUNK_SIZE = 256 * 1024
+
+# Timeout of agent bootstrap and of the health-check ping (seconds)
+DEFAULT_CONNECT_TIMEOUT = 30
+_PING_TIMEOUT = 5
+
+# Disk usage cap of the content store on every DUT (bytes)
+DEFAULT_STORE_CAP = 2 * 1024 ** 3
+
+
+class BControlAgentError(BControlError):
+    pass
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _bootstrap_command():
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "dut_agent.py"), "rb") as f:
+        source = base64.b64encode(zlib.compress(f.read())).decode("ascii")
+
+    code = "import base64,zlib;exec(zlib.decompress(base64.b64decode('%s')))" % source
+    return "python3 -u -c %s" % shlex.quote(code)
+
+
+class AgentClient:
+    """
+    Connection to the agent running on one DUT.
+    """
+
+    def __init__(self, host, ssh_pool, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.host = host
+        self.ssh_pool = ssh_pool
+        self.connect_timeout = connect_timeout
+        self.process = None
+        self.boot_id = None
+
+    def connect(self):
+        self.close()
+
+        args, env = self.ssh_pool.command(self.host, _bootstrap_command())
+        debug("agent: bootstrapping agent on %s", self.host)
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+            bufsize=0,
+            start_new_session=True,
+        )
+
+        previous_boot_id = self.boot_id
+        self.boot_id = self.request({"op": "ping"}, timeout=self.connect_timeout)["boot_id"]
+        if previous_boot_id is not None and previous_boot_id != self.boot_id:
+            info("agent: %s rebooted, agent bootstrapped again", self.host)
+
+    def close(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            _kill_process_group(self.process)
+            self.process.wait()
+
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+
+    def ensure(self):
+        """
+        Make sure the agent is running and responding, bootstrap it again if
+        it is not.
+        """
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.request({"op": "ping"}, timeout=_PING_TIMEOUT)
+                return
+            except (BControlAgentError, BControlTimeout):
+                pass
+
+        self.connect()
+
+    def _send(self, header, data=b""):
+        encoded = json.dumps(header).encode("utf-8")
+        try:
+            self.process.stdin.write(_HEADER.pack(len(encoded), len(data)) + encoded + data)
+        except BrokenPipeError:
+            raise BControlAgentError("agent: connection to %s lost" % self.host)
+
+    def _read_exact(self, size, deadline):
+        data = b""
+        while len(data) < size:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+            if not ready:
+                self.close()
+                raise BControlTimeout("Agent request on %s" % self.host, timeout)
+
+            chunk = os.read(self.process.stdout.fileno(), size - len(data))
+            if not chunk:
+                self.close()
+                raise BControlAgentError("agent: connection to %s lost" % self.host)
+
+            data += chunk
+
+        return data
+
+    def _receive(self, deadline):
+        header_len, data_len = _HEADER.unpack(self._read_exact(_HEADER.size, deadline))
+        header = json.loads(self._read_exact(header_len, deadline).decode("utf-8"))
+        data = self._read_exact(data_len, deadline) if data_len else b""
+
+        if not header.get("ok"):
+            raise BControlAgentError("agent on %s: %s" % (self.host, header.get("error")))
+
+        return header, data
+
+    def request(self, header, timeout=None):
+        """
+        Send single request and return the response header.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._send(header)
+        response, _ = self._receive(deadline)
+        return response
+
+    def exec(self, args, cwd=None, hooks=(), timeout=None):
+        """
+        Run `args` on the DUT. Output lines are passed to `hooks` as soon as
+        they arrive. Returns exit code, standard output and the tail of the
+        standard error output.
+        """
+        self.ensure()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        buffers = {
+            STDOUT: SpillBuffer(),
+            STDERR: TailBuffer(),
+        }
+        decoders = {
+            STDOUT: LineDecoder(),
+            STDERR: LineDecoder(),
+        }
+
+        self._send({"op": "exec", "args": list(args), "cwd": cwd})
+        while True:
+            response, data = self._receive(deadline)
+            if response["event"] == "exit":
+                break
+
+            timestamp = time.monotonic()
+            for text in decoders[response["event"]].decode(data):
+                line = OutputLine(response["event"], timestamp, text)
+                buffers[line.stream].write(text)
+                for hook in hooks:
+                    hook(line)
+
+        for name, decoder in decoders.items():
+            for text in decoder.decode(b""):
+                buffers[name].write(text)
+
+        return response["rc"], buffers[STDOUT].getvalue(), buffers[STDERR].getvalue()
+
+    def missing(self, sha256s):
+        """
+        Return those of `sha256s` which are not in the content store of the
+        DUT (one request for all of them).
+        """
+        self.ensure()
+        present = set(self.request({"op": "has", "sha256s": list(sha256s)})["present"])
+        return [sha256 for sha256 in sha256s if sha256 not in present]
+
+    def put(self, path, sha256, cap=None, timeout=None, keep=()):
+        """
+        Transfer local file `path` with `sha256` into the content store of the
+        DUT, evict least recently used files (except those in `keep`) over the
+        `cap`. Returns number of transferred bytes.
+        """
+        # A timed out request before closed the connection
+        self.ensure()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sent = 0
+        self._send({"op": "put", "sha256": sha256, "cap": cap, "keep": list(keep)})
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                self._send({"op": "chunk"}, chunk)
+                sent += len(chunk)
+
+        self._send({"op": "chunk"})
+        response, _ = self._receive(deadline)
+        if response["evicted"]:
+            debug("agent: %s: evicted from store: %s", self.host, ", ".join(response["evicted"]))
+
+        return sent
+
+    def link(self, sha256, dest, mode=0o644):
+        self.request({"op": "link", "sha256": sha256, "dest": dest, "mode": mode})
+
+    def serve(self, port=0):
+        """
+        Serve the content store of the DUT to other DUTs over HTTP, return
+        the port.
+        """
+        self.ensure()
+        return self.request({"op": "serve", "port": port})["port"]
+
+    def unserve(self):
+        self.request({"op": "unserve"})
+
+    def fetch(self, url, sha256, cap=None, timeout=None):
+        """
+        Let the DUT download `url` into its content store. Returns size of
+        the file and how long the download took (seconds).
+        """
+        self.ensure()
+        response = self.request(
+            {"op": "fetch", "url": url, "sha256": sha256, "cap": cap, "timeout": timeout or 60},
+            timeout=timeout,
+        )
+        return response["size"], response["seconds"]
+
+    def push(self, path, dest, mode=0o644, cap=None):
+        """
+        Make local file `path` available on the DUT as `dest`. The content is
+        transferred only if the DUT does not have it in its store yet. Returns
+        number of transferred bytes.
+        """
+        sha256 = _sha256(path)
+        sent = 0
+        if self.missing([sha256]):
+            sent = self.put(path, sha256, cap=cap)
+
+        self.link(sha256, dest, mode)
+        return sent
+
+
+class AgentPool:
+    """
+    Agents on all `hosts`. Operations run on all hosts in parallel.
+    """
+
+    def __init__(self, hosts, ssh_pool=None, store_cap=DEFAULT_STORE_CAP):
+        self.hosts = list(hosts)
+        self.store_cap = store_cap
+        self.ssh_pool = ssh_pool or SSHPool(self.hosts, inventory=load_inventory())
+        self.clients = {
+            host: AgentClient(host, self.ssh_pool) for host in self.hosts
+        }
+
+    def _map(self, fnc):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.hosts), 1)) as executor:
+            return dict(zip(self.hosts, executor.map(fnc, [self.clients[host] for host in self.hosts])))
+
+    def ensure(self):
+        self._map(lambda client: client.ensure())
+
+    def close(self):
+        self._map(lambda client: client.close())
+
+    def run(self, args, cwd=None, timeout=None):
+        """
+        Run `args` on all hosts. Returns the same document as the json Ansible
+        callback produces for the command module and the CompletedRun. The
+        return code is the first non-zero exit code of any host;
+        BControlCommandError is raised in that case.
+        """
+        start = time.monotonic()
+        results = self._map(lambda client: client.exec(args, cwd=cwd, timeout=timeout))
+        debug("agent: %s finished on %d hosts in %.3f s", args, len(results), time.monotonic() - start)
+
+        hosts = {}
+        stats = {}
+        returncode = 0
+        for host, (rc, stdout, stderr) in results.items():
+            hosts[host] = {
+                "rc": rc,
+                "stdout": stdout.rstrip("\n"),
+                "stderr": stderr.rstrip("\n"),
+                "failed": rc != 0,
+            }
+            stats[host] = {
+                "ok": int(rc == 0),
+                "failures": int(rc != 0),
+            }
+            returncode = returncode or rc
+
+        document = json.dumps({
+            "plays": [{
+                "play": {"name": "bcontrol agent"},
+                "tasks": [{
+                    "task": {"name": " ".join(args)},
+                    "hosts": hosts,
+                }],
+            }],
+            "stats": stats,
+        })
+
+        process = CompletedRun(args, returncode)
+        if returncode != 0:
+            stderr_output = "\n".join("%s: %s" % (host, result["stderr"]) for host, result in hosts.items())
+            raise BControlCommandError(args, process, document, stderr_output)
+
+        return document, process
+
+    def store(self, paths, timeout=None):
+        """
+        Make local files `paths` available in the content store of all hosts.
+        Every host is asked for all the hashes at once and only the missing
+        files are transferred. Returns mapping host -> sent bytes and mapping
+        path -> sha256.
+        """
+        digests = collections.OrderedDict((path, _sha256(path)) for path in paths)
+
+        def store_host(client):
+            missing = client.missing(list(digests.values()))
+            sent = 0
+            for path, sha256 in digests.items():
+                if sha256 in missing:
+                    # Files of the batch must not evict each other
+                    sent += client.put(path, sha256, cap=self.store_cap, timeout=timeout, keep=digests.values())
+
+            debug("agent: %s: %d of %d files were in store", client.host, len(digests) - len(missing), len(digests))
+            return sent
+
+        return self._map(store_host), digests
+
+    def link(self, sha256, dest, mode=0o644):
+        self._map(lambda client: client.link(sha256, dest, mode))
+
+    def push(self, path, dest, mode=0o644, timeout=None):
+        """
+        Push local file to all hosts, return mapping host -> sent bytes.
+        """
+        sent, digests = self.store([path], timeout=timeout)
+        self.link(digests[path], dest, mode)
+        return sent
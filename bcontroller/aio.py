@@ -0,0 +1,174 @@
+"""
+Asyncio execution backend.
+
+Coroutine counterparts of bcontroller.run_command and of the git, ansible and
+build helpers. They allow to overlap e.g. kernel build with work on DUTs:
+
+    build_task = asyncio.ensure_future(aio.build(...))
+    await aio.ansible_playbook(...)
+    await build_task
+
+Every command runs in its own process group. When the coroutine is cancelled,
+the whole group is terminated (and killed after a grace period) before the
+cancellation is propagated.
+"""
+import asyncio
+import os
+import signal
+import time
+from logging import debug, warning
+
+from . import (
+    ARTIFACT_RPM,
+    ARTIFACT_TARBALL,
+    AnsibleEvents,
+    BControlCommandError,
+    BControlTimeout,
+    _OutputTee,
+    _ansible_args,
+    _ansible_error,
+    _ansible_playbook_args,
+    _build_args,
+    _build_env,
+    _build_hooks,
+    _build_manifest,
+    _collect_tarball,
+    _git_args,
+    _kernel_release_args,
+    _kill_process_group,
+    _oldconfig_args,
+)
+from .stream import DEFAULT_CHUNK_SIZE, STDERR, STDOUT, LineDecoder, OutputLine, SpillBuffer, TailBuffer
+
+
+# How long to wait after SIGTERM before the process group is killed
+KILL_GRACE_PERIOD = 5
+
+
+async def _drain(reader, name, tee, hooks):
+    decoder = LineDecoder()
+    while True:
+        chunk = await reader.read(DEFAULT_CHUNK_SIZE)
+        timestamp = time.monotonic()
+        for text in decoder.decode(chunk):
+            line = OutputLine(name, timestamp, text)
+            tee.write(line)
+            for hook in hooks:
+                hook(line)
+
+        if not chunk:
+            break
+
+
+async def terminate(process, grace_period=KILL_GRACE_PERIOD):
+    """
+    Terminate the whole process group of `process`, kill it if it does not
+    exit within `grace_period` seconds.
+    """
+    if process.returncode is not None:
+        return
+
+    _kill_process_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), grace_period)
+    except asyncio.TimeoutError:
+        warning("Process group %d did not exit in %d s, killing it", process.pid, grace_period)
+        _kill_process_group(process, signal.SIGKILL)
+        await process.wait()
+
+
+async def run_command(args, env=None, output=None, log_file=None, hooks=(), timeout=None):
+    """
+    Asyncio counterpart of bcontroller.run_command. Output lines are passed
+    to all `hooks` as soon as they are read.
+    """
+    debug("Running CMD (async): %s", args)
+    if output is None:
+        output = SpillBuffer()
+
+    stderr_output = TailBuffer()
+    tee = _OutputTee(output, stderr_output, log_file)
+
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env,
+        start_new_session=True,
+    )
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _drain(process.stdout, STDOUT, tee, hooks),
+                _drain(process.stderr, STDERR, tee, hooks),
+                process.wait(),
+            ),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        await asyncio.shield(terminate(process))
+        raise BControlTimeout("Program [$ %s]" % " ".join(args), time.monotonic() - start)
+    except BaseException:
+        # Cancelled or a hook failed
+        await asyncio.shield(terminate(process))
+        raise
+    finally:
+        tee.close()
+
+    if process.returncode != 0:
+        raise BControlCommandError(
+            args,
+            process,
+            output.getvalue(),
+            stderr_output.getvalue(),
+        )
+
+    return output.getvalue(), process
+
+
+async def git(args, work_dir=os.getcwd()):
+    return await run_command(_git_args(args, work_dir))
+
+
+async def _run_ansible(args):
+    events = AnsibleEvents(fail_fast=True)
+    try:
+        _, process = await run_command(args, output=TailBuffer(), hooks=[events.hook])
+    except BControlCommandError as e:
+        raise _ansible_error(e, events)
+
+    return events.dumps(), process
+
+
+async def ansible(module_name, limit, params=""):
+    return await _run_ansible(_ansible_args(module_name, limit, params))
+
+
+async def ansible_playbook(playbook, limit, **argv):
+    return await _run_ansible(_ansible_playbook_args(playbook, limit, **argv))
+
+
+async def build(git_tree, make_opts, jobs, cc, rpmbuild_topdir, oldconfig, log_file=None, artifact=ARTIFACT_RPM):
+    """
+    Asyncio counterpart of bcontroller.build.
+    """
+    modified_env = _build_env(cc)
+
+    if oldconfig:
+        await run_command(_oldconfig_args(git_tree), env=modified_env, log_file=log_file)
+
+    packages = {}
+    _, process = await run_command(
+        _build_args(git_tree, make_opts, jobs, rpmbuild_topdir, artifact),
+        env=modified_env,
+        output=TailBuffer(),
+        log_file=log_file,
+        hooks=_build_hooks(packages),
+    )
+
+    if artifact == ARTIFACT_TARBALL:
+        out, _ = await run_command(_kernel_release_args(git_tree))
+        _collect_tarball(git_tree, out.strip(), rpmbuild_topdir, packages)
+
+    return _build_manifest(packages), process
@@ -0,0 +1,283 @@
+"""
+Boot-readiness prober of rebooting DUTs.
+
+The Ansible reboot module polls the connection coarsely and, with the linear
+strategy, the play continues only when the slowest DUT is back. With the
+prober, playbooks only trigger the reboot and wait on a FIFO of the DUT (see
+playbooks/tasks/reboot.yml), while bcontrol watches all rebooting DUTs
+concurrently in one asyncio loop running in a background thread:
+
+1. the SSH port stops answering (the DUT went down),
+2. the SSH port accepts connections again and sends the SSH banner,
+3. the boot ID (/proc/sys/kernel/random/boot_id) differs from the one read
+   before the reboot.
+
+Every probe is repeated with a tight exponential backoff. As soon as a DUT is
+ready, its FIFO is written, which releases the DUT into the next task (with
+the free strategy, without waiting for the other DUTs). The FIFO carries the
+boot durations of the DUT, which are logged and recorded by the result hook
+of the playbook (see bcontroller._RebootTimes).
+"""
+import asyncio
+import collections
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+from logging import debug, info, warning
+
+from . import BControlCommandError, BControlTimeout
+from .aio import run_command
+from .inventory import load_inventory
+from .sshpool import SSHPool
+
+
+DEFAULT_SSH_PORT = 22
+
+# Delays between probes of one DUT (seconds)
+BACKOFF_MIN = 0.05
+BACKOFF_MAX = 1.0
+BACKOFF_FACTOR = 1.5
+
+# How long one probe (TCP connect and banner, or boot ID) may take
+_PROBE_TIMEOUT = 2
+_BOOT_ID_TIMEOUT = 10
+
+_BOOT_ID_COMMAND = "cat /proc/sys/kernel/random/boot_id"
+
+# Playbook tasks the prober follows (see playbooks/tasks/reboot.yml)
+_BOOT_ID_TASK = "Read boot ID before reboot"
+_TRIGGER_TASK = "Trigger reboot for boot probe"
+
+# Seconds since the reboot was triggered: the SSH port stopped answering (None
+# when it was never seen down), the banner came back, the boot ID changed
+BootTimes = collections.namedtuple("BootTimes", [
+    "down",
+    "banner",
+    "ready",
+])
+
+
+def _backoff():
+    delay = BACKOFF_MIN
+    while True:
+        yield delay
+        delay = min(delay * BACKOFF_FACTOR, BACKOFF_MAX)
+
+
+async def read_banner(address, port, timeout=_PROBE_TIMEOUT):
+    """
+    Return the SSH banner sent by `address`:`port`, None when it does not
+    accept connections or does not send a banner in `timeout` seconds.
+    """
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+        line = await asyncio.wait_for(reader.readline(), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+
+    banner = line.decode("ascii", "replace").strip()
+    return banner if banner.startswith("SSH-") else None
+
+
+def format_status(method, times):
+    """
+    Return the FIFO message of a DUT which booted by `method` in `times`.
+    """
+    status = "ready %s %.2f banner=%.2f" % (method, times.ready, times.banner)
+    if times.down is not None:
+        status += " down=%.2f" % times.down
+
+    return status
+
+
+def parse_status(status):
+    """
+    Return the method and BootTimes of the FIFO message `status`, None when
+    the DUT did not boot.
+    """
+    fields = status.split()
+    if len(fields) < 3 or fields[0] != "ready":
+        return None
+
+    values = dict(field.split("=", 1) for field in fields[3:] if "=" in field)
+    return fields[1], BootTimes(
+        down=float(values["down"]) if "down" in values else None,
+        banner=float(values.get("banner", fields[2])),
+        ready=float(fields[2]),
+    )
+
+
+class BootWaiter:
+    """
+    Wait for DUTs of the `inventory` to come back after reboot (coroutines
+    for any event loop). Boot IDs are read through `ssh_pool`, or by plain
+    ssh.
+    """
+
+    def __init__(self, ssh_pool=None, inventory=None):
+        self.inventory = inventory or load_inventory()
+        self.ssh_pool = ssh_pool
+        self._ssh = ssh_pool or SSHPool([], inventory=self.inventory)
+
+    async def boot_id(self, host):
+        """
+        Return the boot ID of the `host`, None when it cannot be read.
+        """
+        args, env = self._ssh.command(host, _BOOT_ID_COMMAND)
+        try:
+            out, _ = await run_command(args, env=env, timeout=_BOOT_ID_TIMEOUT)
+        except (BControlCommandError, BControlTimeout):
+            return None
+
+        return out.strip() or None
+
+    async def wait(self, host, old_boot_id, timeout):
+        """
+        Wait until the `host` rebooted (its boot ID is not `old_boot_id`
+        any more) and return its BootTimes. Raises BControlTimeout when it
+        does not happen in `timeout` seconds.
+        """
+        address = self.inventory.address(host)
+        port = int(self.inventory.port(host) or DEFAULT_SSH_PORT)
+        start = time.monotonic()
+
+        async def pause(delays, what):
+            elapsed = time.monotonic() - start
+            if elapsed > timeout:
+                raise BControlTimeout("Boot of %s (%s)" % (host, what), elapsed)
+
+            await asyncio.sleep(next(delays))
+
+        down = None
+        delays = _backoff()
+        while True:
+            if await read_banner(address, port) is None:
+                down = time.monotonic() - start
+                debug("boot: %s: down in %.2f s", host, down)
+                break
+
+            # The down window can be too short to be noticed (e.g. kexec)
+            if time.monotonic() - start > BACKOFF_MAX and await self.boot_id(host) not in (None, old_boot_id):
+                break
+
+            await pause(delays, "shutdown")
+
+        banner = None
+        delays = _backoff()
+        while banner is None:
+            if await read_banner(address, port) is not None:
+                banner = time.monotonic() - start
+                debug("boot: %s: SSH banner in %.2f s", host, banner)
+                break
+
+            await pause(delays, "SSH banner")
+
+        delays = _backoff()
+        while True:
+            boot_id = await self.boot_id(host)
+            if boot_id not in (None, old_boot_id):
+                break
+
+            await pause(delays, "boot ID")
+
+        return BootTimes(down=down, banner=banner, ready=time.monotonic() - start)
+
+
+class BootProber(BootWaiter):
+    """
+    Watch DUTs come back after reboot triggered by playbooks, see module
+    documentation. Masters of `ssh_pool` are re-established as soon as a DUT
+    is ready.
+    """
+
+    def __init__(self, ssh_pool=None, inventory=None):
+        super().__init__(ssh_pool, inventory)
+        self.dir = tempfile.mkdtemp(prefix="bcontrol-boot-")
+        # host -> BootTimes of its last boot
+        self.times = {}
+        self._boot_ids = {}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def fifo(self, host):
+        return os.path.join(self.dir, host)
+
+    def _prepare(self, host):
+        # The playbook creates it too when it comes first
+        try:
+            os.mkfifo(self.fifo(host), 0o600)
+        except FileExistsError:
+            pass
+
+    async def _release(self, host, status, timeout):
+        """
+        Write `status` into the FIFO of the `host` once the playbook reads
+        it.
+        """
+        start = time.monotonic()
+        while True:
+            try:
+                fd = os.open(self.fifo(host), os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                # No reader yet
+                if e.errno != errno.ENXIO or time.monotonic() - start > timeout:
+                    warning("boot: %s: cannot release the host: %s", host, e)
+                    return
+
+            await asyncio.sleep(BACKOFF_MIN)
+
+        try:
+            os.write(fd, (status + "\n").encode())
+        finally:
+            os.close(fd)
+
+    async def _watch(self, host, old_boot_id, method, timeout):
+        try:
+            times = await self.wait(host, old_boot_id, timeout)
+        except BControlTimeout as e:
+            warning("boot: %s", e.message)
+            status = "timeout %s" % e.message
+        else:
+            self.times[host] = times
+            info("boot: %s ready in %.2f s (SSH banner in %.2f s)", host, times.ready, times.banner)
+            status = format_status(method, times)
+            if self.ssh_pool is not None:
+                await self._loop.run_in_executor(None, self.ssh_pool.ensure_host, host)
+
+        await self._release(host, status, timeout)
+
+    def hook(self, method, timeout, on_result=None):
+        """
+        Return result hook for ansible_playbook() which starts watching every
+        DUT as soon as it triggered the reboot (by `method`), then passes the
+        results to `on_result`.
+        """
+        def _hook(task_name, host, result):
+            ok = not (result.get("failed") or result.get("skipped") or result.get("unreachable"))
+            if task_name == _BOOT_ID_TASK and ok:
+                self._boot_ids[host] = result.get("stdout", "").strip()
+                self._prepare(host)
+            elif task_name == _TRIGGER_TASK and ok:
+                asyncio.run_coroutine_threadsafe(
+                    self._watch(host, self._boot_ids.get(host), method, timeout),
+                    self._loop,
+                )
+
+            if on_result is not None:
+                on_result(task_name, host, result)
+
+        return _hook
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,222 @@
+"""
+Persistent cache of built kernel packages.
+
+Bisects of the same regression window build the same trees again and again.
+Every build is keyed by what determines its output:
+
+* the tree of the commit (git rev-parse HEAD^{tree}, so the same sources
+  under a different commit hit too),
+* the kernel configuration (.config before oldconfig, which is deterministic
+  for the tree),
+* the compiler (CC and its version) and the make options,
+* the artifact format (see bcontroller.ARTIFACT_FORMATS).
+
+Trees with uncommitted changes are never cached. Packages of every build are
+kept in their own directory of the cache together with the manifest
+(manifest.json) and are used from there, a hit is answered without running
+make at all. The manifest also records the kernel release of the build: the
+same tree checked out as another commit has another release with
+CONFIG_LOCALVERSION_AUTO, but the cached kernel reports the one it was built
+with (see release()). The cache is bounded by size, the least recently used builds are
+evicted first (the mtime of the manifest is the time of the last use).
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from logging import debug, info, warning
+
+from . import BControlCommandError, BuildManifest, git
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "bcontrol",
+    "builds",
+)
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+
+_MANIFEST = "manifest.json"
+
+# Compilers whose version was already asked for
+_CC_VERSIONS = {}
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _cc_version(cc):
+    if cc not in _CC_VERSIONS:
+        try:
+            out = subprocess.run([cc, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 check=True, universal_newlines=True).stdout
+            _CC_VERSIONS[cc] = out.splitlines()[0] if out else ""
+        except (OSError, subprocess.CalledProcessError):
+            _CC_VERSIONS[cc] = ""
+
+    return _CC_VERSIONS[cc]
+
+
+class BuildCache:
+    """
+    Kernel packages built before, stored in `path` up to `max_size` bytes,
+    see module documentation.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, git_tree, make_opts, cc, artifact):
+        """
+        Return the key of the build of `git_tree`, None when the tree cannot
+        be cached (uncommitted changes, no configuration).
+        """
+        try:
+            out, _ = git(["rev-parse", "HEAD^{tree}"], work_dir=git_tree)
+            git(["diff-index", "--quiet", "HEAD", "--"], work_dir=git_tree)
+        except BControlCommandError:
+            debug("build cache: %s has uncommitted changes", git_tree)
+            return None
+
+        try:
+            config_hash = _file_hash(os.path.join(git_tree, ".config"))
+        except OSError:
+            return None
+
+        cc = cc or os.environ.get("CC") or "gcc"
+        parts = {
+            "tree": out.strip(),
+            "config": config_hash,
+            "cc": cc,
+            "cc_version": _cc_version(cc),
+            "make_opts": make_opts or "",
+            "artifact": artifact,
+        }
+        debug("build cache: key of %s: %s", git_tree, parts)
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """
+        Return BuildManifest of the cached build of `key`, None on miss.
+        """
+        manifest_path = os.path.join(self._entry(key), _MANIFEST)
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                entry = json.load(f)
+            packages = entry["packages"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if not entry.get("release"):
+            debug("build cache: entry %s has no kernel release, ignoring it", key)
+            return None
+
+        packages = {field: os.path.join(self._entry(key), name) for field, name in packages.items()}
+        if not all(os.path.exists(pkg_path) for pkg_path in packages.values()):
+            warning("build cache: incomplete entry %s, ignoring it", key)
+            return None
+
+        # Most recently used
+        os.utime(manifest_path)
+        return BuildManifest(**{field: packages.get(field) for field in BuildManifest._fields})
+
+    def put(self, key, manifest, release):
+        """
+        Move packages of the `manifest` (kernel `release`) into the cache
+        under `key` and return the manifest of the cached packages.
+        """
+        packages = {field: pkg_path for field, pkg_path in manifest._asdict().items() if pkg_path}
+        os.makedirs(self.path, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+        try:
+            size = 0
+            for pkg_path in packages.values():
+                cached_path = os.path.join(tmp_dir, os.path.basename(pkg_path))
+                shutil.move(pkg_path, cached_path)
+                size += os.path.getsize(cached_path)
+
+            with open(os.path.join(tmp_dir, _MANIFEST), "w", encoding="utf-8") as f:
+                json.dump({
+                    "packages": {field: os.path.basename(pkg_path) for field, pkg_path in packages.items()},
+                    "release": release,
+                    "size": size,
+                    "created": time.time(),
+                }, f, indent=2)
+
+            # Another build of the same key may have been stored meanwhile
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            os.rename(tmp_dir, self._entry(key))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        info("build cache: stored %s (%.1f MiB)", key, size / 1024 ** 2)
+        self.evict(keep=key)
+        return self.get(key)
+
+    def release(self, pkg_path):
+        """
+        Return kernel release of the cached build the package `pkg_path`
+        belongs to, None when it is not a cached package.
+        """
+        entry_dir = os.path.dirname(os.path.abspath(pkg_path))
+        if os.path.dirname(entry_dir) != os.path.abspath(self.path):
+            return None
+
+        try:
+            with open(os.path.join(entry_dir, _MANIFEST), encoding="utf-8") as f:
+                return json.load(f).get("release")
+        except (OSError, ValueError):
+            return None
+
+    def entries(self):
+        """
+        Return (mtime of last use, size, key) of all cached builds.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return entries
+
+        for key in names:
+            manifest_path = os.path.join(self._entry(key), _MANIFEST)
+            try:
+                with open(manifest_path, encoding="utf-8") as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.getmtime(manifest_path), size, key))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used builds (except `keep`) until the cache
+        fits into max_size.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+
+            if key == keep:
+                continue
+
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+            info("build cache: evicted %s (%.1f MiB)", key, size / 1024 ** 2)
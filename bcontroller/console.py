@@ -0,0 +1,289 @@
+"""
+Capture of DUT consoles with panic detection.
+
+Console of every DUT is given by its bcontrol_console inventory variable:
+
+    host1.example.com bcontrol_console=netconsole
+    host2.example.com bcontrol_console=/dev/ttyUSB0@115200
+
+"netconsole" is the kernel netconsole sending to UDP port
+DEFAULT_NETCONSOLE_PORT of the controller (e.g.
+netconsole=@/,6666@192.168.1.10/ on the kernel command line), matched to the
+DUT by the source address ("netconsole:ADDRESS" when the DUT sends from
+another address than its inventory one). Anything else is a serial line (or
+a pty, e.g. a console of a virtual machine) with an optional baud rate.
+
+All consoles are read by one thread, every line is appended to the log of
+the DUT (DEFAULT_LOG_DIR/<host>.log). Lines of watched DUTs are scanned for
+kernel panics (PANIC_PATTERN); the watcher is called with the panic and the
+tail of the console log once the trace is printed (the console stays quiet
+for PANIC_GRACE seconds).
+"""
+import collections
+import os
+import re
+import selectors
+import socket
+import tempfile
+import termios
+import threading
+import time
+import tty
+from logging import debug, info, warning
+
+from . import BControlError
+from .inventory import load_inventory
+from .stream import LineDecoder, TailBuffer
+
+
+CONSOLE_NETCONSOLE = "netconsole"
+
+DEFAULT_NETCONSOLE_PORT = 6666
+DEFAULT_LOG_DIR = os.path.join(tempfile.gettempdir(), "bcontrol-console")
+
+PANIC_PATTERN = re.compile(r"Kernel panic|Oops|BUG:")
+
+# Quiet period after the panic line which ends its trace (seconds)
+PANIC_GRACE = 2.0
+
+# Console log attached to the panic
+_PANIC_LOG_SIZE = 64 * 1024
+
+_BAUD_RATES = {
+    9600: termios.B9600,
+    19200: termios.B19200,
+    38400: termios.B38400,
+    57600: termios.B57600,
+    115200: termios.B115200,
+}
+
+Panic = collections.namedtuple("Panic", [
+    "host",
+    # The console line which matched PANIC_PATTERN
+    "line",
+    # Tail of the console log including the trace
+    "log",
+    # Path of the whole console log
+    "log_path",
+])
+
+
+def _serial_spec(spec):
+    path, _, baud = spec.partition("@")
+    if baud and int(baud) not in _BAUD_RATES:
+        raise BControlError("console: unsupported baud rate of %s" % spec)
+
+    return path, int(baud) if baud else None
+
+
+class _Console:
+    """
+    Console log of one DUT and its panic detection state.
+    """
+
+    def __init__(self, host, log_dir):
+        self.host = host
+        self.log_path = os.path.join(log_dir, "%s.log" % host)
+        self.tail = TailBuffer(_PANIC_LOG_SIZE)
+        self.decoder = LineDecoder()
+        self.watcher = None
+        # The panic line and when its trace is considered complete
+        self.panic = None
+        self.panic_deadline = None
+        self._log = open(self.log_path, "a", encoding="utf-8")
+
+    def feed(self, chunk):
+        for line in self.decoder.decode(chunk):
+            # Serial consoles end lines with CR LF
+            line = line.rstrip("\r\n") + "\n"
+            self.tail.write(line)
+            self._log.write(line)
+            if self.watcher is None:
+                continue
+
+            if self.panic is None and PANIC_PATTERN.search(line):
+                self.panic = line.strip()
+                warning("console: %s: %s", self.host, self.panic)
+
+            if self.panic is not None:
+                self.panic_deadline = time.monotonic() + PANIC_GRACE
+
+        self._log.flush()
+
+    def close(self):
+        self._log.close()
+
+
+class ConsoleMonitor:
+    """
+    Read consoles of DUTs (mapping host -> console, see module documentation)
+    in a background thread. Call watch() to get notified about panics of a
+    DUT.
+    """
+
+    def __init__(self, consoles, netconsole_port=DEFAULT_NETCONSOLE_PORT, log_dir=DEFAULT_LOG_DIR, inventory=None):
+        self.consoles = dict(consoles)
+        self.netconsole_port = netconsole_port
+        self.log_dir = log_dir
+        self.inventory = inventory
+        self._hosts = {}
+        self._serial = {}
+        self._netconsole = None
+        self._netconsole_hosts = {}
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._thread = None
+        self._stop = False
+
+    def _open_serial(self, host, spec):
+        path, baud = _serial_spec(spec)
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        if os.isatty(fd):
+            tty.setraw(fd)
+            if baud is not None:
+                attrs = termios.tcgetattr(fd)
+                attrs[4] = attrs[5] = _BAUD_RATES[baud]
+                termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+        self._serial[host] = fd
+        self._selector.register(fd, selectors.EVENT_READ, host)
+
+    def _open_netconsole(self, host, spec):
+        _, _, address = spec.partition(":")
+        if not address:
+            address = (self.inventory or load_inventory()).address(host)
+
+        self._netconsole_hosts[socket.gethostbyname(address)] = host
+        if self._netconsole is None:
+            self._netconsole = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._netconsole.bind(("", self.netconsole_port))
+            self._netconsole.setblocking(False)
+            self._selector.register(self._netconsole, selectors.EVENT_READ, None)
+
+    def start(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        for host, spec in self.consoles.items():
+            self._hosts[host] = _Console(host, self.log_dir)
+            try:
+                if spec == CONSOLE_NETCONSOLE or spec.startswith(CONSOLE_NETCONSOLE + ":"):
+                    self._open_netconsole(host, spec)
+                else:
+                    self._open_serial(host, spec)
+            except OSError as e:
+                raise BControlError("console: cannot open console %s of %s: %s" % (spec, host, e))
+
+            debug("console: %s: %s", host, spec)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        info("console: capturing %d consoles into %s", len(self._hosts), self.log_dir)
+
+    def _read(self, key):
+        if key.data is not None:
+            try:
+                chunk = os.read(key.fd, 4096)
+            except BlockingIOError:
+                return
+            except OSError:
+                # e.g. EIO when the other side of a pty is closed
+                chunk = b""
+
+            if not chunk:
+                warning("console: %s: console closed", key.data)
+                self._selector.unregister(key.fd)
+
+            return key.data, chunk
+
+        chunk, (address, _) = self._netconsole.recvfrom(65536)
+        host = self._netconsole_hosts.get(address)
+        if host is None:
+            debug("console: netconsole message from unknown %s", address)
+            return
+
+        return host, chunk
+
+    def _run(self):
+        while not self._stop:
+            now = time.monotonic()
+            deadlines = [console.panic_deadline for console in self._hosts.values() if console.panic_deadline]
+            timeout = max(min(deadlines) - now, 0) if deadlines else 1.0
+
+            for key, _ in self._selector.select(timeout):
+                read = self._read(key)
+                if read:
+                    with self._lock:
+                        self._hosts[read[0]].feed(read[1])
+
+            self._fire(time.monotonic())
+
+    def _fire(self, now):
+        fired = []
+        with self._lock:
+            for console in self._hosts.values():
+                if console.panic_deadline is None or console.panic_deadline > now:
+                    continue
+
+                panic = Panic(console.host, console.panic, console.tail.getvalue(), console.log_path)
+                fired.append((console.watcher, panic))
+                console.watcher = console.panic = console.panic_deadline = None
+
+        for watcher, panic in fired:
+            try:
+                watcher(panic)
+            except Exception as e:
+                warning("console: %s: panic watcher failed: %s", panic.host, e)
+
+    def watch(self, host, watcher):
+        """
+        Call `watcher` with Panic when the `host` panics, only once. DUTs
+        without a console are ignored.
+        """
+        with self._lock:
+            console = self._hosts.get(host)
+            if console is not None:
+                console.watcher = watcher
+                console.panic = console.panic_deadline = None
+
+    def unwatch(self, host):
+        with self._lock:
+            console = self._hosts.get(host)
+            if console is not None:
+                console.watcher = console.panic = console.panic_deadline = None
+
+    def recover(self, host):
+        """
+        Reset the panicked `host`: by magic SysRq "b" on a serial console
+        (break, then the key), a DUT with netconsole resets itself (panic=10
+        on the kernel command line). Returns True if the reset was sent.
+        """
+        fd = self._serial.get(host)
+        if fd is None:
+            info("console: %s: waiting for the DUT to reset itself after panic", host)
+            return False
+
+        try:
+            if os.isatty(fd):
+                termios.tcsendbreak(fd, 0)
+
+            os.write(fd, b"b")
+        except OSError as e:
+            warning("console: %s: cannot send SysRq reset: %s", host, e)
+            return False
+
+        info("console: %s: SysRq reset sent", host)
+        return True
+
+    def close(self):
+        self._stop = True
+        if self._thread is not None:
+            self._thread.join()
+
+        self._selector.close()
+        for fd in self._serial.values():
+            os.close(fd)
+
+        if self._netconsole is not None:
+            self._netconsole.close()
+
+        for console in self._hosts.values():
+            console.close()
@@ -0,0 +1,323 @@
+"""
+bcontrol DUT agent.
+
+This file is pushed to DUTs and runs there (see bcontroller.agent), so it must
+not import anything from bcontroller and has to work with the system python3
+of all supported distros.
+
+The agent serves requests read from its standard input and writes responses
+into its standard output, both carried by the SSH channel. Every frame is:
+
+    <header length: 4 bytes, big-endian><data length: 4 bytes, big-endian>
+    <header: JSON object><data: raw bytes>
+
+Requests are processed one at a time. Supported operations (header "op"):
+
+    ping     -> {"boot_id", "pid"}
+    exec     -> stream of {"event": "stdout"|"stderr"} frames with the output
+                in data, finished by {"event": "exit", "rc"}
+    has      -> {"present"}: those of "sha256s" which are in the content store
+    put      -> data frames with the file content follow ("op": "chunk"),
+                terminated by an empty chunk; stores the file by its "sha256",
+                then evicts least recently used files until the store fits
+                into "cap" bytes (if given) -> {"evicted"}
+    link     -> make a copy (a reflink where the filesystem supports it) of
+                stored file "sha256" available as "dest" (with "mode")
+    serve    -> serve the content store over HTTP on "port" (0 picks a free
+                one) to other DUTs -> {"port"}
+    unserve  -> stop serving the content store
+    fetch    -> download "url" into the content store as "sha256" (evicting
+                over "cap" as put does) -> {"size", "seconds", "evicted"}
+
+Every response carries "ok" (and "error" when it is false).
+"""
+import fcntl
+import hashlib
+import http.server
+import json
+import os
+import selectors
+import shutil
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+
+STORE_DIR = "/var/cache/bcontrol/store"
+CHUNK_SIZE = 256 * 1024
+# ioctl cloning a file on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+_HEADER = struct.Struct(">II")
+
+
+def read_frame(stream):
+    prefix = stream.read(_HEADER.size)
+    if len(prefix) < _HEADER.size:
+        return None, None
+
+    header_len, data_len = _HEADER.unpack(prefix)
+    header = json.loads(stream.read(header_len).decode("utf-8"))
+    data = stream.read(data_len) if data_len else b""
+    return header, data
+
+
+def write_frame(stream, header, data=b""):
+    encoded = json.dumps(header).encode("utf-8")
+    stream.write(_HEADER.pack(len(encoded), len(data)) + encoded + data)
+    stream.flush()
+
+
+def boot_id():
+    with open("/proc/sys/kernel/random/boot_id") as f:
+        return f.read().strip()
+
+
+def store_path(sha256):
+    return os.path.join(STORE_DIR, sha256)
+
+
+def op_ping(req, data, stdin, stdout):
+    write_frame(stdout, {"ok": True, "boot_id": boot_id(), "pid": os.getpid()})
+
+
+def op_exec(req, data, stdin, stdout):
+    process = subprocess.Popen(
+        req["args"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=req.get("cwd"),
+        env=dict(os.environ, **req.get("env", {})),
+    )
+
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+    selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+    while selector.get_map():
+        for key, _ in selector.select():
+            chunk = os.read(key.fileobj.fileno(), CHUNK_SIZE)
+            if not chunk:
+                selector.unregister(key.fileobj)
+                continue
+
+            write_frame(stdout, {"ok": True, "event": key.data}, chunk)
+
+    write_frame(stdout, {"ok": True, "event": "exit", "rc": process.wait()})
+
+
+def touch(sha256):
+    # Keep LRU order of the store
+    os.utime(store_path(sha256))
+
+
+def evict(cap, keep=()):
+    """
+    Remove least recently used files from the store until it fits into `cap`
+    bytes. The files with sha256 in `keep` are never removed.
+    """
+    entries = []
+    for name in os.listdir(STORE_DIR):
+        # Skip unfinished uploads
+        if len(name) != 64:
+            continue
+
+        st = os.stat(store_path(name))
+        entries.append((st.st_mtime, name, st.st_size))
+
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, name, size in sorted(entries):
+        if total <= cap:
+            break
+
+        if name in keep:
+            continue
+
+        os.unlink(store_path(name))
+        total -= size
+        evicted.append(name)
+
+    return evicted
+
+
+def op_has(req, data, stdin, stdout):
+    present = []
+    for sha256 in req["sha256s"]:
+        if os.path.exists(store_path(sha256)):
+            touch(sha256)
+            present.append(sha256)
+
+    write_frame(stdout, {"ok": True, "present": present})
+
+
+def _chunks(stdin):
+    """
+    Yield data of the chunk frames which follow a put, up to the terminating
+    empty chunk.
+    """
+    while True:
+        header, chunk = read_frame(stdin)
+        if header is None or not chunk:
+            return
+
+        yield chunk
+
+
+def op_put(req, data, stdin, stdout):
+    chunks = _chunks(stdin)
+    digest = hashlib.sha256()
+    f = None
+    try:
+        os.makedirs(STORE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=STORE_DIR, delete=False) as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+
+        if digest.hexdigest() != req["sha256"]:
+            os.unlink(f.name)
+            write_frame(stdout, {"ok": False, "error": "checksum mismatch"})
+            return
+
+        os.rename(f.name, store_path(req["sha256"]))
+    except Exception:
+        # The rest of the upload must not be read as requests
+        for _ in chunks:
+            pass
+
+        if f is not None and os.path.lexists(f.name):
+            os.unlink(f.name)
+
+        raise
+
+    evicted = []
+    if req.get("cap"):
+        evicted = evict(req["cap"], keep={req["sha256"]} | set(req.get("keep", ())))
+
+    write_frame(stdout, {"ok": True, "evicted": evicted})
+
+
+class StoreHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serve files of the content store by their sha256, e.g. GET /<sha256>.
+    """
+
+    def translate_path(self, path):
+        return store_path(os.path.basename(path.split("?", 1)[0]))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StoreServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+_SERVER = None
+
+
+def op_serve(req, data, stdin, stdout):
+    global _SERVER
+    if _SERVER is None:
+        os.makedirs(STORE_DIR, exist_ok=True)
+        _SERVER = StoreServer(("", req.get("port", 0)), StoreHandler)
+        threading.Thread(target=_SERVER.serve_forever, daemon=True).start()
+
+    write_frame(stdout, {"ok": True, "port": _SERVER.server_address[1]})
+
+
+def op_unserve(req, data, stdin, stdout):
+    global _SERVER
+    if _SERVER is not None:
+        _SERVER.shutdown()
+        _SERVER.server_close()
+        _SERVER = None
+
+    write_frame(stdout, {"ok": True})
+
+
+def op_fetch(req, data, stdin, stdout):
+    os.makedirs(STORE_DIR, exist_ok=True)
+    start = time.monotonic()
+    digest = hashlib.sha256()
+    size = 0
+    f = None
+    try:
+        with urllib.request.urlopen(req["url"], timeout=req.get("timeout", 60)) as response:
+            with tempfile.NamedTemporaryFile(dir=STORE_DIR, delete=False) as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+        if digest.hexdigest() != req["sha256"]:
+            os.unlink(f.name)
+            write_frame(stdout, {"ok": False, "error": "checksum mismatch"})
+            return
+
+        os.rename(f.name, store_path(req["sha256"]))
+    except Exception:
+        if f is not None and os.path.lexists(f.name):
+            os.unlink(f.name)
+
+        raise
+
+    evicted = []
+    if req.get("cap"):
+        evicted = evict(req["cap"], keep={req["sha256"]} | set(req.get("keep", ())))
+
+    write_frame(stdout, {"ok": True, "size": size, "seconds": time.monotonic() - start, "evicted": evicted})
+
+
+def op_link(req, data, stdin, stdout):
+    dest = req["dest"]
+    tmp_dest = dest + ".bcontrol-tmp"
+    if os.path.lexists(tmp_dest):
+        os.unlink(tmp_dest)
+
+    touch(req["sha256"])
+    # Not a hard link: evicting the store entry has to free its space and
+    # the mode of dest must not change the stored file
+    with open(store_path(req["sha256"]), "rb") as src, open(tmp_dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    os.chmod(tmp_dest, req.get("mode", 0o644))
+    os.rename(tmp_dest, dest)
+    write_frame(stdout, {"ok": True})
+
+
+OPERATIONS = {
+    "ping": op_ping,
+    "exec": op_exec,
+    "has": op_has,
+    "put": op_put,
+    "link": op_link,
+    "serve": op_serve,
+    "unserve": op_unserve,
+    "fetch": op_fetch,
+}
+
+
+def serve(stdin, stdout):
+    while True:
+        req, data = read_frame(stdin)
+        if req is None:
+            return
+
+        try:
+            OPERATIONS[req["op"]](req, data, stdin, stdout)
+        except Exception as e:
+            write_frame(stdout, {"ok": False, "error": "%s: %s" % (type(e).__name__, e)})
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer)
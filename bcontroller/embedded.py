@@ -0,0 +1,226 @@
+"""
+In-process Ansible runner.
+
+Every `ansible` and `ansible-playbook` process imports Ansible, parses the
+inventory and ansible.cfg and loads plugins again before it even opens an SSH
+connection. EmbeddedRunner drives Ansible's Python API inside the bcontrol
+process instead, so the loaded inventory, variable manager and plugin state
+are reused by all calls.
+
+Events of the bcontrol_ndjson callback are passed to AnsibleEvents directly
+(without serialization to the standard output), so the callers get the same
+result document as from the ansible commands.
+"""
+import threading
+from logging import debug, warning
+
+from . import AnsibleEvents, BControlTimeout, CompletedRun, _ansible_failure, _ansible_timeout
+
+from ansible import constants as C
+from ansible import context
+from ansible.executor.playbook_executor import PlaybookExecutor
+from ansible.executor.task_queue_manager import TaskQueueManager
+from ansible.inventory.manager import InventoryManager
+from ansible.module_utils.common.collections import ImmutableDict
+from ansible.parsing.dataloader import DataLoader
+from ansible.playbook.play import Play
+from ansible.plugins.loader import callback_loader
+from ansible.utils.vars import load_extra_vars
+from ansible.vars.manager import VariableManager
+
+try:
+    from ansible.plugins.loader import init_plugin_loader
+except ImportError:  # ansible < 2.15
+    init_plugin_loader = None
+
+
+# Exit codes of the ansible commands
+_RC_OK = 0
+_RC_HOST_FAILED = 2
+_RC_HOST_UNREACHABLE = 4
+
+
+class _EventSink:
+    """
+    Feed events of the bcontrol_ndjson callback straight into AnsibleEvents.
+    Exceptions raised from callbacks are swallowed by Ansible, so the error
+    (e.g. the fail fast one) is kept and the run is terminated instead. Note
+    that tasks already running are not interrupted.
+    """
+
+    def __init__(self, tqm, events):
+        self.tqm = tqm
+        self.events = events
+        self.error = None
+
+    def __call__(self, event):
+        if self.error is not None:
+            return
+
+        try:
+            self.events.feed(event)
+        except Exception as e:
+            self.error = e
+            self.tqm.terminate()
+
+
+class EmbeddedRunner:
+    """
+    Long-lived Ansible runner. Create it once per bcontrol process and call
+    its `ansible` and `ansible_playbook` methods instead of the functions
+    with the same names from bcontroller.
+    """
+
+    def __init__(self, inventory=None):
+        if init_plugin_loader is not None:
+            init_plugin_loader()
+
+        context.CLIARGS = ImmutableDict(
+            connection=C.DEFAULT_TRANSPORT,
+            module_path=None,
+            forks=C.DEFAULT_FORKS,
+            become=None,
+            become_method=None,
+            become_user=None,
+            check=False,
+            diff=False,
+            verbosity=0,
+            syntax=None,
+            start_at_task=None,
+            listhosts=None,
+            listtasks=None,
+            listtags=None,
+            tags=("all",),
+            skip_tags=(),
+            extra_vars=(),
+        )
+
+        self.loader = DataLoader()
+        self.inventory = InventoryManager(
+            loader=self.loader,
+            sources=inventory or C.DEFAULT_HOST_LIST,
+        )
+        self.variable_manager = VariableManager(
+            loader=self.loader,
+            inventory=self.inventory,
+        )
+        self._base_extra_vars = load_extra_vars(loader=self.loader)
+
+    def _prepare(self, limit, extra_vars=None):
+        self.inventory.remove_restriction()
+        self.inventory.subset(limit)
+        self.variable_manager._extra_vars = dict(self._base_extra_vars, **(extra_vars or {}))
+
+    @staticmethod
+    def _install_callback(tqm, fail_fast, on_result=None):
+        sink = _EventSink(tqm, AnsibleEvents(fail_fast=fail_fast, on_result=on_result))
+        callback = callback_loader.get("bcontrol_ndjson")
+        callback.sink = sink
+        # TaskQueueManager does not load any other callback when some are
+        # already present
+        if hasattr(callback, "_init_callback_methods"):
+            callback._init_callback_methods()
+
+        tqm._callback_plugins = [callback]
+        return sink
+
+    def _run(self, what, run_fnc, tqm, timeout):
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            tqm.terminate()
+
+        watchdog = None
+        if timeout is not None:
+            # Running tasks are not interrupted, no new task is started
+            watchdog = threading.Timer(timeout, expire)
+            watchdog.start()
+
+        try:
+            rc = run_fnc()
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+
+        if expired.is_set():
+            raise BControlTimeout(what, timeout)
+
+        return rc
+
+    def _result(self, args, rc, sink, ignore_failures=False):
+        if sink.error is not None:
+            raise sink.error
+
+        document = sink.events.document()
+        if ignore_failures and rc in (_RC_HOST_FAILED, _RC_HOST_UNREACHABLE):
+            timeout_error = _ansible_timeout(document)
+            if timeout_error is not None:
+                raise timeout_error
+        elif rc != _RC_OK:
+            raise _ansible_failure(document)
+
+        return sink.events.dumps(), CompletedRun(args, rc)
+
+    def ansible(self, module_name, limit, params="", timeout=None):
+        args = ["ansible", "-m", module_name, "--args", params, limit]
+        debug("Running (embedded): %s", args)
+        self._prepare(limit)
+
+        play = Play().load(
+            {
+                "name": "Ansible Ad-Hoc",
+                "hosts": limit,
+                "gather_facts": False,
+                "tasks": [
+                    {module_name: params or None},
+                ],
+            },
+            variable_manager=self.variable_manager,
+            loader=self.loader,
+        )
+
+        tqm = TaskQueueManager(
+            inventory=self.inventory,
+            variable_manager=self.variable_manager,
+            loader=self.loader,
+            passwords={},
+            forks=C.DEFAULT_FORKS,
+        )
+        sink = self._install_callback(tqm, fail_fast=True)
+
+        try:
+            rc = self._run("Ansible module [%s]" % module_name, lambda: tqm.run(play), tqm, timeout)
+            tqm.send_callback("v2_playbook_on_stats", tqm._stats)
+        finally:
+            tqm.cleanup()
+            self.loader.cleanup_all_tmp_files()
+
+        return self._result(args, rc, sink)
+
+    def ansible_playbook(self, playbook, limit, timeout=None, ignore_failures=False, forks=None, on_result=None, **argv):
+        args = ["ansible-playbook", "--limit", limit, playbook]
+        debug("Running (embedded): %s %s", args, argv)
+        self._prepare(limit, argv)
+        # PlaybookExecutor takes the number of forks from the CLI arguments
+        context.CLIARGS = ImmutableDict(context.CLIARGS, forks=forks or C.DEFAULT_FORKS)
+
+        pbex = PlaybookExecutor(
+            playbooks=[playbook],
+            inventory=self.inventory,
+            variable_manager=self.variable_manager,
+            loader=self.loader,
+            passwords={},
+        )
+
+        sink = self._install_callback(pbex._tqm, fail_fast=not ignore_failures, on_result=on_result)
+
+        try:
+            rc = self._run("Ansible playbook [%s]" % playbook, pbex.run, pbex._tqm, timeout)
+        finally:
+            self.loader.cleanup_all_tmp_files()
+
+        if rc not in (_RC_OK, _RC_HOST_FAILED, _RC_HOST_UNREACHABLE):
+            warning("embedded-runner: ansible-playbook finished with unexpected code %d", rc)
+
+        return self._result(args, rc, sink, ignore_failures)
@@ -0,0 +1,159 @@
+"""
+Fan-out distribution of artifacts to DUTs.
+
+The controller sends the artifact only to the first `degree` DUTs. Every DUT
+which has it then serves its content store over HTTP (see
+bcontroller.dut_agent) to its `degree` children in the tree, which download
+it in parallel and relay it further. Distribution to N DUTs takes about
+log_degree(N) transfer times instead of N transfers over the controller
+uplink.
+
+A DUT which cannot download the artifact from its parent gets it from the
+controller directly.
+"""
+import collections
+import concurrent.futures
+import time
+from logging import debug, info, warning
+
+from . import BControlTimeout
+from .agent import BControlAgentError, _sha256
+
+
+DEFAULT_DEGREE = 2
+
+# Port the DUTs serve their content store on (has to be open between DUTs)
+DEFAULT_PORT = 8765
+
+Transfer = collections.namedtuple("Transfer", [
+    "host",
+    # Host the artifact was downloaded from, None for the controller
+    "parent",
+    "size",
+    "seconds",
+])
+
+
+def tree(hosts, degree):
+    """
+    Return mapping parent -> children of the distribution tree of `hosts`.
+    The controller (the root) is None.
+    """
+    nodes = [None] + list(hosts)
+    children = {}
+    for index, node in enumerate(nodes):
+        node_children = nodes[index * degree + 1:(index + 1) * degree + 1]
+        if node_children:
+            children[node] = node_children
+
+    return children
+
+
+def depth(children, node=None):
+    if node not in children:
+        return 0
+
+    return 1 + max(depth(children, child) for child in children[node])
+
+
+class FanOut:
+    """
+    Distribute artifacts to all hosts of the AgentPool `pool` through the
+    tree of the given `degree`.
+    """
+
+    def __init__(self, pool, degree=DEFAULT_DEGREE, port=DEFAULT_PORT):
+        self.pool = pool
+        self.degree = degree
+        self.port = port
+
+    def _put(self, host, path, sha256, timeout):
+        start = time.monotonic()
+        size = self.pool.clients[host].put(path, sha256, cap=self.pool.store_cap, timeout=timeout)
+        return Transfer(host, None, size, time.monotonic() - start)
+
+    def _send(self, parent, host, path, sha256, ports, timeout):
+        if parent is None:
+            return self._put(host, path, sha256, timeout)
+
+        url = "http://%s:%d/%s" % (self.pool.ssh_pool.inventory.address(parent), ports[parent], sha256)
+        try:
+            size, seconds = self.pool.clients[host].fetch(url, sha256, cap=self.pool.store_cap, timeout=timeout)
+        except (BControlAgentError, BControlTimeout) as e:
+            warning("fanout: %s cannot download from %s, sending from controller: %s", host, parent, e.message)
+            return self._put(host, path, sha256, timeout)
+
+        return Transfer(host, parent, size, seconds)
+
+    def distribute(self, path, timeout=None):
+        """
+        Make local file `path` available in the content store of all hosts.
+        Returns its sha256 and list of Transfers, hosts which had the file
+        already are not part of the tree.
+        """
+        sha256 = _sha256(path)
+        clients = self.pool.clients
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(clients), 1)) as executor:
+            absent = dict(zip(clients, executor.map(lambda client: bool(client.missing([sha256])), clients.values())))
+
+        missing = [host for host in self.pool.hosts if absent[host]]
+        children = tree(missing, self.degree)
+        transfers = []
+        ports = {}
+        start = time.monotonic()
+
+        def branch(executor, parent, host):
+            transfers.append(self._send(parent, host, path, sha256, ports, timeout))
+            if host not in children:
+                return
+
+            try:
+                ports[host] = clients[host].serve(self.port)
+            except (BControlAgentError, BControlTimeout) as e:
+                warning("fanout: %s cannot serve, sending to its children from controller: %s", host, e.message)
+                deliver(executor, host, None)
+                return
+
+            deliver(executor, host, host)
+
+        # Children of the tree `node` get the file from `parent`
+        def deliver(executor, node, parent):
+            futures = [executor.submit(branch, executor, parent, child) for child in children.get(node, [])]
+            for future in futures:
+                future.result()
+
+        # Every host is one task which waits only for its children, so the
+        # tasks cannot exhaust the workers
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(missing), 1)) as executor:
+                deliver(executor, None, None)
+        finally:
+            for host in ports:
+                try:
+                    clients[host].unserve()
+                except (BControlAgentError, BControlTimeout):
+                    pass
+
+        elapsed = time.monotonic() - start
+        for transfer in transfers:
+            debug(
+                "fanout: %s <- %s: %d bytes in %.2f s (%.1f MB/s)",
+                transfer.host,
+                transfer.parent or "controller",
+                transfer.size,
+                transfer.seconds,
+                transfer.size / transfer.seconds / 1e6 if transfer.seconds else 0.0,
+            )
+
+        if missing:
+            info(
+                "fanout: %d DUTs in %.2f s (degree %d, depth %d), %d sent by controller, %d DUTs had it already",
+                len(missing),
+                elapsed,
+                self.degree,
+                depth(children),
+                sum(1 for transfer in transfers if transfer.parent is None),
+                len(self.pool.hosts) - len(missing),
+            )
+
+        return sha256, transfers
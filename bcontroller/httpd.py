@@ -0,0 +1,163 @@
+"""
+HTTP server DUTs download kernel packages from.
+
+The server runs in a background thread of the bcontrol process and serves
+only the files which were published (by their base name). Every client is
+handled in its own thread and file bodies are sent with sendfile(2), so the
+data never goes through Python. Single byte ranges are supported, so an
+interrupted download can be resumed (e.g. $ curl -C -).
+"""
+import collections
+import http.server
+import os
+import re
+import socket
+import threading
+import time
+import urllib.parse
+from logging import debug, info
+
+
+DEFAULT_PORT = 8080
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+Download = collections.namedtuple("Download", [
+    "client",
+    "path",
+    "size",
+    "seconds",
+])
+
+
+class _ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        debug("httpd: %s %s", self.client_address[0], format % args)
+
+    def _range(self, size):
+        """
+        Return (start, end) of the requested range (end is exclusive), None
+        for the whole file or raise ValueError if it cannot be satisfied.
+        """
+        header = self.headers.get("Range")
+        if not header:
+            return None
+
+        match = _RANGE_PATTERN.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            # Multiple ranges are not supported, send the whole file
+            return None
+
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the last N bytes
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+
+        if start >= size or start >= end:
+            raise ValueError(header)
+
+        return start, end
+
+    def _send_file(self, send_body):
+        path = self.server.published.get(urllib.parse.unquote(self.path.split("?", 1)[0]).lstrip("/"))
+        if path is None:
+            self.send_error(404)
+            return
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            try:
+                byte_range = self._range(size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            start, end = byte_range or (0, size)
+            if byte_range is None:
+                self.send_response(200)
+            else:
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            if not send_body:
+                return
+
+            begin = time.monotonic()
+            sent = self.connection.sendfile(f, start, end - start)
+            self.server.record(Download(self.client_address[0], path, sent, time.monotonic() - begin))
+
+    def do_GET(self):
+        self._send_file(send_body=True)
+
+    def do_HEAD(self):
+        self._send_file(send_body=False)
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _ArtifactHandler)
+        self.published = {}
+        self.downloads = []
+        self._lock = threading.Lock()
+
+    def record(self, download):
+        with self._lock:
+            self.downloads.append(download)
+
+        info(
+            "httpd: %s downloaded %s: %d bytes in %.2f s (%.1f MB/s)",
+            download.client,
+            os.path.basename(download.path),
+            download.size,
+            download.seconds,
+            download.size / download.seconds / 1e6 if download.seconds else 0.0,
+        )
+
+
+class ArtifactServer:
+    """
+    Serve published files on `port` of all interfaces. `address` is how DUTs
+    reach the controller (its FQDN by default).
+    """
+
+    def __init__(self, address=None, port=DEFAULT_PORT):
+        self.address = address or socket.getfqdn()
+        self._server = _Server(("", port))
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    @property
+    def downloads(self):
+        return list(self._server.downloads)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        info("httpd: serving on port %d, DUTs download from http://%s:%d/", self.port, self.address, self.port)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def publish(self, path):
+        """
+        Make local file `path` available to DUTs, return its URL.
+        """
+        name = os.path.basename(path)
+        self._server.published[name] = os.path.realpath(path)
+        return "http://%s:%d/%s" % (self.address, self.port, urllib.parse.quote(name))
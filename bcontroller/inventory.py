@@ -0,0 +1,69 @@
+"""
+Read-only view of the Ansible inventory (remotes.txt) for the parts of
+bcontrol which talk to DUTs directly, without Ansible.
+"""
+import json
+
+from . import run_command
+
+
+_INVENTORY = None
+
+
+class Inventory:
+    """
+    Parsed output of $ ansible-inventory --list.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._hostvars = data.get("_meta", {}).get("hostvars", {})
+
+    def hosts(self, group):
+        """
+        Return hosts of the `group` (including its child groups) in the
+        inventory order.
+        """
+        group_data = self._data.get(group, {})
+        hosts = list(group_data.get("hosts", []))
+        for child in group_data.get("children", []):
+            hosts += [host for host in self.hosts(child) if host not in hosts]
+
+        return hosts
+
+    def hostvars(self, host):
+        return self._hostvars.get(host, {})
+
+    def address(self, host):
+        return self.hostvars(host).get("ansible_host", host)
+
+    def user(self, host):
+        hostvars = self.hostvars(host)
+        return hostvars.get("ansible_user") or hostvars.get("ansible_ssh_user")
+
+    def port(self, host):
+        return self.hostvars(host).get("ansible_port") or self.hostvars(host).get("ansible_ssh_port")
+
+    def password(self, host):
+        hostvars = self.hostvars(host)
+        return hostvars.get("ansible_ssh_pass") or hostvars.get("ansible_password")
+
+    def console(self, host):
+        """
+        Return console of the `host` (bcontrol_console variable, see
+        bcontroller.console), None if it has none.
+        """
+        return self.hostvars(host).get("bcontrol_console")
+
+
+def load_inventory(reload=False):
+    """
+    Return the inventory Ansible uses (see ansible.cfg). The inventory is
+    loaded only once per process.
+    """
+    global _INVENTORY
+    if _INVENTORY is None or reload:
+        out, _ = run_command(["ansible-inventory", "--list"])
+        _INVENTORY = Inventory(json.loads(out))
+
+    return _INVENTORY
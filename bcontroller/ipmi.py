@@ -0,0 +1,283 @@
+"""
+Out-of-band power control of DUTs through their BMCs (IPMI).
+
+Every DUT is paired with its management host of the duts-mgmt group: the one
+given by its bcontrol_mgmt inventory variable, else the one named after the
+DUT (host1-mgmt for host1), else the one at the same position in the
+inventory. The BMC is reached at the address of the management host, with
+these variables of the management host (or of all:vars):
+
+    bcontrol_ipmi_user        (default: ansible_user)
+    bcontrol_ipmi_password    (default: ansible_ssh_pass)
+    bcontrol_ipmi_interface   (default: lanplus, "lan" for IPMI 1.5)
+    bcontrol_ipmi_port        (default: 623)
+
+So an IPMI simulator (e.g. ipmi_sim of OpenIPMI) listening on localhost can
+stand in for the BMCs:
+
+    [duts-mgmt]
+    host1-mgmt.example.com ansible_host=127.0.0.1 bcontrol_ipmi_port=9001
+
+Power operations are run by ipmitool, for all BMCs concurrently in one
+asyncio loop. At most `concurrency` of them run at once and they are started
+at most `rate` per second, so neither the controller nor a shared management
+network is flooded.
+
+A reboot escalates through REBOOT_STEPS: the DUT is rebooted in-band first
+(over SSH), a DUT which is not ready (see bcontroller.boot.BootWaiter) in
+`timeout` seconds is reset by its BMC, then power cycled.
+"""
+import asyncio
+import os
+import time
+from logging import debug, info, warning
+
+from . import BControlCommandError, BControlError, BControlTimeout
+from .aio import run_command
+from .boot import BootWaiter
+from .inventory import load_inventory
+from .sshpool import SSHPool
+
+
+POWER_STATUS = "status"
+POWER_ON = "on"
+POWER_OFF = "off"
+POWER_SOFT = "soft"  # ACPI shutdown
+POWER_RESET = "reset"
+POWER_CYCLE = "cycle"
+POWER_OPERATIONS = (
+    POWER_STATUS,
+    POWER_ON,
+    POWER_OFF,
+    POWER_SOFT,
+    POWER_RESET,
+    POWER_CYCLE,
+)
+
+# In-band reboot, then escalated to the BMC
+REBOOT_SOFT = "soft"
+REBOOT_STEPS = (
+    REBOOT_SOFT,
+    POWER_RESET,
+    POWER_CYCLE,
+)
+
+DEFAULT_INTERFACE = "lanplus"
+DEFAULT_IPMI_PORT = 623
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 4.0
+
+# Seconds every reboot step gives a DUT to be ready
+DEFAULT_READY_TIMEOUT = 300
+
+# How long one ipmitool call may take (it retries on its own)
+_IPMI_TIMEOUT = 30
+
+# Returns right away, the SSH connection drops with the reboot
+_SOFT_REBOOT_COMMAND = "nohup sh -c 'sleep 1; systemctl reboot' >/dev/null 2>&1 &"
+
+
+class BControlPowerError(BControlError):
+    pass
+
+
+def pair_mgmt(inventory, duts="duts", mgmt="duts-mgmt"):
+    """
+    Return mapping DUT -> its management host (see module documentation).
+    """
+    dut_hosts = inventory.hosts(duts)
+    mgmt_hosts = inventory.hosts(mgmt)
+    by_name = {host.split(".")[0]: host for host in mgmt_hosts}
+
+    pairs = {}
+    for index, host in enumerate(dut_hosts):
+        mgmt_host = inventory.hostvars(host).get("bcontrol_mgmt") or by_name.get("%s-mgmt" % host.split(".")[0])
+        if mgmt_host is None and len(mgmt_hosts) == len(dut_hosts):
+            mgmt_host = mgmt_hosts[index]
+
+        if mgmt_host is None:
+            raise BControlPowerError("power: no host of %s manages %s, set its bcontrol_mgmt" % (mgmt, host))
+
+        pairs[host] = mgmt_host
+
+    return pairs
+
+
+class _RateLimit:
+    """
+    Let at most `concurrency` holders in at once, started at most `rate` per
+    second. Has to be created in the loop which uses it.
+    """
+
+    def __init__(self, concurrency, rate):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock = asyncio.Lock()
+        self._interval = 1.0 / rate if rate else 0
+        self._next = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        async with self._lock:
+            delay = self._next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self._next = time.monotonic() + self._interval
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+
+class IPMIPower:
+    """
+    Power control of DUTs of the `inventory` through BMCs of their
+    management hosts, see module documentation.
+    """
+
+    def __init__(self, inventory=None, ssh_pool=None, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE):
+        self.inventory = inventory or load_inventory()
+        self.pairs = pair_mgmt(self.inventory)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.ssh_pool = ssh_pool
+        self.waiter = BootWaiter(ssh_pool, self.inventory)
+        self._ssh = ssh_pool or SSHPool([], inventory=self.inventory)
+        self._limit = None
+
+    def _ipmitool(self, host, operation):
+        mgmt_host = self.pairs.get(host)
+        if mgmt_host is None:
+            raise BControlPowerError("power: %s is not a DUT" % host)
+
+        hostvars = self.inventory.hostvars(mgmt_host)
+        user = hostvars.get("bcontrol_ipmi_user") or self.inventory.user(mgmt_host)
+        password = hostvars.get("bcontrol_ipmi_password") or self.inventory.password(mgmt_host)
+
+        args = [
+            "ipmitool",
+            "-I", hostvars.get("bcontrol_ipmi_interface", DEFAULT_INTERFACE),
+            "-H", self.inventory.address(mgmt_host),
+            "-p", str(hostvars.get("bcontrol_ipmi_port", DEFAULT_IPMI_PORT)),
+        ]
+        if user:
+            args += ["-U", str(user)]
+
+        env = os.environ.copy()
+        if password:
+            # Not on the command line
+            env["IPMI_PASSWORD"] = str(password)
+            args.append("-E")
+
+        return args + ["chassis", "power", operation], env
+
+    async def _power(self, host, operation):
+        args, env = self._ipmitool(host, operation)
+        async with self._limit:
+            start = time.monotonic()
+            try:
+                out, _ = await run_command(args, env=env, timeout=_IPMI_TIMEOUT)
+            except FileNotFoundError:
+                raise BControlPowerError("power: ipmitool is not installed")
+            except BControlCommandError as e:
+                raise BControlPowerError("power: %s of %s (BMC %s) failed: %s" % (
+                    operation, host, self.pairs[host], e.stderr_output.strip() or e.output.strip(),
+                ))
+
+        debug("power: %s of %s done in %.2f s: %s", operation, host, time.monotonic() - start, out.strip())
+        return out.strip()
+
+    async def _soft_reboot(self, host):
+        args, env = self._ssh.command(host, _SOFT_REBOOT_COMMAND)
+        async with self._limit:
+            try:
+                await run_command(args, env=env, timeout=_IPMI_TIMEOUT)
+            except (BControlCommandError, BControlTimeout) as e:
+                warning("power: %s: in-band reboot failed: %s", host, e.message.splitlines()[0])
+                return False
+
+        return True
+
+    async def _reboot(self, host, timeout, steps):
+        """
+        Reboot the `host` by `steps` (see REBOOT_STEPS) until it is ready,
+        return the step which rebooted it with its BootTimes.
+        """
+        boot_id = await self.waiter.boot_id(host)
+        for step in steps:
+            # A hung DUT cannot reboot itself
+            if step == REBOOT_SOFT and boot_id is None:
+                info("power: %s: unreachable, skipping in-band reboot", host)
+                continue
+
+            if step == REBOOT_SOFT:
+                if not await self._soft_reboot(host):
+                    continue
+            elif step == POWER_CYCLE and POWER_OFF in (await self._power(host, POWER_STATUS)).lower():
+                # A powered-off chassis cannot be cycled
+                await self._power(host, POWER_ON)
+            else:
+                await self._power(host, step)
+
+            try:
+                times = await self.waiter.wait(host, boot_id, timeout)
+            except BControlTimeout as e:
+                warning("power: %s, escalating", e.message)
+                continue
+
+            info("power: %s ready after %s in %.2f s", host, step, times.ready)
+            if self.ssh_pool is not None:
+                await asyncio.get_event_loop().run_in_executor(None, self.ssh_pool.ensure_host, host)
+
+            return step, times
+
+        raise BControlPowerError("power: %s did not come back after %s" % (host, ", ".join(steps)))
+
+    def _run_all(self, coroutine, hosts, *args):
+        """
+        Run `coroutine` for all `hosts` concurrently, return mapping host ->
+        its result. Raises BControlPowerError listing all failed hosts.
+        """
+        async def _all():
+            self._limit = _RateLimit(self.concurrency, self.rate)
+            return await asyncio.gather(*(coroutine(host, *args) for host in hosts), return_exceptions=True)
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(_all())
+        finally:
+            loop.close()
+
+        errors = []
+        for host, result in zip(hosts, results):
+            if isinstance(result, BControlError):
+                errors.append(result.message)
+            elif isinstance(result, BaseException):
+                raise result
+
+        if errors:
+            raise BControlPowerError("\n".join(errors))
+
+        return dict(zip(hosts, results))
+
+    def power(self, operation, hosts=None):
+        """
+        Run power `operation` (see POWER_OPERATIONS) on BMCs of `hosts` (all
+        DUTs by default), return mapping host -> ipmitool output.
+        """
+        hosts = list(self.pairs) if hosts is None else hosts
+        start = time.monotonic()
+        results = self._run_all(self._power, hosts, operation)
+        info("power: %s of %d DUTs done in %.2f s", operation, len(hosts), time.monotonic() - start)
+        return results
+
+    def reboot(self, hosts=None, timeout=DEFAULT_READY_TIMEOUT, steps=REBOOT_STEPS):
+        """
+        Reboot `hosts` (all DUTs by default), escalating through `steps` for
+        every DUT which is not ready in `timeout` seconds. Returns mapping
+        host -> (step which rebooted it, BootTimes).
+        """
+        hosts = list(self.pairs) if hosts is None else hosts
+        start = time.monotonic()
+        results = self._run_all(self._reboot, hosts, timeout, steps)
+        info("power: %d DUTs rebooted in %.2f s", len(hosts), time.monotonic() - start)
+        return results
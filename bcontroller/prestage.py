@@ -0,0 +1,313 @@
+"""
+Pre-staging of candidate kernels of the next bisect steps.
+
+While DUTs install and test the kernel of the current bisect step, the
+controller builds the kernels of both possible next midpoints (the one when
+the current commit turns out good and the one when it is bad, see
+`git rev-list --bisect`). They are built in their own git worktrees, so the
+checkout of the bisect is not touched. Every worktree slot is reused for the
+following candidates, so these builds are incremental too.
+
+When the step is decided, the candidates are installed on DUTs in one batch
+without reboot. When the next step tests one of them, it only selects its
+boot entry by grub2-reboot and reboots. Kernels of candidates which are not
+going to be tested any more (and other kernels installed by bcontrol, see
+playbooks/tasks/gc-kernels.yml) are removed from DUTs in the same batch.
+
+Every candidate is built with a LOCALVERSION derived from its commit, so its
+kernel release (and boot entry) is unique. The state of the session (which
+candidates were staged) is kept in the git directory of the bisected tree,
+see Session. It is dropped when the bisect does not continue the one it was
+saved for, and a staged kernel which is missing on DUTs (e.g. reinstalled
+DUT) is installed again.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from logging import debug, info, warning
+
+from . import (
+    BControlCommandError,
+    BControlError,
+    INSTALLER_YUM,
+    _CUR_DIR,
+    _PLAYBOOK_DEADLINE_SLACK,
+    ansible_playbook,
+    build,
+    git,
+    manifest_release,
+    sh,
+)
+
+
+# How many candidates are staged by default (both next midpoints)
+DEFAULT_CANDIDATES = 2
+
+_STATE_DIR = "bcontrol"
+_STATE_FILE = "prestage.json"
+
+
+def make_opts(commit):
+    """
+    Return make options which give the kernel of `commit` a unique release.
+    """
+    return "LOCALVERSION=-bc%s" % commit[:12]
+
+
+def _rev_parse(git_tree, rev):
+    out, _ = git(["rev-parse", "--verify", "--quiet", rev], work_dir=git_tree)
+    return out.strip()
+
+
+def bisect_refs(git_tree):
+    """
+    Return the bad commit and the sorted good commits of the bisect running
+    in `git_tree`, None when there is none.
+    """
+    try:
+        bad = _rev_parse(git_tree, "refs/bisect/bad")
+    except BControlCommandError:
+        return None
+
+    out, _ = git(["for-each-ref", "--format=%(objectname)", "refs/bisect/good-*"], work_dir=git_tree)
+    return {"bad": bad, "good": sorted(out.split())}
+
+
+def _continues(git_tree, saved, current):
+    """
+    Return True if the bisect with `current` refs is the one with `saved`
+    refs, narrowed by the verdicts of the steps since.
+    """
+    if saved is None or current is None or not set(saved["good"]) <= set(current["good"]):
+        return False
+
+    if saved["bad"] == current["bad"]:
+        return True
+
+    try:
+        git(["merge-base", "--is-ancestor", current["bad"], saved["bad"]], work_dir=git_tree)
+    except BControlCommandError:
+        return False
+
+    return True
+
+
+def installed(release):
+    """
+    Return True if the kernel `release` is installed on all DUTs.
+    """
+    try:
+        sh("test", ["-e", "/boot/vmlinuz-%s" % release])
+    except BControlCommandError:
+        return False
+
+    return True
+
+
+def next_midpoints(git_tree, head, work_dir):
+    """
+    Return the commits the bisect continues with after `head` is marked good
+    and after it is marked bad (the ones which exist).
+
+    `work_dir` is another worktree of the repository. Bisect refs are per
+    worktree and `git rev-list --bisect` adds the ones it sees to its
+    arguments, so the midpoints git bisect would pick are computed there.
+    """
+    bad = _rev_parse(git_tree, "refs/bisect/bad")
+    out, _ = git(["for-each-ref", "--format=%(objectname)", "refs/bisect/good-*"], work_dir=git_tree)
+    good = out.split()
+    out, _ = git(["for-each-ref", "--format=%(objectname)", "refs/bisect/skip-*"], work_dir=git_tree)
+    untestable = set(out.split()) | {head, bad}
+
+    candidates = []
+    for tip, exclude in ((bad, good + [head]), (head, good)):
+        out, _ = git(["rev-list", "--bisect", tip, "--not"] + exclude, work_dir=work_dir)
+        commit = out.strip()
+        # No commit means the bisect ends with this verdict
+        if commit and commit not in untestable and commit not in candidates:
+            candidates.append(commit)
+
+    return candidates
+
+
+class Session:
+    """
+    Candidates staged on DUTs during the bisect of `git_tree`, kept in
+    .git/bcontrol/prestage.json as mapping commit -> kernel release and path
+    of its package, together with the bisect refs they were staged for (see
+    bisect_refs()).
+    """
+
+    def __init__(self, git_tree):
+        self.git_tree = git_tree
+        out, _ = git(["rev-parse", "--absolute-git-dir"], work_dir=git_tree)
+        self.dir = os.path.join(out.strip(), _STATE_DIR)
+        self.path = os.path.join(self.dir, _STATE_FILE)
+        self.staged = {}
+        self.bisect = bisect_refs(git_tree)
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            staged, saved_bisect = state["staged"], state.get("bisect")
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError) as e:
+            warning("prestage: ignoring broken state %s: %s", self.path, e)
+            return
+
+        if _continues(git_tree, saved_bisect, self.bisect):
+            self.staged = staged
+        elif staged:
+            info("prestage: bisect was restarted, forgetting %d staged kernels", len(staged))
+
+    def head(self):
+        return _rev_parse(self.git_tree, "HEAD")
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"bisect": bisect_refs(self.git_tree), "staged": self.staged}, f, indent=2)
+
+        os.replace(tmp_path, self.path)
+
+    def worktree(self, slot):
+        return os.path.join(self.dir, "worktrees", "slot-%d" % slot)
+
+
+class Prestager:
+    """
+    Build up to `count` candidates of the next bisect steps in background
+    (start()) and stage them on DUTs (finish()). Candidates are built as RPM
+    packages and installed by the given `installer`.
+    """
+
+    def __init__(self, session, rpmbuild_topdir, count=DEFAULT_CANDIDATES, installer=INSTALLER_YUM, deadlines=None,
+                 gc=True, keep_releases=()):
+        self.session = session
+        self.rpmbuild_topdir = rpmbuild_topdir
+        self.count = count
+        self.installer = installer
+        self.deadlines = deadlines or {}
+        # Removal of other kernels installed by bcontrol, see gc-kernels.yml
+        self.gc = gc
+        self.keep_releases = list(keep_releases)
+        # Candidates of the next step and the ones being built
+        self.next = []
+        self.candidates = []
+        self.built = {}
+        self._thread = None
+
+    def _worktree(self, slot, commit):
+        path = self.session.worktree(slot)
+        if not os.path.isdir(path):
+            git(["worktree", "add", "--detach", path, commit], work_dir=self.session.git_tree)
+
+        return path
+
+    def _checkout(self, slot, commit):
+        path = self._worktree(slot, commit)
+        git(["checkout", "--quiet", "--force", "--detach", commit], work_dir=path)
+        shutil.copy2(os.path.join(self.session.git_tree, ".config"), os.path.join(path, ".config"))
+        return path
+
+    def _build(self, slot, commit):
+        start = time.monotonic()
+        path = self._checkout(slot, commit)
+        opts = make_opts(commit)
+        manifest, _ = build(
+            path,
+            make_opts=opts,
+            jobs=multiprocessing.cpu_count(),
+            cc="",
+            rpmbuild_topdir=os.path.join(self.rpmbuild_topdir, "prestage-%d" % slot),
+            oldconfig=True,
+            timeout=self.deadlines.get("build") or None,
+        )
+        if manifest.kernel is None:
+            warning("prestage: build of %s did not produce kernel package", commit)
+            return
+
+        self.built[commit] = {
+            "release": manifest_release(path, opts, manifest),
+            "pkg": manifest.kernel,
+        }
+        info("prestage: %s built in %.1f s: %s", commit, time.monotonic() - start, manifest.kernel)
+
+    def _build_all(self):
+        for slot, commit in enumerate(self.candidates):
+            try:
+                self._build(slot, commit)
+            except (BControlError, OSError) as e:
+                warning("prestage: cannot build %s: %s", commit, str(e).splitlines()[0])
+
+    def start(self, head):
+        """
+        Start building candidates of the step after the one testing `head`
+        which are not staged yet.
+        """
+        try:
+            self.next = next_midpoints(self.session.git_tree, head, self._worktree(0, head))[:self.count]
+        except BControlError as e:
+            warning("prestage: cannot find next candidates: %s", e.message.splitlines()[0])
+            return
+
+        self.candidates = [commit for commit in self.next if commit not in self.session.staged]
+        info("prestage: next candidates: %s (%d staged already)", ", ".join(self.next) or "none", len(self.next) - len(self.candidates))
+
+        self._thread = threading.Thread(target=self._build_all, daemon=True)
+        self._thread.start()
+
+    def finish(self, head, stage=True):
+        """
+        Wait for the candidate builds. With `stage`, install them on DUTs
+        and remove staged kernels which are neither candidates nor `head`.
+        """
+        if self._thread is None:
+            return
+
+        self._thread.join()
+        if not stage:
+            return
+
+        keep = set(self.next) | {head}
+        stale = {commit: entry for commit, entry in self.session.staged.items() if commit not in keep}
+        if not self.built and not stale:
+            return
+
+        timeout = None
+        if self.deadlines:
+            timeout = self.deadlines.get("copy", 0) + self.deadlines.get("install", 0) + _PLAYBOOK_DEADLINE_SLACK
+
+        start = time.monotonic()
+        ansible_playbook(
+            os.path.join(_CUR_DIR, "../playbooks/stage-kernels.yml"),
+            "duts",
+            timeout=timeout,
+            pkg_paths=",".join(entry["pkg"] for entry in self.built.values()),
+            pkg_releases=",".join(entry["release"] for entry in self.built.values()),
+            keep_releases=",".join(self.keep_releases + [
+                entry["release"] for commit, entry in self.session.staged.items() if commit not in stale
+            ]),
+            gc_kernels=self.gc,
+            installer=self.installer,
+            copy_timeout=self.deadlines.get("copy", 0),
+            install_timeout=self.deadlines.get("install", 0),
+        )
+        info(
+            "prestage: %d kernels staged, %d stale removed in %.1f s",
+            len(self.built),
+            len(stale),
+            time.monotonic() - start,
+        )
+
+        for commit in stale:
+            del self.session.staged[commit]
+
+        self.session.staged.update(self.built)
+        self.session.save()
+        debug("prestage: staged: %s", self.session.staged)
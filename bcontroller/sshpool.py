@@ -0,0 +1,237 @@
+"""
+Pool of persistent multiplexed SSH connections (ControlMaster) to DUTs.
+
+bcontrol owns one master connection per DUT. Masters are started (pre-warmed)
+in parallel, health-checked before use and re-established when they are gone,
+e.g. after the DUT rebooted. Ansible is configured to use the same control
+sockets (and pipelining), so its tasks skip the SSH handshake and the password
+authentication entirely.
+
+Host keys are verified against the user's known_hosts like Ansible does.
+Verification is disabled only for hosts whose ansible_host_key_checking (or
+ansible_ssh_host_key_checking) inventory variable is false, or for all hosts
+with ANSIBLE_HOST_KEY_CHECKING=False, the settings Ansible itself honours.
+"""
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+from logging import debug, info, warning
+
+from . import BControlCommandError, BControlError, BControlTimeout, run_command
+from .inventory import load_inventory
+
+
+DEFAULT_CONTROL_DIR = os.path.join(tempfile.gettempdir(), "bcontrol-ssh")
+
+# How long an idle master stays alive (seconds). Masters are shared by all
+# bcontrol processes of the bisect, so this covers a kernel build.
+DEFAULT_PERSIST = 4 * 3600
+
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# Pool status of a host
+STATUS_REUSED = "reused"
+STATUS_STARTED = "started"
+STATUS_FAILED = "failed"
+
+
+_FALSE_VALUES = ("0", "false", "no", "off", "n", "f")
+
+
+def _is_false(value):
+    return value is not None and str(value).strip().lower() in _FALSE_VALUES
+
+
+class SSHPool:
+    """
+    Persistent SSH masters for all `hosts`, see module documentation.
+    """
+
+    def __init__(self, hosts, control_dir=DEFAULT_CONTROL_DIR, persist=DEFAULT_PERSIST,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, inventory=None):
+        self.hosts = list(hosts)
+        self.control_dir = control_dir
+        self.persist = persist
+        self.connect_timeout = connect_timeout
+        self.inventory = inventory or load_inventory()
+
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+
+    @property
+    def control_path(self):
+        # %C is a hash of local host, remote host, port and user, which keeps
+        # the socket path short and is computed in the same way by Ansible
+        return os.path.join(self.control_dir, "%C")
+
+    def ansible_env(self):
+        """
+        Environment variables which make Ansible share the pool's masters.
+        """
+        return {
+            "ANSIBLE_SSH_CONTROL_PATH_DIR": self.control_dir,
+            "ANSIBLE_SSH_CONTROL_PATH": "%(directory)s/%%C",
+            "ANSIBLE_SSH_ARGS": "-o ControlMaster=auto -o ControlPersist=%ds" % self.persist,
+            "ANSIBLE_PIPELINING": "True",
+        }
+
+    def ssh_args(self, host, *options):
+        """
+        Return ssh command (without the remote command) for `host` which goes
+        through its master connection.
+        """
+        args = [
+            "ssh",
+            "-o", "ControlPath=%s" % self.control_path,
+            "-o", "ConnectTimeout=%d" % self.connect_timeout,
+            "-o", "LogLevel=ERROR",
+        ]
+
+        if not self.host_key_checking(host):
+            args += ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
+
+        user = self.inventory.user(host)
+        if user:
+            args += ["-l", str(user)]
+
+        port = self.inventory.port(host)
+        if port:
+            args += ["-p", str(port)]
+
+        return args + list(options) + [self.inventory.address(host)]
+
+    def host_key_checking(self, host):
+        """
+        Return False if the user opted out of host key verification of the
+        `host`, see module documentation.
+        """
+        hostvars = self.inventory.hostvars(host)
+        for var in ("ansible_host_key_checking", "ansible_ssh_host_key_checking"):
+            if var in hostvars:
+                return not _is_false(hostvars[var])
+
+        return not _is_false(os.environ.get("ANSIBLE_HOST_KEY_CHECKING"))
+
+    def command(self, host, remote_command):
+        """
+        Return arguments and environment of ssh which runs `remote_command`
+        (shell string) on the `host`, through the master connection if there
+        is one.
+        """
+        args = self._with_password(host, self.ssh_args(host) + [remote_command])
+        return args, self._env(host)
+
+    def wrap(self, host, args):
+        """
+        Return arguments and environment of a command which runs ssh for the
+        `host` itself (e.g. rsync with ssh_args() as its remote shell), with
+        password authentication when the host needs it.
+        """
+        return self._with_password(host, args), self._env(host)
+
+    def _env(self, host):
+        env = os.environ.copy()
+        password = self.inventory.password(host)
+        if password:
+            env["SSHPASS"] = str(password)
+
+        return env
+
+    def _with_password(self, host, args):
+        if not self.inventory.password(host):
+            return args
+
+        if shutil.which("sshpass") is None:
+            warning("ssh-pool: %s uses password authentication but sshpass is not installed", host)
+            return args
+
+        return ["sshpass", "-e"] + args
+
+    def check(self, host):
+        """
+        Return True if master connection of the `host` is alive and usable.
+        """
+        try:
+            run_command(self.ssh_args(host, "-O", "check"), timeout=self.connect_timeout)
+            # The master can still be waiting for a dead (rebooted) peer
+            run_command(self.ssh_args(host, "-o", "BatchMode=yes") + ["true"], timeout=self.connect_timeout)
+        except (BControlCommandError, BControlTimeout):
+            return False
+
+        return True
+
+    def start(self, host):
+        """
+        Start (or restart) the master connection of the `host`.
+        """
+        # Drop the stale master (if any) first, e.g. after DUT reboot
+        self.stop(host)
+
+        args = self.ssh_args(
+            host,
+            "-o", "ControlMaster=yes",
+            "-o", "ControlPersist=%d" % self.persist,
+            # Notice dead connection (e.g. rebooted DUT) quickly
+            "-o", "ServerAliveInterval=5",
+            "-o", "ServerAliveCountMax=2",
+            # Authenticate, then go into background and keep the connection
+            "-N",
+            "-f",
+        )
+        run_command(
+            self._with_password(host, args),
+            env=self._env(host),
+            timeout=self.connect_timeout * 3,
+        )
+
+    def stop(self, host):
+        try:
+            run_command(self.ssh_args(host, "-O", "exit"), timeout=self.connect_timeout)
+        except (BControlCommandError, BControlTimeout):
+            pass
+
+    def ensure_host(self, host):
+        if self.check(host):
+            return STATUS_REUSED
+
+        debug("ssh-pool: starting master connection to %s", host)
+        try:
+            self.start(host)
+        except (BControlCommandError, BControlTimeout) as e:
+            warning("ssh-pool: cannot connect to %s: %s", host, e.message.splitlines()[0])
+            return STATUS_FAILED
+
+        return STATUS_STARTED
+
+    def ensure(self, hosts=None):
+        """
+        Health-check master connections of all `hosts` (whole pool by
+        default) in parallel and re-establish those which are gone. Returns
+        mapping host -> status.
+        """
+        hosts = self.hosts if hosts is None else hosts
+        if not hosts:
+            return {}
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            statuses = dict(zip(hosts, executor.map(self.ensure_host, hosts)))
+
+        info("ssh-pool: %d hosts ready in %.2f s: %s", len(hosts), time.monotonic() - start, statuses)
+        return statuses
+
+    def warm(self):
+        """
+        Pre-warm the pool. Raises BControlError if any host is not reachable.
+        """
+        statuses = self.ensure()
+        failed = [host for host, status in statuses.items() if status == STATUS_FAILED]
+        if failed:
+            raise BControlError("ssh-pool: cannot connect to: %s" % ", ".join(failed))
+
+        return statuses
+
+    def close(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.hosts), 1)) as executor:
+            list(executor.map(self.stop, self.hosts))
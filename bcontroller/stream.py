@@ -0,0 +1,252 @@
+"""
+Streaming helpers for reading output of child processes.
+
+Output is read in large chunks without blocking, decoded incrementally (so
+multi-byte UTF-8 characters split between two chunks are handled correctly)
+and split into lines. Only bounded amount of the output is kept in memory.
+"""
+import codecs
+import collections
+import io
+import os
+import re
+import selectors
+import tempfile
+import threading
+import time
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_TAIL_SIZE = 256 * 1024
+DEFAULT_SPILL_THRESHOLD = 8 * 1024 * 1024
+
+# Partial line longer than this is emitted even without the line ending
+MAX_LINE_SIZE = 1024 * 1024
+
+STDOUT = "stdout"
+STDERR = "stderr"
+
+OutputLine = collections.namedtuple("OutputLine", [
+    # STDOUT or STDERR
+    "stream",
+    # time.monotonic() of the moment the line was read
+    "timestamp",
+    # Decoded line including its line ending (the last line may be without)
+    "text",
+])
+
+
+class TailBuffer:
+    """
+    Output buffer which keeps only the last `max_size` characters.
+    """
+
+    def __init__(self, max_size=DEFAULT_TAIL_SIZE):
+        self.max_size = max_size
+        self.total_size = 0
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def write(self, data):
+        if not data:
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+        self.total_size += len(data)
+
+        # Drop whole chunks while the rest still covers the tail
+        while self._size - len(self._chunks[0]) >= self.max_size:
+            self._size -= len(self._chunks.popleft())
+
+    def tail(self, size=None):
+        size = self.max_size if size is None else min(size, self.max_size)
+        return "".join(self._chunks)[-size:] if size else ""
+
+    def getvalue(self):
+        return self.tail()
+
+    def close(self):
+        self._chunks.clear()
+        self._size = 0
+
+
+class SpillBuffer:
+    """
+    Output buffer which keeps the whole output. It stays in memory until it
+    grows over `threshold` bytes, then it is spilled into a temporary file.
+    """
+
+    def __init__(self, threshold=DEFAULT_SPILL_THRESHOLD, tail_size=DEFAULT_TAIL_SIZE):
+        self.threshold = threshold
+        self.tail_size = tail_size
+        self.total_size = 0
+        self._file = io.BytesIO()
+        self._spilled = False
+
+    @property
+    def spilled(self):
+        return self._spilled
+
+    def write(self, data):
+        if not data:
+            return
+
+        encoded = data.encode("utf-8")
+        self.total_size += len(encoded)
+        self._file.write(encoded)
+
+        if not self._spilled and self._file.tell() > self.threshold:
+            spill_file = tempfile.TemporaryFile(prefix="bcontrol-output-")
+            spill_file.write(self._file.getbuffer())
+            self._file = spill_file
+            self._spilled = True
+
+    def tail(self, size=None):
+        size = self.tail_size if size is None else size
+        pos = self._file.tell()
+        self._file.seek(max(pos - size, 0))
+        data = self._file.read(pos - self._file.tell())
+        self._file.seek(pos)
+
+        # The first bytes could be in the middle of a multi-byte character
+        return data.decode("utf-8", errors="ignore")
+
+    def getvalue(self):
+        pos = self._file.tell()
+        self._file.seek(0)
+        data = self._file.read(pos)
+        self._file.seek(pos)
+        return data.decode("utf-8")
+
+    def close(self):
+        self._file.close()
+
+
+class LineMatcher:
+    """
+    Line event hook which calls `callback(match, line)` for every output line
+    matching the regular expression `pattern`. If `stream` is given, only
+    lines of that stream are matched. An exception raised from the callback
+    stops the command.
+    """
+
+    def __init__(self, pattern, callback, stream=None):
+        self.pattern = re.compile(pattern)
+        self.callback = callback
+        self.stream = stream
+
+    def __call__(self, line):
+        if self.stream is not None and line.stream != self.stream:
+            return
+
+        m = self.pattern.search(line.text)
+        if m:
+            self.callback(m, line)
+
+
+class LineDecoder:
+    """
+    Incremental decoder which turns chunks of bytes into complete lines.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""
+
+    def decode(self, chunk):
+        """
+        Decode `chunk` and return list of lines completed by it. Empty chunk
+        means EOF, the rest of the data is returned as the last line.
+        """
+        text = self._pending + self._decoder.decode(chunk, final=not chunk)
+        lines = text.split("\n")
+        rest = lines.pop()
+        lines = [line + "\n" for line in lines]
+        if rest and (not chunk or len(rest) >= MAX_LINE_SIZE):
+            lines.append(rest)
+            rest = ""
+
+        self._pending = rest
+        return lines
+
+
+class Interrupt:
+    """
+    Stop multiplex() from another thread: throw() makes it raise the given
+    exception in the thread which reads the streams. Only the first thrown
+    exception is raised. Exceptions thrown after close() are ignored.
+    """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.error = None
+
+    def fileno(self):
+        return self._read_fd
+
+    def throw(self, error):
+        with self._lock:
+            if self._closed or self.error is not None:
+                return
+
+            self.error = error
+            os.write(self._write_fd, b"\0")
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+
+def multiplex(streams, chunk_size=DEFAULT_CHUNK_SIZE, deadline=None, interrupt=None):
+    """
+    Drain all `streams` (mapping of stream name to binary file object)
+    concurrently and yield OutputLine for each line read from any of them.
+    Lines of one stream are yielded in order, lines of different streams in
+    the order they were read.
+
+    If `deadline` (time.monotonic() value) passes before all streams reach
+    EOF, TimeoutError is raised. The exception thrown into `interrupt` (see
+    Interrupt) is raised as soon as it is thrown.
+    """
+    selector = selectors.DefaultSelector()
+    for name, stream in streams.items():
+        if stream is not None:
+            selector.register(stream.fileno(), selectors.EVENT_READ, (name, LineDecoder()))
+
+    if interrupt is not None:
+        if interrupt.error is not None:
+            raise interrupt.error
+
+        selector.register(interrupt.fileno(), selectors.EVENT_READ, None)
+
+    try:
+        while len(selector.get_map()) > (interrupt is not None):
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError
+
+            for key, _ in selector.select(timeout):
+                if key.data is None:
+                    raise interrupt.error
+
+                name, decoder = key.data
+                chunk = os.read(key.fd, chunk_size)
+                timestamp = time.monotonic()
+
+                for line in decoder.decode(chunk):
+                    yield OutputLine(name, timestamp, line)
+
+                if not chunk:
+                    selector.unregister(key.fd)
+    finally:
+        selector.close()
@@ -0,0 +1,135 @@
+"""
+Delta transfer of kernel packages to DUTs.
+
+Every DUT keeps the last kernel packages it received in DUT_CACHE_DIR. A new
+package is sent by rsync with --fuzzy, which picks the most similar cached
+file (the previous bisect kernel) as the basis: only blocks which do not
+match by the rolling checksum are transferred, the rest is copied on the DUT
+locally.
+
+The transfer goes through the SSH pool master connections when there are
+some (see bcontroller.sshpool).
+"""
+import collections
+import concurrent.futures
+import os
+import re
+import shlex
+import shutil
+from logging import debug, info, warning
+
+from . import BControlCommandError, BControlTimeout, run_command
+from .inventory import load_inventory
+from .sshpool import SSHPool
+
+
+DUT_CACHE_DIR = "/var/cache/bcontrol/kernels"
+
+# How many packages to keep in the DUT cache as delta bases
+DEFAULT_KEEP = 2
+
+TransferStats = collections.namedtuple("TransferStats", [
+    # Size of the package
+    "size",
+    # Bytes sent over the network (data and protocol overhead)
+    "sent",
+    # Bytes of the package which were not found in the basis
+    "literal",
+    # Bytes of the package reconstructed from the basis on the DUT
+    "matched",
+])
+
+_STATS_PATTERNS = {
+    "size": re.compile(r"^Total file size: ([\d,]+)", re.MULTILINE),
+    "sent": re.compile(r"^Total bytes sent: ([\d,]+)", re.MULTILINE),
+    "literal": re.compile(r"^Literal data: ([\d,]+)", re.MULTILINE),
+    "matched": re.compile(r"^Matched data: ([\d,]+)", re.MULTILINE),
+}
+
+
+def available():
+    return shutil.which("rsync") is not None
+
+
+def _parse_stats(output):
+    values = {}
+    for name, pattern in _STATS_PATTERNS.items():
+        match = pattern.search(output)
+        values[name] = int(match.group(1).replace(",", "")) if match else 0
+
+    return TransferStats(**values)
+
+
+def _rsync_command(ssh_pool, host, path, cache_dir):
+    ssh_args = ssh_pool.ssh_args(host)
+    address = ssh_args.pop()
+    return ssh_pool.wrap(host, [
+        "rsync",
+        "--fuzzy",
+        "--times",
+        "--stats",
+        "--rsh", " ".join(shlex.quote(arg) for arg in ssh_args),
+        "--rsync-path", "mkdir -p %s && rsync" % shlex.quote(cache_dir),
+        path,
+        "%s:%s/" % (address, cache_dir),
+    ])
+
+
+def _prune(ssh_pool, host, cache_dir, keep, pushed):
+    """
+    Remove all but the `keep` newest packages from `cache_dir` on the `host`,
+    the `pushed` one is always kept (rsync --times gives it the mtime of the
+    controller file, which can be older than the cached ones).
+    """
+    args, env = ssh_pool.command(
+        host,
+        "cd %s && ls -t | grep -vxF %s | tail -n +%d | xargs -r rm -f --" % (
+            shlex.quote(cache_dir),
+            shlex.quote(pushed),
+            max(keep, 1),
+        ),
+    )
+    try:
+        run_command(args, env=env, timeout=ssh_pool.connect_timeout * 3)
+    except (BControlCommandError, BControlTimeout) as e:
+        warning("delta: cannot prune cache on %s: %s", host, e.message.splitlines()[0])
+
+
+def push_host(ssh_pool, host, path, cache_dir=DUT_CACHE_DIR, keep=DEFAULT_KEEP, timeout=None):
+    """
+    Send `path` into `cache_dir` on the `host`, return TransferStats.
+    """
+    args, env = _rsync_command(ssh_pool, host, path, cache_dir)
+    out, _ = run_command(args, env=env, timeout=timeout)
+    stats = _parse_stats(out)
+    debug("delta: %s: %s", host, stats)
+
+    _prune(ssh_pool, host, cache_dir, keep, os.path.basename(path))
+    return stats
+
+
+def push(path, hosts, ssh_pool=None, cache_dir=DUT_CACHE_DIR, keep=DEFAULT_KEEP, timeout=None):
+    """
+    Send the kernel package `path` to all `hosts` in parallel. Returns mapping
+    host -> TransferStats and the path of the package on DUTs.
+    """
+    hosts = list(hosts)
+    ssh_pool = ssh_pool or SSHPool(hosts, inventory=load_inventory())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(hosts), 1)) as executor:
+        stats = dict(zip(hosts, executor.map(
+            lambda host: push_host(ssh_pool, host, path, cache_dir, keep, timeout),
+            hosts,
+        )))
+
+    for host, host_stats in stats.items():
+        info(
+            "delta: %s: sent %d of %d bytes (%.1f %%), %d bytes reused from the cached package",
+            host,
+            host_stats.sent,
+            host_stats.size,
+            100.0 * host_stats.sent / host_stats.size if host_stats.size else 0.0,
+            host_stats.matched,
+        )
+
+    return stats, os.path.join(cache_dir, os.path.basename(path))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the embedded Ansible runner against spawning ansible commands.
+
+Both runners execute the same sequence of calls a bisect step makes (ad-hoc
+command and a playbook) against a local-connection inventory:
+
+    $ python benchmarks/ansible_runner.py --iterations 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+_PLAYBOOK = """---
+- hosts: all
+  gather_facts: false
+  tasks:
+    - name: Check kernel
+      command: uname -r
+"""
+
+
+def step(ansible, ansible_playbook, playbook):
+    ansible("command", "duts", "uname -r")
+    ansible("ping", "duts")
+    ansible_playbook(playbook, "duts")
+
+
+def measure(name, fnc, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.monotonic()
+        fnc()
+        durations.append(time.monotonic() - start)
+
+    print(f"{name:12s} mean {statistics.mean(durations):7.3f} s   min {min(durations):7.3f} s")
+    return statistics.mean(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=5, help="Number of measured bisect steps.")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        inventory = os.path.join(tmp_dir, "hosts")
+        with open(inventory, "w") as f:
+            f.write(f"[duts]\nlocalhost ansible_connection=local ansible_python_interpreter={sys.executable}\n")
+
+        playbook = os.path.join(tmp_dir, "step.yml")
+        with open(playbook, "w") as f:
+            f.write(_PLAYBOOK)
+
+        # Both runners have to use the same inventory
+        os.environ["ANSIBLE_INVENTORY"] = inventory
+
+        import bcontroller
+        subprocess_mean = measure(
+            "subprocess",
+            lambda: step(bcontroller.ansible, bcontroller.ansible_playbook, playbook),
+            opts.iterations,
+        )
+
+        start = time.monotonic()
+        bcontroller.use_embedded_runner()
+        print(f"{'':12s} embedded runner initialized in {time.monotonic() - start:.3f} s")
+        embedded_mean = measure(
+            "embedded",
+            lambda: step(bcontroller.ansible, bcontroller.ansible_playbook, playbook),
+            opts.iterations,
+        )
+
+        print(f"speedup: {subprocess_mean / embedded_mean:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the kernel build against a hit of the build cache.
+
+The tree is built once into an empty cache in a temporary directory (the
+first build may be incremental, see make), then built again the given number
+of times, every time answered by the cache:
+
+    $ python benchmarks/build_cache.py -C ~/repos/linux-torvalds-repository --iterations 10
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+
+def build_seconds(git_tree, rpmbuild_topdir, artifact):
+    import bcontroller
+
+    start = time.monotonic()
+    manifest, _ = bcontroller.build(
+        git_tree,
+        make_opts="",
+        jobs=multiprocessing.cpu_count(),
+        cc="",
+        rpmbuild_topdir=rpmbuild_topdir,
+        oldconfig=True,
+        artifact=artifact,
+    )
+    if manifest.kernel is None:
+        sys.exit("build did not produce kernel package")
+
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-C", dest="git_tree", required=True, help="Kernel tree without uncommitted changes.")
+    parser.add_argument("--artifact", default="rpm", choices=["rpm", "tarball"], help="Format of the built kernel.")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of builds answered by the cache.")
+    opts = parser.parse_args()
+
+    import bcontroller
+    with tempfile.TemporaryDirectory(prefix="bcontrol-bench-") as tmp_dir:
+        bcontroller.use_build_cache(os.path.join(tmp_dir, "cache"))
+        rpmbuild_topdir = os.path.join(tmp_dir, "rpmbuild")
+
+        miss = build_seconds(opts.git_tree, rpmbuild_topdir, opts.artifact)
+        hits = [build_seconds(opts.git_tree, rpmbuild_topdir, opts.artifact) for _ in range(opts.iterations)]
+
+    print(f"build (miss) {miss:10.2f} s")
+    print(f"cache hit    {statistics.mean(hits) * 1000:10.1f} ms mean   max {max(hits) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
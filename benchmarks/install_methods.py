@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the kernel install from RPM (yum) against the kernel tarball.
+
+Both artifacts have to be built from the same tree (see build --artifact).
+They are installed on the DUTs of the current inventory without reboot and
+removed again after every iteration, so none of them may be the running
+kernel:
+
+    $ python benchmarks/install_methods.py --iterations 3 \\
+        --rpm /tmp/rpmbuild-kernel-bisect/RPMS/x86_64/kernel-5.15.0+-1.x86_64.rpm \\
+        --tarball /tmp/rpmbuild-kernel-bisect/TARBALLS/linux-5.15.0+-x86.tar.zst
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+
+def install_seconds(out):
+    """
+    Return sum of durations of the install phase tasks in the ansible-playbook
+    output document.
+    """
+    import bcontroller
+
+    seconds = 0.0
+    for play in json.loads(out)["plays"]:
+        for task in play["tasks"]:
+            if bcontroller._task_phase(task["task"]) == "install":
+                seconds += bcontroller._task_elapsed(task["task"])
+
+    return seconds
+
+
+def uninstall_command(artifact, path):
+    import bcontroller
+
+    if artifact == bcontroller.ARTIFACT_TARBALL:
+        release = bcontroller._tarball_release(path)
+        return (
+            f"grubby --remove-kernel=/boot/vmlinuz-{release}; "
+            f"rm -rf /lib/modules/{release} /boot/*-{release} /boot/initramfs-{release}.img"
+        )
+
+    name = subprocess.check_output(["rpm", "-qp", path], text=True).strip()
+    return f"rpm -e {name}"
+
+
+def measure(artifact, path, iterations):
+    import bcontroller
+
+    totals = []
+    installs = []
+    for _ in range(iterations):
+        start = time.monotonic()
+        out, _ = bcontroller.kernel_install(path, reboot=False)
+        totals.append(time.monotonic() - start)
+        installs.append(install_seconds(out))
+
+        bcontroller.ansible("shell", "duts", uninstall_command(artifact, path))
+
+    print(
+        f"{artifact:8s} {os.path.getsize(path) / 1e6:8.1f} MB   "
+        f"install mean {statistics.mean(installs):7.2f} s   "
+        f"kernel-install mean {statistics.mean(totals):7.2f} s   min {min(totals):7.2f} s"
+    )
+    return statistics.mean(installs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rpm", required=True, help="Kernel RPM package.")
+    parser.add_argument("--tarball", required=True, help="Kernel tarball built from the same tree.")
+    parser.add_argument("--iterations", type=int, default=3, help="Number of installs of every artifact.")
+    opts = parser.parse_args()
+
+    import bcontroller
+    rpm_mean = measure(bcontroller.ARTIFACT_RPM, opts.rpm, opts.iterations)
+    tarball_mean = measure(bcontroller.ARTIFACT_TARBALL, opts.tarball, opts.iterations)
+
+    print(f"install speedup: {rpm_mean / tarball_mean:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the run_command output handling on a synthetic build log.
+
+Every approach runs in its own interpreter so the peak RSS is not affected by
+the previous runs:
+
+    $ python benchmarks/run_command.py --size 100
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+APPROACHES = [
+    "legacy",
+    "tail",
+    "spill",
+]
+
+_LOG_LINES = [
+    "  CC [M]  drivers/net/ethernet/intel/e1000e/netdev.o\n",
+    "  LD [M]  fs/xfs/xfs.o\n",
+    "drivers/gpu/drm/i915/i915_gem.c:42:7: warning: unused variable ‘ret’ [-Wunused-variable]\n",
+    "  AR      lib/lib.a\n",
+]
+
+
+def generate_log(path, size_mb):
+    chunk = "".join(_LOG_LINES).encode("utf-8") * 1024
+    size = size_mb * 1024 * 1024
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(chunk)
+            written += len(chunk)
+
+        f.write(b"Wrote: /tmp/rpmbuild/RPMS/x86_64/kernel-5.1.0_rc3+-5.x86_64.rpm\n")
+
+
+def legacy_run_command(args):
+    # Byte-by-byte implementation used before the streaming engine
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = []
+    for c in iter(lambda: process.stdout.read(1), b''):
+        out.append(c.decode('utf-8', errors="replace"))
+
+    process.communicate()
+    return ''.join(out), process
+
+
+def run_approach(approach, log_path):
+    args = ["cat", log_path]
+
+    start = time.monotonic()
+    if approach == "legacy":
+        output, _ = legacy_run_command(args)
+    else:
+        from bcontroller import stream
+        buf = stream.TailBuffer() if approach == "tail" else stream.SpillBuffer()
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for line in stream.multiplex({
+            stream.STDOUT: process.stdout,
+            stream.STDERR: process.stderr,
+        }):
+            buf.write(line.text)
+
+        process.wait()
+
+        # Only the tail is needed for error reporting
+        output = buf.tail()
+
+    elapsed = time.monotonic() - start
+    assert output.rstrip().endswith(".rpm")
+
+    maxrss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{approach:8s} {elapsed:10.2f} s {maxrss_kb / 1024:10.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=100, help="Size of the synthetic log in MB.")
+    parser.add_argument("--approach", choices=APPROACHES, action="append", help="Run only given approach(es).")
+    parser.add_argument("--log", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.log:
+        run_approach(opts.approach[0], opts.log)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_path = os.path.join(tmp_dir, "build.log")
+        generate_log(log_path, opts.size)
+        print(f"synthetic build log: {opts.size} MB")
+        print(f"{'approach':8s} {'time':>12s} {'peak RSS':>14s}")
+        for approach in opts.approach or APPROACHES:
+            subprocess.run(
+                [sys.executable, __file__, "--approach", approach, "--log", log_path],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
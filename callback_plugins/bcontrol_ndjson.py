@@ -0,0 +1,100 @@
+# Ansible callback plugin of bcontrol (see stdout_callback in ansible.cfg).
+#
+# Emits one JSON object per line as soon as the event happens, so bcontrol can
+# follow the run live instead of waiting for one document at the end of the
+# play. Events (key "event"):
+#
+#   play_start  {"play": {"name", "id"}}
+#   task_start  {"task": {"name", "id", "tags"}}
+#   result      {"task": {"name", "id"}, "host", "status", "ignore_errors",
+#                "result"} where status is ok, failed, unreachable or skipped
+#   stats       {"stats": {host: summary}}
+#
+# Every event carries "time" (UTC, "%Y-%m-%dT%H:%M:%S.%fZ").
+#
+# This file is loaded by Ansible itself, it must not import bcontroller.
+import datetime
+import json
+
+from ansible.module_utils.common.json import AnsibleJSONEncoder
+from ansible.plugins.callback import CallbackBase
+
+
+DOCUMENTATION = """
+    name: bcontrol_ndjson
+    type: stdout
+    short_description: NDJSON event stream for bcontrol
+    description:
+        - One JSON object per line for every play, task, host result and the final stats.
+"""
+
+# Duplicates of stdout/stderr split into lines, not needed by bcontrol
+_DROPPED_KEYS = ("stdout_lines", "stderr_lines")
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "stdout"
+    CALLBACK_NAME = "bcontrol_ndjson"
+
+    def __init__(self, display=None):
+        super().__init__(display)
+        # Callable receiving the events instead of the standard output, used
+        # by bcontrol when it runs Ansible in its own process
+        self.sink = None
+
+    def emit(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = _now()
+        if self.sink is not None:
+            self.sink(json.loads(json.dumps(fields, cls=AnsibleJSONEncoder)))
+        else:
+            self._display.display(json.dumps(fields, cls=AnsibleJSONEncoder))
+
+    def v2_playbook_on_play_start(self, play):
+        self.emit("play_start", play={"name": play.get_name(), "id": str(play._uuid)})
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.emit("task_start", task={"name": task.get_name(), "id": str(task._uuid), "tags": list(task.tags)})
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.v2_playbook_on_task_start(task, False)
+
+    def _result(self, status, result, ignore_errors=False):
+        if result._result.get("_ansible_no_log"):
+            host_result = {"censored": "the output has been hidden due to the fact that 'no_log: true' was specified for this result"}
+        else:
+            host_result = {
+                key: val for key, val in result._result.items() if key not in _DROPPED_KEYS
+            }
+        host_result["action"] = result._task.action
+
+        self.emit(
+            "result",
+            task={"name": result._task.get_name(), "id": str(result._task._uuid)},
+            host=result._host.get_name(),
+            status=status,
+            ignore_errors=ignore_errors,
+            result=host_result,
+        )
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self._result("ok", result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False, **kwargs):
+        self._result("failed", result, ignore_errors)
+
+    def v2_runner_on_unreachable(self, result, **kwargs):
+        self._result("unreachable", result)
+
+    def v2_runner_on_skipped(self, result, **kwargs):
+        self._result("skipped", result)
+
+    def v2_playbook_on_stats(self, stats):
+        self.emit("stats", stats={
+            host: stats.summarize(host) for host in sorted(stats.processed.keys())
+        })
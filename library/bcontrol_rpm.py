@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# Ansible module of bcontrol (see library in ansible.cfg).
+#
+# Install local kernel packages in one direct rpm transaction, without yum:
+# no repository metadata is loaded and no depsolver runs, dependencies are
+# only checked against the installed packages. Install-only packages (the
+# kernel itself) are installed next to the installed versions, the others
+# (kernel-headers) are upgraded or downgraded in place.
+#
+# It runs on DUTs, with their python and its rpm bindings.
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+
+from ansible.module_utils.basic import AnsibleModule
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+
+DOCUMENTATION = """
+    module: bcontrol_rpm
+    short_description: Install local kernel packages in one rpm transaction
+    options:
+        paths:
+            description: Paths to the packages on the host.
+            type: list
+            elements: path
+            required: true
+"""
+
+# Package names installed next to the other versions, as in yum.conf
+_INSTALLONLY_NAMES = ("kernel", "kernel-core", "kernel-modules", "kernel-devel", "kernel-debuginfo")
+_INSTALLONLY_PROVIDE = "installonlypkg(kernel)"
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+
+    return value
+
+
+def _header(ts, path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return ts.hdrFromFdno(fd)
+    finally:
+        os.close(fd)
+
+
+def _nevra(hdr):
+    return "%s-%s-%s.%s" % tuple(_text(hdr[tag]) for tag in (rpm.RPMTAG_NAME, rpm.RPMTAG_VERSION, rpm.RPMTAG_RELEASE, rpm.RPMTAG_ARCH))
+
+
+def _installonly(hdr):
+    provides = [_text(name) for name in hdr[rpm.RPMTAG_PROVIDENAME]]
+    return _text(hdr[rpm.RPMTAG_NAME]) in _INSTALLONLY_NAMES or _INSTALLONLY_PROVIDE in provides
+
+
+def _installed(ts, hdr):
+    for installed in ts.dbMatch("name", hdr[rpm.RPMTAG_NAME]):
+        if _nevra(installed) == _nevra(hdr):
+            return True
+
+    return False
+
+
+def _problems(problems):
+    if isinstance(problems, (list, tuple)):
+        return "; ".join(str(problem) for problem in problems)
+
+    return str(problems)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            paths=dict(type="list", elements="path", required=True),
+        ),
+        supports_check_mode=True,
+    )
+
+    if rpm is None:
+        module.fail_json(msg="python rpm bindings are not available on the host")
+
+    ts = rpm.TransactionSet()
+    # Kernel packages built by bcontrol are not signed
+    ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+
+    installed = []
+    added = []
+    for path in module.params["paths"]:
+        try:
+            hdr = _header(ts, path)
+        except (OSError, rpm.error) as e:
+            module.fail_json(msg="cannot read package %s: %s" % (path, e))
+
+        if _installed(ts, hdr):
+            installed.append(_nevra(hdr))
+            continue
+
+        ts.addInstall(hdr, path, "i" if _installonly(hdr) else "u")
+        added.append(_nevra(hdr))
+
+    if not added or module.check_mode:
+        module.exit_json(changed=bool(added), installed=added, already_installed=installed)
+
+    problems = ts.check()
+    if problems:
+        module.fail_json(msg="dependency problems: %s" % _problems(problems))
+
+    ts.order()
+    fds = {}
+
+    def callback(reason, amount, total, key, client_data):
+        if reason == rpm.RPMCALLBACK_INST_OPEN_FILE:
+            fds[key] = os.open(key, os.O_RDONLY)
+            return fds[key]
+
+        if reason == rpm.RPMCALLBACK_INST_CLOSE_FILE:
+            os.close(fds.pop(key))
+
+    problems = ts.run(callback, "")
+    if problems:
+        module.fail_json(msg="transaction failed: %s" % _problems(problems))
+
+    module.exit_json(changed=True, installed=added, already_installed=installed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/bin/sh
+# Remove kernels installed by bcontrol (listed in /var/lib/bcontrol/kernels,
+# see playbooks/tasks/register-kernel.yml) except the running kernel, the
+# default one (the baseline) and the releases given as arguments.
+#
+# All RPM kernels are removed in one rpm transaction, then the boot entries
+# and files which are left (tarball kernels, see tasks/install-tarball.yml)
+# are removed. Prints the removed releases.
+REGISTRY=/var/lib/bcontrol/kernels
+[ -s "$REGISTRY" ] || exit 0
+
+running=$(uname -r)
+default=$(grubby --default-kernel 2>/dev/null | sed 's|^/boot/vmlinuz-||')
+
+kept=""
+removed=""
+packages=""
+while read -r release; do
+    [ -n "$release" ] || continue
+
+    keep=no
+    for keep_release in "$running" "$default" "$@"; do
+        [ "$release" = "$keep_release" ] && keep=yes
+    done
+
+    if [ "$keep" = yes ]; then
+        kept="$kept $release"
+        continue
+    fi
+
+    removed="$removed $release"
+    if owners=$(rpm -qf "/lib/modules/$release" 2>/dev/null); then
+        packages="$packages $owners"
+    fi
+done < "$REGISTRY"
+
+[ -n "$removed" ] || exit 0
+
+if [ -n "$packages" ]; then
+    # shellcheck disable=SC2086
+    rpm --erase $(printf '%s\n' $packages | sort -u) || exit 1
+fi
+
+for release in $removed; do
+    if grubby --info="/boot/vmlinuz-$release" >/dev/null 2>&1; then
+        grubby --remove-kernel="/boot/vmlinuz-$release"
+    fi
+
+    rm -rf "/lib/modules/$release" "/boot/vmlinuz-$release" "/boot/.vmlinuz-$release.hmac" \
+        "/boot/System.map-$release" "/boot/config-$release" "/boot/initramfs-$release.img"
+done
+
+printf '%s\n' $kept > "$REGISTRY"
+echo $removed
@@ -0,0 +1,66 @@
+import json
+import subprocess
+
+import pytest
+
+import bcontroller
+from bcontroller.buildcache import BuildCache
+
+
+def _git(repo, *args):
+    return subprocess.run(["git", "-C", str(repo)] + list(args), check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout.strip()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    tree = tmp_path / "linux"
+    tree.mkdir()
+    _git(tree, "init", "--quiet")
+    _git(tree, "config", "user.name", "bcontrol")
+    _git(tree, "config", "user.email", "bcontrol@example.com")
+    (tree / "Makefile").write_text("all:\n")
+    (tree / ".gitignore").write_text(".config\n")
+    _git(tree, "add", "Makefile", ".gitignore")
+    _git(tree, "commit", "--quiet", "-m", "v6.1")
+    (tree / ".config").write_text("CONFIG_LOCALVERSION_AUTO=y\n")
+    return tree
+
+
+def _built(tmp_path):
+    pkg_path = tmp_path / "kernel-6.1.0-1.x86_64.rpm"
+    pkg_path.write_bytes(b"rpm")
+    return bcontroller.BuildManifest(kernel=str(pkg_path), headers=None, devel=None, debuginfo=None)
+
+
+def test_hit_of_same_tree_keeps_built_release(tmp_path, tree, monkeypatch):
+    cache = BuildCache(str(tmp_path / "cache"))
+    key = cache.key(str(tree), "", "", bcontroller.ARTIFACT_RPM)
+    cached = cache.put(key, _built(tmp_path), "6.1.0-00001-g1234567")
+
+    # Same tree under another commit, its own release would be -g<other>
+    _git(tree, "commit", "--quiet", "--allow-empty", "-m", "empty")
+    assert cache.key(str(tree), "", "", bcontroller.ARTIFACT_RPM) == key
+    manifest = cache.get(key)
+    assert manifest == cached
+
+    monkeypatch.setattr(bcontroller, "_BUILD_CACHE", cache)
+    assert bcontroller.manifest_release(str(tree), "", manifest) == "6.1.0-00001-g1234567"
+
+
+def test_entry_without_release_is_a_miss(tmp_path, tree):
+    cache = BuildCache(str(tmp_path / "cache"))
+    key = cache.key(str(tree), "", "", bcontroller.ARTIFACT_RPM)
+    cache.put(key, _built(tmp_path), "6.1.0")
+    manifest_path = tmp_path / "cache" / key / "manifest.json"
+    entry = json.loads(manifest_path.read_text())
+    del entry["release"]
+    manifest_path.write_text(json.dumps(entry))
+
+    assert cache.get(key) is None
+
+
+def test_release_of_package_outside_cache(tmp_path):
+    cache = BuildCache(str(tmp_path / "cache"))
+
+    assert cache.release(str(tmp_path / "kernel-6.1.0-1.x86_64.rpm")) is None
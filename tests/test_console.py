@@ -0,0 +1,63 @@
+import os
+import pty
+import threading
+
+from bcontroller import console
+
+
+PANIC_TRACE = (
+    b"[    1.234567] Kernel panic - not syncing: VFS: Unable to mount root fs on unknown-block(0,0)\r\n"
+    b"[    1.234600] CPU: 0 PID: 1 Comm: swapper/0 Not tainted 6.1.0-bc0123456789\r\n"
+    b"[    1.234700] Call Trace:\r\n"
+    b"[    1.234800]  panic+0x10a/0x2e4\r\n"
+)
+
+
+def test_panic_on_pty_console(tmp_path, monkeypatch):
+    monkeypatch.setattr(console, "PANIC_GRACE", 0.1)
+    master, slave = pty.openpty()
+    monitor = console.ConsoleMonitor({"dut1": os.ttyname(slave)}, log_dir=str(tmp_path))
+    panics = []
+    fired = threading.Event()
+
+    def watcher(panic):
+        panics.append(panic)
+        fired.set()
+
+    monitor.start()
+    try:
+        os.write(master, b"[    0.000000] Linux version 6.1.0-bc0123456789\r\n")
+        monitor.watch("dut1", watcher)
+        os.write(master, PANIC_TRACE)
+        assert fired.wait(5)
+    finally:
+        monitor.close()
+        os.close(master)
+        os.close(slave)
+
+    panic, = panics
+    assert panic.host == "dut1"
+    assert panic.line.startswith("[    1.234567] Kernel panic - not syncing")
+    assert "panic+0x10a/0x2e4" in panic.log
+    assert "\r" not in panic.log
+    assert panic.log_path == str(tmp_path / "dut1.log")
+    with open(panic.log_path, encoding="utf-8") as f:
+        assert f.read().startswith("[    0.000000] Linux version")
+
+
+def test_unwatched_panic_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(console, "PANIC_GRACE", 0.1)
+    master, slave = pty.openpty()
+    monitor = console.ConsoleMonitor({"dut1": os.ttyname(slave)}, log_dir=str(tmp_path))
+    fired = threading.Event()
+
+    monitor.start()
+    try:
+        monitor.watch("dut1", lambda panic: fired.set())
+        monitor.unwatch("dut1")
+        os.write(master, PANIC_TRACE)
+        assert not fired.wait(0.5)
+    finally:
+        monitor.close()
+        os.close(master)
+        os.close(slave)
@@ -0,0 +1,142 @@
+import hashlib
+import io
+import tempfile
+
+from bcontroller import dut_agent
+
+
+def _requests(*frames):
+    stream = io.BytesIO()
+    for header, data in frames:
+        dut_agent.write_frame(stream, header, data)
+
+    stream.seek(0)
+    return stream
+
+
+def _responses(stream):
+    stream.seek(0)
+    responses = []
+    while True:
+        header, _ = dut_agent.read_frame(stream)
+        if header is None:
+            return responses
+
+        responses.append(header)
+
+
+def test_put_stores_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(dut_agent, "STORE_DIR", str(tmp_path))
+    content = b"kernel" * 1000
+    sha256 = hashlib.sha256(content).hexdigest()
+    stdin = _requests(
+        ({"op": "put", "sha256": sha256}, b""),
+        ({"op": "chunk"}, content[:3000]),
+        ({"op": "chunk"}, content[3000:]),
+        ({"op": "chunk"}, b""),
+    )
+    stdout = io.BytesIO()
+
+    dut_agent.serve(stdin, stdout)
+
+    assert _responses(stdout) == [{"ok": True, "evicted": []}]
+    assert (tmp_path / sha256).read_bytes() == content
+
+
+def test_put_write_error_keeps_framing(tmp_path, monkeypatch):
+    monkeypatch.setattr(dut_agent, "STORE_DIR", str(tmp_path))
+
+    named_temporary_file = tempfile.NamedTemporaryFile
+
+    class FailingFile:
+        def __init__(self, **kwargs):
+            self._file = named_temporary_file(**kwargs)
+            self.name = self._file.name
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self._file.close()
+
+        def write(self, data):
+            raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(tempfile, "NamedTemporaryFile", FailingFile)
+    stdin = _requests(
+        ({"op": "put", "sha256": "0" * 64}, b""),
+        ({"op": "chunk"}, b"a" * 100),
+        ({"op": "chunk"}, b"b" * 100),
+        ({"op": "chunk"}, b""),
+        ({"op": "ping"}, b""),
+    )
+    stdout = io.BytesIO()
+
+    dut_agent.serve(stdin, stdout)
+
+    put, ping = _responses(stdout)
+    assert not put["ok"] and "No space left on device" in put["error"]
+    assert ping["ok"] and "boot_id" in ping
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_link_does_not_share_the_stored_file(tmp_path, monkeypatch):
+    store = tmp_path / "store"
+    store.mkdir()
+    monkeypatch.setattr(dut_agent, "STORE_DIR", str(store))
+    sha256 = "1" * 64
+    (store / sha256).write_bytes(b"kernel")
+    (store / sha256).chmod(0o644)
+    dest = tmp_path / "vmlinuz"
+    stdout = io.BytesIO()
+
+    dut_agent.serve(_requests(({"op": "link", "sha256": sha256, "dest": str(dest), "mode": 0o600}, b"")), stdout)
+
+    assert _responses(stdout) == [{"ok": True}]
+    assert dest.read_bytes() == b"kernel"
+    assert (dest.stat().st_mode & 0o777, (store / sha256).stat().st_mode & 0o777) == (0o600, 0o644)
+    assert (store / sha256).stat().st_nlink == 1
+    assert dut_agent.evict(0) == [sha256]
+
+
+def test_failed_fetch_removes_partial_download(tmp_path, monkeypatch):
+    monkeypatch.setattr(dut_agent, "STORE_DIR", str(tmp_path))
+
+    class TimingOutResponse:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def read(self, size):
+            raise TimeoutError("timed out")
+
+    monkeypatch.setattr(dut_agent.urllib.request, "urlopen", lambda url, timeout: TimingOutResponse())
+    stdout = io.BytesIO()
+
+    dut_agent.serve(_requests(({"op": "fetch", "url": "http://dut1:8765/" + "0" * 64, "sha256": "0" * 64}, b"")), stdout)
+
+    fetch, = _responses(stdout)
+    assert not fetch["ok"] and "timed out" in fetch["error"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_put_does_not_evict_files_of_its_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(dut_agent, "STORE_DIR", str(tmp_path))
+    old, batch = "1" * 64, "2" * 64
+    (tmp_path / old).write_bytes(b"o" * 100)
+    (tmp_path / batch).write_bytes(b"b" * 100)
+    content = b"kernel" * 100
+    sha256 = hashlib.sha256(content).hexdigest()
+    stdin = _requests(
+        ({"op": "put", "sha256": sha256, "cap": 100, "keep": [batch, sha256]}, b""),
+        ({"op": "chunk"}, content),
+        ({"op": "chunk"}, b""),
+    )
+    stdout = io.BytesIO()
+
+    dut_agent.serve(stdin, stdout)
+
+    assert _responses(stdout) == [{"ok": True, "evicted": [old]}]
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([batch, sha256])
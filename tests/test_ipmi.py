@@ -0,0 +1,126 @@
+import itertools
+import os
+import stat
+
+import pytest
+
+import bcontroller
+from bcontroller import BControlTimeout
+from bcontroller.boot import BootTimes
+from bcontroller.inventory import Inventory
+from bcontroller.ipmi import POWER_CYCLE, POWER_RESET, IPMIPower
+
+
+# Records every call as "<start> <end> <BMC port> <operation>"
+FAKE_IPMITOOL = """#!/bin/sh
+start=$(date +%s.%N)
+while [ $# -gt 1 ]; do
+    [ "$1" = "-p" ] && port=$2
+    shift
+done
+sleep 0.2
+[ "$1" = status ] && echo "Chassis Power is on"
+echo "$start $(date +%s.%N) $port $1" >> "$IPMI_LOG"
+"""
+
+HOSTS = ["dut1", "dut2", "dut3", "dut4"]
+
+
+def _calls(log):
+    with open(log) as f:
+        return [(float(start), float(end), "dut%d" % (int(port) - 9000), op)
+                for start, end, port, op in (line.split() for line in f)]
+
+
+class FakeSSH:
+    """
+    DUTs which are hung: in-band reboot fails.
+    """
+
+    def command(self, host, remote_command):
+        return ["false"], os.environ.copy()
+
+
+class FakeWaiter:
+    """
+    DUTs which come back after the BMC operation given by `recovers`.
+    """
+
+    def __init__(self, log, recovers):
+        self.log = log
+        self.recovers = recovers
+
+    async def boot_id(self, host):
+        return "before"
+
+    async def wait(self, host, old_boot_id, timeout):
+        ops = [op for _, _, call_host, op in _calls(self.log) if call_host == host]
+        if ops[-1] != self.recovers[host]:
+            raise BControlTimeout("Boot of %s" % host, timeout)
+
+        return BootTimes(down=0.1, banner=0.2, ready=0.3)
+
+
+@pytest.fixture
+def ipmi_log(tmp_path, monkeypatch):
+    ipmitool = tmp_path / "bin" / "ipmitool"
+    ipmitool.parent.mkdir()
+    ipmitool.write_text(FAKE_IPMITOOL)
+    ipmitool.chmod(ipmitool.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", "%s:%s" % (ipmitool.parent, os.environ["PATH"]))
+    monkeypatch.setenv("IPMI_LOG", str(tmp_path / "ipmi.log"))
+    (tmp_path / "ipmi.log").write_text("")
+    return str(tmp_path / "ipmi.log")
+
+
+def _power(monkeypatch, ipmi_log, recovers, concurrency, rate):
+    inventory = Inventory({
+        "duts": {"hosts": HOSTS},
+        "duts-mgmt": {"hosts": ["%s-mgmt" % host for host in HOSTS]},
+        "_meta": {"hostvars": {
+            "%s-mgmt" % host: {"ansible_host": "127.0.0.1", "bcontrol_ipmi_port": 9001 + index}
+            for index, host in enumerate(HOSTS)
+        }},
+    })
+    power = IPMIPower(inventory, concurrency=concurrency, rate=rate)
+    power._ssh = FakeSSH()
+    power.waiter = FakeWaiter(ipmi_log, recovers)
+    monkeypatch.setattr(bcontroller, "_POWER", power)
+    return power
+
+
+def test_reboot_escalates(monkeypatch, ipmi_log):
+    recovers = {"dut1": POWER_RESET, "dut2": POWER_CYCLE, "dut3": POWER_RESET, "dut4": POWER_CYCLE}
+    _power(monkeypatch, ipmi_log, recovers, concurrency=8, rate=0)
+
+    results = bcontroller.reboot(bcontroller.REBOOT_IPMI, ready_timeout=1)
+
+    assert {host: step for host, (step, _) in results.items()} == recovers
+    ops = {host: [op for _, _, call_host, op in _calls(ipmi_log) if call_host == host] for host in HOSTS}
+    assert ops["dut1"] == ["reset"]
+    # The chassis is checked to be powered on before the cycle
+    assert ops["dut2"] == ["reset", "status", "cycle"]
+
+
+def test_reboot_fails_when_nothing_helps(monkeypatch, ipmi_log):
+    _power(monkeypatch, ipmi_log, dict.fromkeys(HOSTS, "never"), concurrency=8, rate=0)
+
+    with pytest.raises(bcontroller.BControlError) as e:
+        bcontroller.reboot(bcontroller.REBOOT_IPMI, ready_timeout=1)
+
+    assert e.value.message.count("did not come back") == len(HOSTS)
+
+
+def test_power_is_rate_limited(monkeypatch, ipmi_log):
+    _power(monkeypatch, ipmi_log, dict.fromkeys(HOSTS, POWER_RESET), concurrency=2, rate=20)
+
+    bcontroller.reboot(bcontroller.REBOOT_IPMI, ready_timeout=1)
+
+    calls = sorted(_calls(ipmi_log))
+    assert len(calls) == len(HOSTS)
+    # Started at most 20 per second
+    for (start, _, _, _), (next_start, _, _, _) in zip(calls, calls[1:]):
+        assert next_start - start >= 0.04
+    # Never more than 2 ipmitool processes at once
+    for first, second, third in itertools.combinations(calls, 3):
+        assert not max(first[0], second[0], third[0]) < min(first[1], second[1], third[1])
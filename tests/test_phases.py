@@ -0,0 +1,31 @@
+import bcontroller
+
+
+def _events(*tasks):
+    events = bcontroller.AnsibleEvents()
+    events.feed({"event": "play_start", "play": {"name": "all", "id": "p"}, "time": "2026-01-01T00:00:00.000000Z"})
+    for index, (name, tags, result) in enumerate(tasks):
+        task = {"name": name, "id": str(index), "tags": tags}
+        events.feed({"event": "task_start", "task": task, "time": "2026-01-01T00:00:00.000000Z"})
+        events.feed({"event": "result", "task": task, "host": "dut1", "status": "failed" if result.get("failed") else "ok",
+                     "ignore_errors": False, "result": result, "time": "2026-01-01T00:00:05.000000Z"})
+
+    return events.document()
+
+
+def test_timeout_phase_from_task_tag():
+    doc = _events(
+        ("Copy kernel inside DUTs", ["phase_copy"], {}),
+        ("Renamed install task", ["phase_install"], {"failed": True, "msg": "Timed out after 1 second(s)."}),
+    )
+
+    timeout = bcontroller._ansible_timeout(doc)
+
+    assert timeout.phase == "install"
+    assert timeout.elapsed == 5.0
+
+
+def test_timeout_of_untagged_task_has_no_phase():
+    doc = _events(("Some task", [], {"failed": True, "msg": "Timed out after 1 second(s)."}))
+
+    assert bcontroller._ansible_timeout(doc).phase is None
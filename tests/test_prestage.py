@@ -0,0 +1,48 @@
+import subprocess
+
+import pytest
+
+from bcontroller import prestage
+
+
+def _git(repo, *args):
+    return subprocess.run(["git", "-C", str(repo)] + list(args), check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    _git(tmp_path, "init", "--quiet")
+    _git(tmp_path, "config", "user.name", "bcontrol")
+    _git(tmp_path, "config", "user.email", "bcontrol@example.com")
+    for i in range(8):
+        _git(tmp_path, "commit", "--quiet", "--allow-empty", "-m", "commit %d" % i)
+
+    return tmp_path
+
+
+def _stage(repo, commit):
+    session = prestage.Session(str(repo))
+    session.staged[commit] = {"release": "6.0.0-bc%s" % commit[:12], "pkg": "/tmp/kernel.rpm"}
+    session.save()
+
+
+def test_staged_state_survives_bisect_steps(repo):
+    _git(repo, "bisect", "start", "HEAD", "HEAD~7")
+    _stage(repo, _git(repo, "rev-parse", "HEAD~1"))
+
+    _git(repo, "bisect", "good")
+    assert prestage.Session(str(repo)).staged
+    _git(repo, "bisect", "bad", "HEAD~0")
+    assert prestage.Session(str(repo)).staged
+
+
+def test_staged_state_dropped_on_new_bisect(repo):
+    _git(repo, "bisect", "start", "HEAD", "HEAD~7")
+    _stage(repo, _git(repo, "rev-parse", "HEAD~1"))
+
+    _git(repo, "bisect", "reset")
+    assert not prestage.Session(str(repo)).staged
+
+    _git(repo, "bisect", "start", "HEAD~2", "HEAD~5")
+    assert not prestage.Session(str(repo)).staged
@@ -0,0 +1,31 @@
+from bcontroller.inventory import Inventory
+from bcontroller.sshpool import SSHPool
+
+
+def _pool(tmp_path, hostvars):
+    inventory = Inventory({"_meta": {"hostvars": hostvars}})
+    return SSHPool(list(hostvars), control_dir=str(tmp_path), inventory=inventory)
+
+
+def test_host_keys_checked_by_default(tmp_path, monkeypatch):
+    monkeypatch.delenv("ANSIBLE_HOST_KEY_CHECKING", raising=False)
+    args = _pool(tmp_path, {"dut1": {}}).ssh_args("dut1")
+
+    assert "StrictHostKeyChecking=no" not in args
+    assert "UserKnownHostsFile=/dev/null" not in args
+
+
+def test_host_key_checking_opt_out_by_inventory(tmp_path, monkeypatch):
+    monkeypatch.delenv("ANSIBLE_HOST_KEY_CHECKING", raising=False)
+    pool = _pool(tmp_path, {"dut1": {"ansible_host_key_checking": "false"}, "dut2": {}})
+
+    assert "StrictHostKeyChecking=no" in pool.ssh_args("dut1")
+    assert "StrictHostKeyChecking=no" not in pool.ssh_args("dut2")
+
+
+def test_host_key_checking_opt_out_by_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("ANSIBLE_HOST_KEY_CHECKING", "False")
+    pool = _pool(tmp_path, {"dut1": {}, "dut2": {"ansible_host_key_checking": True}})
+
+    assert "StrictHostKeyChecking=no" in pool.ssh_args("dut1")
+    assert "StrictHostKeyChecking=no" not in pool.ssh_args("dut2")
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from bcontroller.stream import Interrupt, multiplex
+
+
+def test_interrupt_raises_first_thrown_error():
+    read_fd, write_fd = os.pipe()
+    interrupt = Interrupt()
+    interrupt.throw(KeyError("first"))
+    interrupt.throw(ValueError("second"))
+
+    with os.fdopen(read_fd, "rb") as stream, pytest.raises(KeyError):
+        list(multiplex({"stdout": stream}, interrupt=interrupt))
+
+    os.close(write_fd)
+    interrupt.close()
+
+
+def test_interrupt_throw_after_close_is_ignored():
+    interrupt = Interrupt()
+    interrupt.close()
+
+    interrupt.throw(KeyError("late panic"))
+    interrupt.close()
+
+    assert interrupt.error is None
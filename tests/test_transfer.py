@@ -0,0 +1,49 @@
+import os
+
+from bcontroller import transfer
+
+
+class LocalPool:
+    """
+    SSH pool which runs remote commands locally.
+    """
+
+    connect_timeout = 10
+
+    def command(self, host, remote_command):
+        return ["sh", "-c", remote_command], os.environ.copy()
+
+
+def _cache(tmp_path, names_ages):
+    now = 1_700_000_000
+    for name, age in names_ages.items():
+        path = tmp_path / name
+        path.write_bytes(b"x")
+        os.utime(path, (now - age, now - age))
+
+    return tmp_path
+
+
+def test_prune_keeps_newest(tmp_path):
+    cache = _cache(tmp_path, {"a.rpm": 30, "b.rpm": 20, "c.rpm": 10})
+
+    transfer._prune(LocalPool(), "dut", str(cache), 2, "c.rpm")
+
+    assert sorted(os.listdir(cache)) == ["b.rpm", "c.rpm"]
+
+
+def test_prune_keeps_pushed_old_package(tmp_path):
+    # The pushed package keeps the (old) mtime of the controller file
+    cache = _cache(tmp_path, {"old.rpm": 1000, "new1.rpm": 20, "new2.rpm": 10})
+
+    transfer._prune(LocalPool(), "dut", str(cache), 2, "old.rpm")
+
+    assert sorted(os.listdir(cache)) == ["new2.rpm", "old.rpm"]
+
+
+def test_prune_keep_one(tmp_path):
+    cache = _cache(tmp_path, {"old.rpm": 1000, "new.rpm": 10})
+
+    transfer._prune(LocalPool(), "dut", str(cache), 1, "old.rpm")
+
+    assert os.listdir(cache) == ["old.rpm"]
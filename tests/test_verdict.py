@@ -0,0 +1,158 @@
+import pytest
+
+import bcontroller
+from bcontroller import (
+    VERDICT_ALL,
+    VERDICT_ANY_BAD,
+    VERDICT_FIRST,
+    BControlBisectAbort,
+    BControlBisectSkip,
+    BControlTimeout,
+    _StepDecided,
+    _StepResults,
+    step_verdict,
+)
+from bcontroller.console import Panic
+
+
+SCRIPT = _StepResults._SCRIPT_TASK
+STEP_RESULT = _StepResults._STEP_RESULT_TASK
+KERNEL = "6.1.0-bc0123456789"
+
+
+def _step_result(rc, kernel=KERNEL):
+    return {"ansible_facts": {"bcontrol_step": {
+        "kernel": kernel,
+        "verified": str(kernel == KERNEL),
+        "rc": "" if rc is None else str(rc),
+        "stdout": "",
+        "stderr": "",
+    }}}
+
+
+def _feed(step, events):
+    for task_name, host, result in events:
+        try:
+            step.add(task_name, host, result)
+        except _StepDecided:
+            pass
+
+
+def _verdict(events, hosts=("dut1",), verdict=VERDICT_ALL, **kwargs):
+    step = _StepResults(hosts, verdict=verdict, **kwargs)
+    _feed(step, events)
+    return step_verdict(step.results, verdict, hosts=hosts)
+
+
+def test_good_and_bad():
+    assert _verdict([(SCRIPT, "dut1", {"rc": 0}), (STEP_RESULT, "dut1", _step_result(0))]) == 0
+    assert _verdict([
+        (SCRIPT, "dut1", {"rc": 1, "failed": True}),
+        (STEP_RESULT, "dut1", _step_result(1)),
+    ]) == 1
+
+
+def test_script_timeout_is_test_phase_timeout():
+    timed_out = {"failed": True, "msg": "Task failed: Timed out after 60 second(s)."}
+
+    with pytest.raises(BControlTimeout) as e:
+        _verdict([(SCRIPT, "dut1", timed_out), (STEP_RESULT, "dut1", _step_result(None))], test_deadline=60)
+
+    assert e.value.phase == "test"
+    assert e.value.elapsed == 60
+
+
+def test_script_failed_without_exit_code_aborts():
+    with pytest.raises(BControlBisectAbort):
+        _verdict([(SCRIPT, "dut1", {"failed": True, "msg": "Could not find or access 'test.sh'"})])
+
+
+def test_verified_without_exit_code_is_skip():
+    with pytest.raises(BControlBisectSkip):
+        _verdict([(STEP_RESULT, "dut1", _step_result(None))])
+
+
+def test_other_kernel_is_skip():
+    with pytest.raises(BControlBisectSkip):
+        _verdict([(STEP_RESULT, "dut1", _step_result(None, kernel="6.0.0"))])
+
+
+def test_timeout_is_handled_by_watchdog():
+    def step():
+        return _verdict([(SCRIPT, "dut1", {"failed": True, "msg": "Timed out after 1 second(s)."})])
+
+    watchdog = bcontroller.PhaseWatchdog(on_timeout={"test": bcontroller.ON_TIMEOUT_SKIP})
+    with pytest.raises(BControlBisectSkip):
+        watchdog.run("step", step)
+
+    assert watchdog.report.phases["test"]["timed_out"]
+
+
+def test_unreachable_during_test_is_failure():
+    unreachable = {"unreachable": True, "msg": "Failed to connect to the host via ssh"}
+
+    with pytest.raises(BControlBisectAbort):
+        _verdict([(SCRIPT, "dut1", unreachable)])
+
+
+def test_missing_host_is_skip():
+    with pytest.raises(BControlBisectSkip):
+        _verdict([(STEP_RESULT, "dut1", _step_result(0))], hosts=("dut1", "dut2"))
+
+
+def _panic(host):
+    return Panic(host, "Kernel panic - not syncing: VFS", "[    1.0] Kernel panic\n", None)
+
+
+def test_any_bad_ignores_skip_and_crashes():
+    hosts = ("dut1", "dut2", "dut3")
+    step = _StepResults(hosts, verdict=VERDICT_ANY_BAD)
+    _feed(step, [(STEP_RESULT, "dut1", _step_result(125)), (STEP_RESULT, "dut2", _step_result(139))])
+    assert not step.decided()
+
+    _feed(step, [(STEP_RESULT, "dut3", _step_result(1))])
+    assert step_verdict(step.results, VERDICT_ANY_BAD, hosts=hosts) == 1
+
+
+def test_any_bad_ignores_unfinished_hosts():
+    hosts = ("dut1", "dut2", "dut3")
+    step = _StepResults(hosts, verdict=VERDICT_ANY_BAD, test_deadline=60)
+    step.panicked(_panic("dut1"))
+    _feed(step, [
+        (SCRIPT, "dut2", {"unreachable": True, "msg": "Failed to connect"}),
+        (SCRIPT, "dut3", {"failed": True, "msg": "Timed out after 60 second(s)."}),
+    ])
+    assert step.decided()
+
+    # No DUT reproduced the bug, the panicked one skips
+    with pytest.raises(BControlBisectSkip):
+        step_verdict(step.results, VERDICT_ANY_BAD, hosts=hosts)
+
+
+def test_first_counts_finished_hosts():
+    hosts = ("dut1", "dut2")
+    step = _StepResults(hosts, verdict=VERDICT_FIRST)
+    step.panicked(_panic("dut1"))
+    assert not step.decided()
+
+    _feed(step, [(STEP_RESULT, "dut2", _step_result(1))])
+    assert step.decided()
+    assert step_verdict(step.results, VERDICT_FIRST, hosts=hosts) == 1
+
+
+def test_first_without_finished_host():
+    with pytest.raises(BControlBisectAbort):
+        _verdict([(SCRIPT, "dut1", {"unreachable": True, "msg": "Failed to connect"})], verdict=VERDICT_FIRST)
+
+
+def test_panic_is_skip():
+    step = _StepResults(("dut1",))
+    with pytest.raises(_StepDecided):
+        step.panicked(_panic("dut1"))
+
+    with pytest.raises(BControlBisectSkip):
+        step_verdict(step.results, VERDICT_ALL, hosts=("dut1",))
+
+
+def test_skip_exit_code_passes_through():
+    assert _verdict([(STEP_RESULT, "dut1", _step_result(125))]) == 125